@@ -0,0 +1,332 @@
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Mapping, Optional, Tuple
+import db_async
+from db_migrations import stage_pipeline
+from unit_of_work import current_unit_of_work
+
+
+TRACK_FIELD = 'UF_CRM_1723542556619'  # Поле сделки с трек-номером
+
+# Признак того, что значения нет в контексте и его нужно прочитать из базы
+MISSING = object()
+
+
+@dataclass(frozen=True)
+class BatchContext:
+    """
+    Данные локальной базы, загруженные одним набором пакетных запросов для всех сделок пакета вебхуков.
+
+    Снимок неизменяем. Ключи приведены к строкам, так как ID из Bitrix приходят строками.
+    Для каждого вида данных хранится и множество запрошенных ключей: отсутствие ключа в данных
+    означает, что записи в базе нет, и повторно обращаться к базе не нужно.
+    Записи, сделанные во время обработки пакета, накладываются поверх снимка (overrides):
+    пока они ждут сохранения в UnitOfWork, следующая сделка того же клиента или трек-номера видит их.
+    """
+    data: Mapping[str, Mapping[str, Any]]
+    requested: Mapping[str, frozenset]
+    overrides: Dict[Tuple[str, str], Any] = field(default_factory=dict)
+
+    def lookup(self, kind: str, key) -> Any:
+        """
+        Возвращает значение из контекста, None если записи нет, или MISSING, если ключ не загружался.
+        """
+        if key is None:
+            return MISSING
+        key = str(key)
+        value = self.overrides.get((kind, key), MISSING)
+        if value is MISSING:
+            if key not in self.requested.get(kind, ()):
+                return MISSING
+            value = self.data[kind].get(key)
+        if isinstance(value, (dict, list)):
+            return type(value)(value)
+        return value
+
+    def override(self, kind: str, key, value) -> None:
+        if key is not None:
+            self.overrides[(kind, str(key))] = value
+
+    def find_contact_by_final_deal_id(self, final_deal_id) -> Optional[str]:
+        final_deals = {contact_id: final_deal for contact_id, final_deal in self.data.get("final_deals", {}).items()}
+        final_deals.update({key: value for (kind, key), value in self.overrides.items() if kind == "final_deals"})
+        for contact_id, final_deal in final_deals.items():
+            if final_deal and str(final_deal.get('final_deal_id')) == str(final_deal_id):
+                return contact_id
+        return None
+
+
+_current_context: ContextVar[Optional[BatchContext]] = ContextVar("batch_context", default=None)
+
+
+def _freeze(values: Dict[Any, Any]) -> Mapping[str, Any]:
+    return MappingProxyType({str(key): value for key, value in values.items()})
+
+
+async def build_batch_context(deals: Iterable[Dict[str, Any]]) -> BatchContext:
+    """
+    Собирает трек-номера, контакты и ID сделок пакета и загружает связанные записи
+    clients, track_numbers, tracked_deals, deal_history, final_deals, final_deal_tracks и deal_tasks
+    пакетными запросами.
+    """
+    deals = list(deals)
+    track_numbers = {deal.get(TRACK_FIELD) for deal in deals if deal.get(TRACK_FIELD)}
+    contact_ids = {str(deal.get('CONTACT_ID')) for deal in deals if deal.get('CONTACT_ID')}
+    deal_ids = {str(deal.get('ID')) for deal in deals if deal.get('ID')}
+
+    tracks = await db_async.get_tracks_by_numbers(track_numbers)
+    tracked_deals = await db_async.find_deals_by_tracks(track_numbers)
+    deal_history = await db_async.get_deal_history_for_tracks(track_numbers)
+    final_deals = await db_async.get_final_deals_by_contact_ids(contact_ids)
+    clients_by_contact = await db_async.get_clients_by_contact_ids(contact_ids)
+    final_deal_ids = {str(final_deal['final_deal_id']) for final_deal in final_deals.values()}
+    final_deal_tracks = await db_async.get_final_deal_tracks_by_ids(final_deal_ids)
+
+    # Клиенты, на которых ссылаются трек-номера, и задачи сделок-дубликатов
+    chat_ids = {str(track['chat_id']) for track in tracks.values() if track.get('chat_id')}
+    chat_ids |= {str(client['chat_id']) for client in clients_by_contact.values() if client.get('chat_id')}
+    clients_by_chat = await db_async.get_clients_by_chat_ids(chat_ids)
+    task_deal_ids = deal_ids | {str(deal['ID']) for deal in tracked_deals.values()}
+    deal_tasks = await db_async.get_task_ids_by_deal_ids(task_deal_ids)
+
+    context = BatchContext(
+        data=MappingProxyType({
+            "tracks": _freeze(tracks),
+            "tracked_deals": _freeze(tracked_deals),
+            "deal_history": _freeze(deal_history),
+            "final_deals": _freeze(final_deals),
+            "final_deal_tracks": _freeze(final_deal_tracks),
+            "clients_by_contact": _freeze(clients_by_contact),
+            "clients_by_chat": _freeze(clients_by_chat),
+            "deal_tasks": _freeze(deal_tasks),
+        }),
+        requested=MappingProxyType({
+            "tracks": frozenset(track_numbers),
+            "tracked_deals": frozenset(track_numbers),
+            "deal_history": frozenset(track_numbers),
+            "final_deals": frozenset(contact_ids),
+            "final_deal_tracks": frozenset(final_deal_ids),
+            "clients_by_contact": frozenset(contact_ids),
+            "clients_by_chat": frozenset(chat_ids),
+            "deal_tasks": frozenset(task_deal_ids),
+        }),
+    )
+    logging.info(f"Контекст пакета: {len(deals)} сделок, {len(track_numbers)} трек-номеров, "
+                 f"{len(contact_ids)} контактов, {len(chat_ids)} клиентов.")
+    return context
+
+
+@contextmanager
+def use_batch_context(context: BatchContext):
+    """
+    Делает context текущим для функций обработки сделок на время блока with.
+    """
+    token = _current_context.set(context)
+    try:
+        yield context
+    finally:
+        _current_context.reset(token)
+
+
+def _lookup(kind, key):
+    context = _current_context.get()
+    return context.lookup(kind, key) if context else MISSING
+
+
+def _override(kind, key, value):
+    context = _current_context.get()
+    if context:
+        context.override(kind, key, value)
+
+
+async def _write(statement, params, direct_write, *args, **kwargs):
+    """
+    Записывает в базу сразу или, если задан UnitOfWork, откладывает запись до конца обработки пакета.
+    """
+    unit_of_work = current_unit_of_work()
+    if unit_of_work is None:
+        return await direct_write(*args, **kwargs)
+    unit_of_work.add(statement, params)
+
+
+# ========== Чтение: из контекста пакета, при его отсутствии — из базы ==========
+# Функции повторяют сигнатуры и результаты одноимённых функций db_async.
+
+async def get_track_data_by_track_number(track_number):
+    value = _lookup("tracks", track_number)
+    return await db_async.get_track_data_by_track_number(track_number) if value is MISSING else value
+
+
+async def get_name_track_by_track_number(track_number):
+    value = _lookup("tracks", track_number)
+    if value is MISSING:
+        return await db_async.get_name_track_by_track_number(track_number)
+    return value['name_track'] if value else None
+
+
+async def get_client_by_chat_id(chat_id):
+    value = _lookup("clients_by_chat", chat_id)
+    return await db_async.get_client_by_chat_id(chat_id) if value is MISSING else value
+
+
+async def get_personal_code_by_chat_id(chat_id):
+    value = _lookup("clients_by_chat", chat_id)
+    if value is MISSING:
+        return await db_async.get_personal_code_by_chat_id(chat_id)
+    return value['personal_code'] if value else None
+
+
+async def get_client_by_contact_id(contact_id):
+    value = _lookup("clients_by_contact", contact_id)
+    return await db_async.get_client_by_contact_id(contact_id) if value is MISSING else value
+
+
+async def get_chat_id_by_contact_id(contact_id):
+    value = _lookup("clients_by_contact", contact_id)
+    if value is MISSING:
+        return await db_async.get_chat_id_by_contact_id(contact_id)
+    return value['chat_id'] if value else None
+
+
+async def find_deal_by_track(track_number, current_deal_id=None):
+    value = _lookup("tracked_deals", track_number)
+    if value is MISSING:
+        return await db_async.find_deal_by_track(track_number, current_deal_id=current_deal_id)
+    if not value or str(value["ID"]) == str(current_deal_id):
+        return None
+    return value
+
+
+async def get_original_date_by_track(track_number):
+    value = _lookup("deal_history", track_number)
+    return await db_async.get_original_date_by_track(track_number) if value is MISSING else value
+
+
+async def get_final_deal_from_db(contact_id):
+    value = _lookup("final_deals", contact_id)
+    return await db_async.get_final_deal_from_db(contact_id) if value is MISSING else value
+
+
+async def get_final_deal_track_numbers(final_deal_id):
+    value = _lookup("final_deal_tracks", final_deal_id)
+    if value is MISSING:
+        return await db_async.get_final_deal_track_numbers(final_deal_id)
+    return value or []
+
+
+async def get_task_id_by_deal_id(deal_id):
+    value = _lookup("deal_tasks", deal_id)
+    return await db_async.get_task_id_by_deal_id(deal_id) if value is MISSING else value
+
+
+# ========== Запись: в базу или в UnitOfWork, результат накладывается на контекст пакета ==========
+# Отложенные записи сохраняются вместе с операциями Bitrix пакета, не дожидаясь их выполнения (см. UnitOfWork).
+
+async def update_tracked_deal(deal_id, track_number):
+    if _current_context.get():
+        current = await find_deal_by_track(track_number)
+        _override("tracked_deals", track_number, {"ID": deal_id} if current else None)
+    return await _write("update_tracked_deal", (deal_id, track_number), db_async.update_tracked_deal, deal_id,
+                        track_number)
+
+
+async def save_deal_history(deal_id, track_number, original_date_modify, stage_id, china_shipment_date=None):
+    if _current_context.get():
+        current = await get_original_date_by_track(track_number)
+        china_date = china_shipment_date if china_shipment_date is not None else (current[2] if current else None)
+        _override("deal_history", track_number, (original_date_modify, stage_id, china_date))
+    statement = "save_deal_history_china" if china_shipment_date is not None else "save_deal_history"
+    return await _write(statement, (deal_id, track_number, original_date_modify, stage_id, china_shipment_date),
+                        db_async.save_deal_history, deal_id, track_number, original_date_modify,
+                        stage_id, china_shipment_date)
+
+
+async def record_stage_transition(deal_id, track_number, stage_id, changed_at):
+    """
+    Добавляет переход трек-номера на этап stage_id в журнал stage_transitions.
+    """
+    unit_of_work = current_unit_of_work()
+    if unit_of_work is None:
+        return await db_async.save_stage_transitions([(track_number, deal_id, stage_id, changed_at)])
+    unit_of_work.add("register_stage", (stage_id, stage_pipeline(stage_id)))
+    unit_of_work.add("stage_transition", (track_number, deal_id, stage_id, changed_at))
+
+
+async def save_final_deal_to_db(contact_id, deal_id, creation_date, track_number, current_stage_id,
+                                weight=0, amount=0, number_of_orders=1):
+    _override("final_deals", contact_id, {
+        'id': None,
+        'contact_id': contact_id,
+        'final_deal_id': deal_id,
+        'creation_date': creation_date,
+        'current_stage_id': current_stage_id,
+        'track_count': 1,
+        'total_weight': weight,
+        'total_amount': amount,
+        'number_of_orders': number_of_orders
+    })
+    _override("final_deal_tracks", deal_id, [track_number])
+    unit_of_work = current_unit_of_work()
+    if unit_of_work is None:
+        return await db_async.save_final_deal_to_db(contact_id, deal_id, creation_date, track_number, current_stage_id,
+                                                    weight, amount, number_of_orders)
+    unit_of_work.add("save_final_deal", (contact_id, deal_id, creation_date, current_stage_id))
+    unit_of_work.add("append_final_deal_track", (deal_id, track_number, weight, amount, number_of_orders))
+
+
+async def append_final_deal_track(final_deal_id, track_number, weight=0, amount=0, number_of_orders=0):
+    context = _current_context.get()
+    if context is None:
+        return await db_async.append_final_deal_track(final_deal_id, track_number, weight, amount, number_of_orders)
+
+    # Повторяем в контексте то, что сделают с итогами сделки триггеры final_deal_tracks
+    track_numbers = await get_final_deal_track_numbers(final_deal_id)
+    if track_number in track_numbers:
+        return False
+    _override("final_deal_tracks", final_deal_id, track_numbers + [track_number])
+    contact_id = context.find_contact_by_final_deal_id(final_deal_id)
+    if contact_id is not None:
+        final_deal = context.lookup("final_deals", contact_id)
+        final_deal.update({
+            'track_count': (final_deal.get('track_count') or 0) + 1,
+            'total_weight': (final_deal.get('total_weight') or 0) + weight,
+            'total_amount': (final_deal.get('total_amount') or 0) + amount,
+            'number_of_orders': (final_deal.get('number_of_orders') or 0) + number_of_orders,
+        })
+        _override("final_deals", contact_id, final_deal)
+    await _write("append_final_deal_track", (final_deal_id, track_number, weight, amount, number_of_orders),
+                 db_async.append_final_deal_track, final_deal_id, track_number, weight, amount,
+                 number_of_orders)
+    return True
+
+
+async def update_name_track_by_track_number(track_number, new_name):
+    if _current_context.get():
+        current = await get_track_data_by_track_number(track_number)
+        _override("tracks", track_number, dict(current, name_track=new_name) if current else None)
+    return await _write("update_name_track", (new_name, track_number), db_async.update_name_track_by_track_number,
+                        track_number, new_name)
+
+
+async def delete_deal_by_track_number(track_number):
+    if current_unit_of_work() is None or not track_number:
+        _override("tracks", track_number, None)
+        return await db_async.delete_deal_by_track_number(track_number)
+    # Запись откладывается, поэтому результат (была ли запись) определяется по текущим данным
+    existed = await get_track_data_by_track_number(track_number) is not None
+    _override("tracks", track_number, None)
+    current_unit_of_work().add("delete_track", (track_number,))
+    return existed
+
+
+async def save_task_to_db(deal_id, task_id):
+    _override("deal_tasks", deal_id, task_id)
+    return await _write("save_task", (deal_id, task_id), db_async.save_task_to_db, deal_id, task_id)
+
+
+async def delete_task_from_db(deal_id):
+    _override("deal_tasks", deal_id, None)
+    return await _write("delete_task", (deal_id,), db_async.delete_task_from_db, deal_id)
@@ -0,0 +1,206 @@
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+
+# Ссылка на результат другой команды внутри batch-запроса: $result[key] или $result[key][ID]
+RESULT_REFERENCE = re.compile(r"\$result\[([^\]]+)\]")
+
+# Методы, у которых операции над одной сделкой можно объединять и отбрасывать
+DEAL_UPDATE_METHOD = "crm.deal.update"
+DEAL_DELETE_METHOD = "crm.deal.delete"
+DEAL_METHODS_DROPPED_BY_DELETE = {DEAL_UPDATE_METHOD, "crm.deal.contact.items.delete"}
+
+BATCH_LIMIT = 50  # Максимальное количество команд в одном batch-запросе Bitrix24
+
+
+@dataclass
+class Operation:
+    """
+    Команда batch-запроса, разобранная из строки вида "method?param=value&...".
+
+    Значения параметров не декодируются и собираются обратно в том же виде,
+    в котором их сформировал OperationsBuilder.
+    """
+    key: str
+    method: str
+    params: List[Tuple[str, str]]
+    entity: Optional[str] = None                   # Сущность, которую меняет команда: "deal:123", "task:45"
+    depends_on: List[str] = field(default_factory=list)
+
+    @classmethod
+    def parse(cls, key: str, query: str) -> "Operation":
+        method, _, query_string = query.partition("?")
+        params = []
+        for part in query_string.split("&"):
+            if part:
+                name, _, value = part.partition("=")
+                params.append((name, value))
+        operation = cls(key=key, method=method, params=params)
+        operation.entity = operation._detect_entity()
+        operation.depends_on = [ref for _, value in params for ref in RESULT_REFERENCE.findall(value)]
+        return operation
+
+    def get_param(self, *names: str) -> Optional[str]:
+        for name, value in self.params:
+            if name in names:
+                return value
+        return None
+
+    def _detect_entity(self) -> Optional[str]:
+        if self.method.startswith("crm.deal."):
+            deal_id = self.get_param("ID", "id")
+            return f"deal:{deal_id}" if deal_id else None
+        if self.method.startswith("crm.contact."):
+            contact_id = self.get_param("ID", "id")
+            return f"contact:{contact_id}" if contact_id else None
+        if self.method == "tasks.task.delete":
+            task_id = self.get_param("taskId")
+            return f"task:{task_id}" if task_id else None
+        if self.method == "tasks.task.add":
+            # Задача привязана к сделке через поле UF_CRM_TASK=D_{deal_id}
+            binding = self.get_param("fields[UF_CRM_TASK]")
+            if binding and binding.startswith("D_"):
+                return f"deal:{binding[2:]}"
+        return None
+
+    def merge_update(self, other: "Operation") -> None:
+        """
+        Объединяет поля другого crm.deal.update для той же сделки. Более поздние значения имеют приоритет.
+        """
+        merged = {name: value for name, value in self.params if name not in ("ID", "id")}
+        for name, value in other.params:
+            if name not in ("ID", "id"):
+                merged[name] = value
+        deal_id = self.get_param("ID", "id")
+        self.params = [("ID", deal_id)] + list(merged.items())
+        self.depends_on = [ref for _, value in self.params for ref in RESULT_REFERENCE.findall(value)]
+
+    def to_query(self) -> str:
+        return f"{self.method}?" + "&".join(f"{name}={value}" for name, value in self.params)
+
+
+@dataclass
+class BatchPlan:
+    """
+    Результат планирования: чанки для отправки и соответствие исходных ключей итоговым.
+    aliases[исходный_ключ] — ключ команды, в которую вошла операция, или None, если операция отброшена.
+    """
+    chunks: List[Dict[str, str]]
+    aliases: Dict[str, Optional[str]]
+
+
+def _merge_and_prune(operations: List[Operation], aliases: Dict[str, Optional[str]]) -> List[Operation]:
+    """
+    Объединяет обновления одной сделки и отбрасывает операции над сделками, которые удаляются в этом же пакете.
+    """
+    deleted_deals = {op.entity for op in operations if op.method == DEAL_DELETE_METHOD and op.entity}
+
+    result = []
+    update_by_deal: Dict[str, Operation] = {}
+    for op in operations:
+        if op.entity in deleted_deals and op.method in DEAL_METHODS_DROPPED_BY_DELETE:
+            aliases[op.key] = None
+            logging.debug(f"Операция {op.key} отброшена: сделка {op.entity} удаляется в этом же пакете.")
+            continue
+        if op.method == DEAL_UPDATE_METHOD and op.entity:
+            target = update_by_deal.get(op.entity)
+            if target is not None:
+                target.merge_update(op)
+                aliases[op.key] = target.key
+                logging.debug(f"Операция {op.key} объединена с {target.key}.")
+                continue
+            update_by_deal[op.entity] = op
+        result.append(op)
+    return result
+
+
+def _group_operations(operations: List[Operation]) -> List[List[Operation]]:
+    """
+    Группирует операции, которые должны выполниться в одном batch-запросе:
+    команды над одной сущностью (сохраняется их порядок) и команды, связанные через $result[...].
+    """
+    parent = {op.key: op.key for op in operations}
+
+    def find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    def union(a, b):
+        parent[find(a)] = find(b)
+
+    first_by_entity = {}
+    for op in operations:
+        if op.entity:
+            if op.entity in first_by_entity:
+                union(op.key, first_by_entity[op.entity])
+            else:
+                first_by_entity[op.entity] = op.key
+        for ref in op.depends_on:
+            if ref in parent:
+                union(op.key, ref)
+            else:
+                logging.warning(f"Операция {op.key} ссылается на отсутствующую команду {ref}.")
+
+    groups: Dict[str, List[Operation]] = {}
+    for op in operations:  # Порядок внутри группы совпадает с исходным
+        groups.setdefault(find(op.key), []).append(op)
+    return list(groups.values())
+
+
+def _order_group(group: List[Operation]) -> List[Operation]:
+    """
+    Упорядочивает группу так, чтобы команды шли после команд, на результат которых они ссылаются.
+    """
+    keys = {op.key for op in group}
+    ordered, placed = [], set()
+    pending = list(group)
+    while pending:
+        progressed = False
+        for op in list(pending):
+            if all(ref in placed or ref not in keys for ref in op.depends_on):
+                ordered.append(op)
+                placed.add(op.key)
+                pending.remove(op)
+                progressed = True
+        if not progressed:
+            logging.error(f"Циклические ссылки $result между операциями: {[op.key for op in pending]}")
+            ordered.extend(pending)
+            break
+    return ordered
+
+
+def plan_operations(operations: Dict[str, str], batch_limit: int = BATCH_LIMIT) -> BatchPlan:
+    """
+    Строит план отправки операций OperationsBuilder:
+    - объединяет несколько crm.deal.update одной сделки в одну команду;
+    - отбрасывает обновления и отвязку контакта у сделок, удаляемых в этом же пакете;
+    - помещает связанные команды (одна сущность, ссылки $result[...]) в один чанк;
+    - упаковывает группы в минимальное количество чанков не больше batch_limit команд.
+    """
+    aliases: Dict[str, Optional[str]] = {key: key for key in operations}
+    parsed = [Operation.parse(key, query) for key, query in operations.items()]
+    merged = _merge_and_prune(parsed, aliases)
+    groups = [_order_group(group) for group in _group_operations(merged)]
+
+    # Упаковка групп в чанки (first fit decreasing)
+    bins: List[List[Operation]] = []
+    for group in sorted(groups, key=len, reverse=True):
+        if len(group) > batch_limit:
+            logging.warning(f"Группа из {len(group)} связанных операций не помещается в один batch и будет разделена.")
+            for i in range(0, len(group), batch_limit):
+                bins.append(group[i:i + batch_limit])
+            continue
+        for chunk in bins:
+            if len(chunk) + len(group) <= batch_limit:
+                chunk.extend(group)
+                break
+        else:
+            bins.append(list(group))
+
+    chunks = [{op.key: op.to_query() for op in chunk} for chunk in bins]
+    logging.info(f"План batch-запросов: {len(operations)} операций -> {len(merged)} команд в {len(chunks)} чанках.")
+    return BatchPlan(chunks=chunks, aliases=aliases)
@@ -1,9 +1,17 @@
 import logging
 import asyncio
+import os
+import socket
+from urllib.parse import quote
 from config import bitrix  # Используем инициализированный BitrixAsync из config
-from db_management import get_unprocessed_webhooks, mark_webhook_as_processed, save_task_to_db, \
-    get_task_id_by_deal_id, delete_task_from_db
+from db_async import claim_webhooks, release_webhooks, cache_deals
 from process_functions import process_contact_update, process_deal_add, process_deal_update
+from rate_limiter import TokenBucket, backoff_delay
+from batch_context import build_batch_context, use_batch_context, save_task_to_db, get_task_id_by_deal_id, \
+    delete_task_from_db, TRACK_FIELD
+from unit_of_work import UnitOfWork, use_unit_of_work
+from crm_sync import mirror_records, find_mirrored_deals_by_tracks, DEAL_FIELDS, CONTACT_FIELDS
+from outbox import notify_outbox
 
 # Инициализация логирования
 logging.basicConfig(
@@ -12,52 +20,68 @@ logging.basicConfig(
 )
 logging.getLogger('fast_bitrix24').addHandler(logging.StreamHandler())
 
+# Ограничения частоты batch-запросов к Bitrix
+BITRIX_REQUESTS_PER_SECOND = 2.0   # Допустимая скорость запросов к порталу
+BITRIX_BURST = 10                  # Сколько запросов можно отправить подряд после простоя
+MAX_CONCURRENT_CHUNKS = 4          # Сколько batch-чанков отправляется одновременно
+DUPLICATE_SEARCH_TRACKS = 25       # Трек-номеров в одной команде поиска дубликатов: у трек-номера обычно
+                                   # одна-две сделки, поэтому ответ помещается в одну страницу
+LIST_PAGE_SIZE = 50                # Сколько записей crm.*.list возвращает за один запрос
+
+bitrix_bucket = TokenBucket(rate=BITRIX_REQUESTS_PER_SECOND, capacity=BITRIX_BURST)
+
+# Вебхуки обрабатываются порциями, взятыми в аренду, чтобы после массового обновления
+# в Bitrix или простоя бота не загружать в память всю очередь сразу
+WEBHOOK_CHUNK_SIZE = 500           # Сколько вебхуков берётся в одну порцию
+WEBHOOK_LEASE_SECONDS = 600        # Через сколько секунд порция упавшего обработчика снова станет доступна
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
 
 # ========== Пакетное получение информации из Bitrix ==========
 
-async def fetch_batch_entity_info(entity_ids, entity_type):
+async def fetch_entities(entity_ids, entity_type, select):
     """
-    Получает информацию о сущностях (сделках или контактах) из Bitrix в пакетном режиме.
+    Получает сделки или контакты из Bitrix по списку ID в пакетном режиме.
+
+    Каждая команда batch-запроса — crm.{entity_type}.list с filter[ID][] на LIST_PAGE_SIZE идентификаторов
+    и списком полей select, поэтому одна команда возвращает до 50 записей только с нужными полями.
+    Повторяющиеся ID загружаются один раз.
 
-    :param entity_ids: Список идентификаторов сущностей.
+    :param entity_ids: Идентификаторы сущностей (повторы допускаются).
     :param entity_type: Тип сущности - 'deal' или 'contact'.
-    :return: Список словарей с информацией о сущностях.
+    :param select: Поля, которые нужны вызывающему коду.
+    :return: Словарь {str(ID): запись}.
     """
+    entity_ids = list(dict.fromkeys(str(entity_id) for entity_id in entity_ids if entity_id))
     if not entity_ids:
-        logging.debug("Список entity_ids пуст. Возвращаем пустой список.")
-        return []
-
-    all_entity_info = []
-    batch_size = 50  # Максимальный размер batch-запроса в Bitrix24
-    total_entities = len(entity_ids)
-    logging.debug(f"Начало обработки {total_entities} сущностей типа '{entity_type}' с batch_size={batch_size}.")
-
-    for i in range(0, total_entities, batch_size):
-        chunk_ids = entity_ids[i:i + batch_size]
-        operations = {
-            f"{entity_type}_{idx}": f"crm.{entity_type}.get?ID={entity_id}"
-            for idx, entity_id in enumerate(chunk_ids)
-        }
-        logging.debug(f"Сформирован batch-чанк с {len(chunk_ids)} сущностями: {chunk_ids}")
-
-        try:
-            response = await bitrix.call_batch({
-                'halt': 0,
-                'cmd': operations
-            })
-            logging.debug(f"Ответ от Bitrix для текущего чанка: {response}")
-
-            if isinstance(response, dict):
-                all_entity_info.extend(response.values())
-                logging.info(f"Успешно получено {len(response.values())} записей для типа '{entity_type}' в текущем чанке.")
-            else:
-                logging.error(f"Непредвиденная структура ответа: {response}")
-
-        except Exception as e:
-            logging.error(f"Ошибка при выполнении batch-запроса для сущностей {chunk_ids}: {e}")
+        logging.debug("Список entity_ids пуст. Возвращаем пустой словарь.")
+        return {}
+
+    operations = {
+        f"{entity_type}_{i // LIST_PAGE_SIZE}": f"crm.{entity_type}.list?" + "&".join(
+            [f"filter[ID][]={entity_id}" for entity_id in entity_ids[i:i + LIST_PAGE_SIZE]]
+            + ["start=-1"] + [f"select[]={field}" for field in select])
+        for i in range(0, len(entity_ids), LIST_PAGE_SIZE)
+    }
+    logging.debug(f"Загрузка {len(entity_ids)} сущностей типа '{entity_type}' командами: {len(operations)}.")
+    # Чанки отправляются параллельно с учётом лимита запросов
+    response = await send_chunks_concurrently(operations, batch_size=50)
+
+    entities = {}
+    for key in operations:
+        result = response.get(key)
+        if not isinstance(result, list):
+            logging.error(f"Команда {key} не выполнена: сущности типа '{entity_type}' не получены.")
+            continue
+        for entity in result:
+            entities[str(entity['ID'])] = entity
 
-    logging.debug(f"Обработка завершена. Всего получено {len(all_entity_info)} записей для типа '{entity_type}'.")
-    return all_entity_info
+    missing = len(entity_ids) - len(entities)
+    if missing:
+        logging.warning(f"Не получено {missing} из {len(entity_ids)} сущностей типа '{entity_type}' "
+                        f"(удалены или команда не выполнена).")
+    logging.debug(f"Обработка завершена. Всего получено {len(entities)} записей для типа '{entity_type}'.")
+    return entities
 
 
 # ========== Пакетная отправка данных в Bitrix ==========
@@ -69,9 +93,15 @@ def chunk_operations(operations, batch_size):
         yield dict(operations_list[i:i + batch_size])
 
 
+def _is_rate_limit_error(error):
+    return 'QUERY_LIMIT_EXCEEDED' in str(error)
+
+
 async def send_batch_chunk(batch_chunk, batch_size=50, max_retries=5):
     """
     Отправляет batch-запрос в Bitrix и возвращает результат выполнения.
+    Перед каждой попыткой берёт токен из bitrix_bucket. При превышении лимита Bitrix
+    снижает скорость запросов, повторные попытки выполняются с экспоненциальной задержкой.
     """
     retry_count = 0
     while retry_count < max_retries:
@@ -81,11 +111,12 @@ async def send_batch_chunk(batch_chunk, batch_size=50, max_retries=5):
             logging.info(f"Отправка batch-запроса: {list(batch_chunk.keys())}")
 
             # Выполняем batch-запрос
+            await bitrix_bucket.acquire()
             response = await bitrix.call_batch(batch_cmd)
 
             # 🛑 Проверяем ошибки и игнорируем "Not found"
             if 'result_error' in response:
-                for operation, error in response['result_error'].items():
+                for operation, error in list(response['result_error'].items()):
                     if isinstance(error, dict) and error.get('error_description') == 'Not found':
                         logging.info(f"✅ Bitrix подтвердил удаление сделки {operation}. Ошибка игнорируется.")
                         response['result_error'].pop(operation)  # Убираем ошибку, чтобы не вызывать исключение
@@ -93,13 +124,21 @@ async def send_batch_chunk(batch_chunk, batch_size=50, max_retries=5):
             # Обработка ошибок
             if 'error' in response:
                 error_type = response.get('error')
+                if _is_rate_limit_error(error_type):
+                    raise RuntimeError(error_type)
                 if error_type == 'ERROR_BATCH_LENGTH_EXCEEDED' and batch_size > 1:
                     logging.warning("Превышен лимит batch-запроса. Разделяем.")
                     results = {}
+                    errors = {}
                     for smaller_chunk in chunk_operations(batch_chunk, batch_size // 2):
                         # Рекурсивно обрабатываем мелкие чанки
                         chunk_result = await send_batch_chunk(smaller_chunk, batch_size // 2, max_retries)
+                        if chunk_result:
+                            errors.update(chunk_result.get('result_error') or {})
+                        else:
+                            errors.update({key: 'Чанк не выполнен' for key in smaller_chunk})
                         results.update(chunk_result)  # Собираем результаты
+                    results['result_error'] = errors
                     logging.debug(f"Обработка batch-запроса завершена. Результат: {response}")
                     return results
                 else:
@@ -109,44 +148,129 @@ async def send_batch_chunk(batch_chunk, batch_size=50, max_retries=5):
             # Логируем успешный ответ
             logging.info("Batch успешно выполнен.")
             logging.debug(f"Результаты batch-запроса: {response}")
+            bitrix_bucket.recover()
 
             # Обрабатываем ответ с сохранением TASK_ID
-            process_batch_response(response)
+            await process_batch_response(response)
 
             return response  # Возвращаем результат
         except Exception as e:
+            if _is_rate_limit_error(e):
+                bitrix_bucket.slow_down()
+            delay = backoff_delay(retry_count)
             retry_count += 1
-            logging.error(f"Ошибка в batch-запросе. Попытка {retry_count}: {e}")
-            await asyncio.sleep(2)
+            logging.error(f"Ошибка в batch-запросе. Попытка {retry_count}: {e}. Повтор через {delay:.1f} с.")
+            await asyncio.sleep(delay)
 
     # Если после всех попыток запрос не удался
     logging.error(f"Не удалось обработать чанк после {max_retries} попыток: {list(batch_chunk.keys())}")
     return {}
 
 
+async def send_chunks_concurrently(operations, batch_size=50):
+    """
+    Разбивает операции на чанки и отправляет их параллельно (не более MAX_CONCURRENT_CHUNKS одновременно).
+    Частота запросов ограничивается bitrix_bucket внутри send_batch_chunk.
+    Возвращает объединённые результаты всех чанков.
+    """
+    return await send_chunks(chunk_operations(operations, batch_size), batch_size)
+
+
+async def _send_chunks_gathered(chunks, batch_size):
+    """
+    Отправляет чанки параллельно (не более MAX_CONCURRENT_CHUNKS одновременно)
+    и возвращает список результатов в порядке чанков.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHUNKS)
+
+    async def send(batch_chunk):
+        async with semaphore:
+            return await send_batch_chunk(batch_chunk, batch_size)
+
+    return await asyncio.gather(*(send(batch_chunk) for batch_chunk in chunks))
+
+
+async def send_chunks(chunks, batch_size=50):
+    """
+    Отправляет готовые чанки параллельно (не более MAX_CONCURRENT_CHUNKS одновременно)
+    и возвращает объединённые результаты.
+    """
+    chunk_results = await _send_chunks_gathered(chunks, batch_size)
+
+    results = {}
+    for chunk_result in chunk_results:
+        if isinstance(chunk_result, dict):
+            results.update(chunk_result)
+        else:
+            logging.error(f"Непредвиденная структура ответа: {chunk_result}")
+    return results
+
+
+async def send_plan(plan, batch_size=50):
+    """
+    Отправляет чанки плана и возвращает словарь {исходный ключ операции: ошибка} для невыполненных операций:
+    все операции чанка, если запрос не удался, и команды из result_error.
+    Ключи, объединённые планировщиком с другой командой, разделяют её результат.
+    """
+    chunk_results = await _send_chunks_gathered(plan.chunks, batch_size)
+
+    failed = {}
+    for batch_chunk, chunk_result in zip(plan.chunks, chunk_results):
+        if not chunk_result or not isinstance(chunk_result, dict):
+            failed.update({key: "Batch-запрос не выполнен" for key in batch_chunk})
+        else:
+            for key, error in (chunk_result.get('result_error') or {}).items():
+                failed[key] = error.get('error_description', error) if isinstance(error, dict) else error
+    if failed:
+        logging.warning(f"Не выполнены операции batch-запроса: {sorted(failed)}")
+    return {key: failed[alias] for key, alias in plan.aliases.items() if alias in failed}
+
+
 # Обработка ответа на batch-запрос
-def process_batch_response(response):
+async def process_batch_response(response):
     for operation, result in response.items():
         if operation.startswith("almaty_task_"):
             deal_id = int(operation.split("_")[2])  # Извлекаем deal_id из названия операции
             task_data = result.get("task", {})
             task_id = task_data.get("id")
             if task_id:
-                save_task_to_db(deal_id, task_id)
+                await save_task_to_db(deal_id, task_id)
 
 
 async def batch_send_to_bitrix():
     """
-    Получает необработанные вебхуки, извлекает данные из Bitrix и отправляет их на дальнейшую обработку.
+    Обрабатывает очередь вебхуков порциями по WEBHOOK_CHUNK_SIZE, пока она не опустеет.
+    Каждая порция берётся в аренду и фиксируется отдельно, поэтому после перезапуска
+    обработка продолжается с первой незавершённой порции. Если порцию не удалось обработать,
+    она освобождается, а исключение передаётся диспетчеру, который повторит обработку с задержкой.
     """
     logging.info("Запуск пакетной обработки.")
-    webhooks = get_unprocessed_webhooks()
-    if not webhooks:
+    total = 0
+    while True:
+        webhooks = await claim_webhooks(WORKER_ID, WEBHOOK_CHUNK_SIZE, WEBHOOK_LEASE_SECONDS)
+        if not webhooks:
+            break
+        total += len(webhooks)
+        try:
+            await process_webhook_chunk(webhooks)
+        except Exception:
+            # Освобождаем порцию, чтобы её можно было повторить, не дожидаясь истечения аренды
+            await release_webhooks(webhooks, WORKER_ID)
+            raise
+        if len(webhooks) < WEBHOOK_CHUNK_SIZE:
+            break
+
+    if not total:
         logging.info("Нет необработанных вебхуков.")
-        return
 
-    logging.info(f"Обработка {len(webhooks)} вебхуков.")
-    await asyncio.sleep(2)  # Задержка для стабилизации
+
+async def process_webhook_chunk(webhooks):
+    """
+    Извлекает данные из Bitrix для порции вебхуков, отправляет их на дальнейшую обработку
+    и помечает вебхуки как обработанные.
+    """
+    suppressed = sum(webhook['duplicates'] for webhook in webhooks)
+    logging.info(f"Обработка {len(webhooks)} вебхуков (схлопнуто повторных событий: {suppressed}).")
 
     deal_ids = set()
     contact_ids = set()
@@ -165,115 +289,141 @@ async def batch_send_to_bitrix():
         elif event_type == "ONCRMDEALUPDATE":
             deal_update_ids.add(entity_id)
 
-    # Получение информации о сделках
-    if deal_ids:
-        deal_info_list = await fetch_batch_entity_info(list(deal_ids), "deal")
+    # Получение информации о новых и обновленных сделках: сделка из обоих наборов загружается один раз
+    deals = await fetch_entities(deal_ids | deal_update_ids, "deal", DEAL_FIELDS)
+    deal_info_list = [deals[str(deal_id)] for deal_id in deal_ids if str(deal_id) in deals]
+    deal_update_info_list = [deals[str(deal_id)] for deal_id in deal_update_ids if str(deal_id) in deals]
+    await cache_deals(list(deals.values()))  # Полученные данные сразу обновляют кэш сделок
+    await mirror_records("deal", list(deals.values()))  # и зеркало CRM до следующей синхронизации
+
+    # Записи локальной базы для всех сделок порции загружаются заранее пакетными запросами,
+    # обработчики сделок читают их из контекста вместо отдельного запроса на каждую сделку.
+    # Локальные записи копятся в unit_of_work и сохраняются одной транзакцией после batch-запросов.
+    context = await build_batch_context(deal_info_list + deal_update_info_list)
+    unit_of_work = UnitOfWork()
+    with use_batch_context(context), use_unit_of_work(unit_of_work):
         for deal_info in deal_info_list:
             try:
                 await process_deal_add(deal_info, operations, unregistered_deals)
             except Exception as e:
                 logging.error(f"Ошибка при обработке сделки {deal_info['ID']}: {e}")
 
-    # Получение информации о контактах
-    if contact_ids:
-        contact_info_list = await fetch_batch_entity_info(list(contact_ids), "contact")
-        for contact_info in contact_info_list:
-            try:
-                await process_contact_update(contact_info)
-            except Exception as e:
-                logging.error(f"Ошибка при обработке контакта {contact_info['ID']}: {e}")
+        # Получение информации о контактах
+        if contact_ids:
+            contact_info_list = list((await fetch_entities(contact_ids, "contact", CONTACT_FIELDS)).values())
+            await mirror_records("contact", contact_info_list)
+            for contact_info in contact_info_list:
+                try:
+                    await process_contact_update(contact_info)
+                except Exception as e:
+                    logging.error(f"Ошибка при обработке контакта {contact_info['ID']}: {e}")
 
-    # Получение информации об обновленных сделках
-    if deal_update_ids:
-        deal_update_info_list = await fetch_batch_entity_info(list(deal_update_ids), "deal")
         for deal_info in deal_update_info_list:
             try:
                 await process_deal_update(deal_info)  # Вызов функции для обработки обновлений сделок
             except Exception as e:
                 logging.error(f"Ошибка при обработке обновленной сделки {deal_info['ID']}: {e}")
 
-    # Обработка незарегистрированных трек-номеров
-    await handle_unregistered_deals(unregistered_deals, operations)
+        # Обработка незарегистрированных трек-номеров
+        await handle_unregistered_deals(unregistered_deals, operations)
 
-    # Финальная отправка batch-запросов
-    if operations:
-        for batch_chunk in chunk_operations(operations, batch_size=50):
-            await send_batch_chunk(batch_chunk)
-            await asyncio.sleep(1)
-    else:
-        logging.warning("Нет операций для batch-запроса.")
+        # Операции Bitrix ставятся в очередь outbox и отправляются обработчиком очереди (outbox.py)
+        if operations:
+            unit_of_work.enqueue_operations(operations, "webhook_batch")
+        else:
+            logging.warning("Нет операций для batch-запроса.")
 
-    # Отмечаем вебхуки как обработанные
+    # Локальные записи, операции Bitrix и отметка вебхуков сохраняются одной транзакцией
     for webhook in webhooks:
-        try:
-            mark_webhook_as_processed(webhook['id'])
-            logging.info(f"Вебхук {webhook['id']} успешно обработан.")
-        except Exception as e:
-            logging.error(f"Ошибка при обработке вебхука {webhook['id']}: {e}")
+        unit_of_work.add("mark_webhook_processed", (webhook['id'], webhook['timestamp']))
+    counts = await unit_of_work.commit()
+    if counts is None:
+        # Обработка прерывается: batch_send_to_bitrix освобождает порцию, диспетчер повторит её с задержкой
+        raise RuntimeError(f"Не удалось сохранить результаты обработки {len(webhooks)} вебхуков.")
+    if operations:
+        notify_outbox()
+        logging.info(f"В очередь операций Bitrix поставлено {len(operations)} операций.")
+
+    marked = counts.get("mark_webhook_processed", 0)
+    logging.info(f"Отмечено обработанными {marked} из {len(webhooks)} вебхуков.")
+    if marked < len(webhooks):
+        # Неотмеченные вебхуки освобождаются, чтобы следующий пакет взял их, не дожидаясь истечения аренды
+        await release_webhooks(webhooks, WORKER_ID)
+        logging.info("Часть вебхуков получила новые события во время обработки и будет обработана в следующем пакете.")
+
+
+async def search_deals_by_tracks(track_numbers):
+    """
+    Ищет сделки по списку трек-номеров и возвращает словарь {трек-номер: [сделки]}.
+
+    Если зеркало CRM актуально, сделки читаются из него. Иначе выполняется crm.deal.list с фильтром-массивом
+    по трек-номеру — одна команда на DUPLICATE_SEARCH_TRACKS трек-номеров, команды отправляются batch-запросами.
+    Если команда вернула полную страницу, следующая страница запрашивается по ID (filter[>ID]).
+    Трек-номера, поиск по которым не выполнен, в результат не попадают.
+    """
+    track_numbers = list(dict.fromkeys(track_number for track_number in track_numbers if track_number))
+    deals_by_track = await find_mirrored_deals_by_tracks(track_numbers)
+    if deals_by_track is not None:
+        logging.info(f"Сделки по {len(track_numbers)} трек-номерам получены из зеркала CRM.")
+        return deals_by_track
+
+    # Ключ операции -> (трек-номера, последний полученный ID)
+    pending = {
+        f"search_{i // DUPLICATE_SEARCH_TRACKS}": (track_numbers[i:i + DUPLICATE_SEARCH_TRACKS], 0)
+        for i in range(0, len(track_numbers), DUPLICATE_SEARCH_TRACKS)
+    }
+    deals_by_track = {}
+    while pending:
+        search_operations = {
+            key: "crm.deal.list?" + "&".join(
+                [f"filter[{TRACK_FIELD}][]={quote(track_number)}" for track_number in tracks]
+                + [f"filter[>ID]={last_id}", "order[ID]=ASC", "select[]=ID", "select[]=STAGE_ID",
+                   f"select[]={TRACK_FIELD}"])
+            for key, (tracks, last_id) in pending.items()
+        }
+        logging.info(f"Сформировано {len(search_operations)} операций для поиска сделок по трек-номерам.")
+        results = await send_chunks_concurrently(search_operations, batch_size=50)
+
+        next_pending = {}
+        for key, (tracks, last_id) in pending.items():
+            page = results.get(key)
+            if not isinstance(page, list):
+                logging.warning(f"Поиск сделок {key} не выполнен, трек-номера пропущены: {', '.join(tracks)}")
+                continue
+            for deal in page:
+                deals_by_track.setdefault(deal.get(TRACK_FIELD), []).append(deal)
+            if len(page) >= LIST_PAGE_SIZE:
+                next_pending[key] = (tracks, max(int(deal['ID']) for deal in page))
+        pending = next_pending
+    return deals_by_track
 
 
 async def handle_unregistered_deals(unregistered_deals, operations):
+    """
+    Удаляет дубликаты сделок с незарегистрированными трек-номерами: сделки с тем же трек-номером
+    на другом этапе. Сделки всех трек-номеров ищутся одним пакетом (search_deals_by_tracks)
+    и сопоставляются с исходными сделками по трек-номеру.
+    """
     if not unregistered_deals:
         logging.info("Нет сделок без зарегистрированных трек-номеров для обработки.")
         return
 
     logging.info(f"Начата обработка {len(unregistered_deals)} сделок без зарегистрированных трек-номеров.")
 
-    # Шаг 1: Формируем запросы для поиска дубликатов
-    search_operations = {}
-    for idx, deal in enumerate(unregistered_deals):
-        track_number = deal.get('track_number')
-        if not track_number:
+    # Шаг 1: Ищем сделки по всем трек-номерам сразу
+    for deal in unregistered_deals:
+        if not deal.get('track_number'):
             logging.warning(f"Пропущена сделка ID: {deal['ID']} из-за отсутствия трек-номера.")
-            continue
+    deals_by_track = await search_deals_by_tracks(deal.get('track_number') for deal in unregistered_deals)
 
-        search_operations[f"search_{idx}"] = (
-            f"crm.deal.list?"
-            f"filter[UF_CRM_1723542556619]={track_number}&"
-            f"filter[!ID]={deal['ID']}&"
-            f"select[]=ID&"
-            f"select[]=STAGE_ID"
-        )
-        logging.debug(f"Добавлена операция поиска: search_{idx} для трек-номера {track_number}")
-
-    logging.info(f"Сформировано {len(search_operations)} операций для поиска дубликатов.")
-
-    # Шаг 2: Отправляем запросы чанками
-    duplicate_results = {}
-    for batch_chunk in chunk_operations(search_operations, batch_size=50):
-        logging.debug(f"Отправляем следующий batch-чанк: {batch_chunk}")
-        chunk_result = await send_batch_chunk(batch_chunk)
-        logging.debug(f"Результаты batch-чанка: {chunk_result}")
-        if chunk_result:
-            duplicate_results.update(chunk_result)
-
-    # Проверяем, не потерялись ли данные
-    logging.debug(f"Итоговые результаты дубликатов: {duplicate_results}")
-
-    # Шаг 3: Обрабатываем результаты поиска
+    # Шаг 2: Дубликаты каждой сделки — сделки её трек-номера на другом этапе.
+    # Сделки, обрабатываемые в этом пакете, не удаляются, даже если совпадают по трек-номеру.
+    processed_ids = {str(deal['ID']) for deal in unregistered_deals}
     duplicate_ids = set()  # Используем set для исключения повторений
-
-    for idx, deal in enumerate(unregistered_deals):
-        deal_stage_id = deal.get('STAGE_ID')
-        deal_id = deal.get('ID')
-        logging.debug(f"Обрабатывается сделка ID={deal_id}, STAGE_ID={deal_stage_id}")
-
-        # Проходим по результатам поиска
-        for key, result_list in duplicate_results.items():
-            if not isinstance(result_list, list):
-                logging.warning(f"Ожидался список, но получено {type(result_list)} для ключа {key}. Пропускаем.")
-                continue
-
-            # Обрабатываем список дубликатов
-            for duplicate in result_list:
-                duplicate_stage_id = duplicate.get('STAGE_ID')
-                duplicate_id = duplicate.get('ID')
-
-                if duplicate_id != deal_id and duplicate_stage_id != deal_stage_id:
-                    # logging.debug(f"Добавлен дубликат: ID={duplicate_id}, STAGE_ID={duplicate_stage_id}")
-                    duplicate_ids.add(duplicate_id)
-                # else:
-                #     logging.debug(f"Исключён из дубликатов: ID={duplicate_id}, STAGE_ID={duplicate_stage_id}")
+    for deal in unregistered_deals:
+        for duplicate in deals_by_track.get(deal.get('track_number'), []):
+            if str(duplicate.get('ID')) not in processed_ids and duplicate.get('STAGE_ID') != deal.get('STAGE_ID'):
+                duplicate_ids.add(str(duplicate['ID']))
 
     # Проверяем, есть ли дубликаты
     if not duplicate_ids:
@@ -285,19 +435,19 @@ async def handle_unregistered_deals(unregistered_deals, operations):
 
     logging.info(f"Найдено {len(duplicate_ids)} уникальных дубликатов. Добавляем операции на удаление.")
 
-    # Шаг 4: Добавляем операции на удаление
-    for idx, deal_id in enumerate(duplicate_ids):
-        operations[f"delete_{idx}"] = f"crm.deal.delete?id={deal_id}"
-        logging.debug(f"Добавлена операция удаления: delete_{idx} для ID={deal_id}")
+    # Шаг 3: Добавляем операции на удаление
+    for deal_id in duplicate_ids:
+        operations[f"delete_deal_{deal_id}"] = f"crm.deal.delete?id={deal_id}"
+        logging.debug(f"Добавлена операция удаления: delete_deal_{deal_id}")
 
         # Получаем TASK_ID для текущей сделки
-        task_id = get_task_id_by_deal_id(deal_id)
+        task_id = await get_task_id_by_deal_id(deal_id)
         if task_id:
             # Добавляем операцию на удаление задачи
             operations[f"delete_task_{task_id}"] = f"tasks.task.delete?taskId={task_id}"
             logging.info(f"Добавлена операция удаления задачи с ID {task_id} для сделки {deal_id}.")
 
             # Удаляем запись о задаче из базы данных
-            delete_task_from_db(deal_id)
+            await delete_task_from_db(deal_id)
             logging.info(f"Запись о задаче с TASK_ID={task_id} для сделки {deal_id} удалена из базы данных.")
     logging.info(f"Операции на удаление добавлены. Всего операций: {len(operations)}")
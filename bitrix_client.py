@@ -0,0 +1,48 @@
+import logging
+import importlib.util
+import httpx
+
+
+# Параметры общего HTTP-клиента Bitrix
+REQUEST_TIMEOUT = 30.0               # Таймаут одного запроса в секундах
+MAX_CONNECTIONS = 20                 # Максимум одновременных соединений с Bitrix
+MAX_KEEPALIVE_CONNECTIONS = 10       # Сколько простаивающих соединений держать открытыми
+KEEPALIVE_EXPIRY = 60.0              # Через сколько секунд простоя закрывать соединение
+
+# HTTP/2 включается только если установлен пакет h2 (pip install httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+_client = None
+
+
+def get_bitrix_client():
+    """
+    Возвращает общий асинхронный HTTP-клиент для запросов к Bitrix.
+
+    Клиент создаётся при первом обращении и переиспользуется всеми функциями bitrix_integration,
+    поэтому соединения и TLS-сессии сохраняются между запросами (keep-alive).
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=REQUEST_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY
+            ),
+            http2=HTTP2_AVAILABLE
+        )
+        logging.info(f"Создан HTTP-клиент Bitrix (HTTP/2: {'да' if HTTP2_AVAILABLE else 'нет'}).")
+    return _client
+
+
+async def close_bitrix_client():
+    """
+    Закрывает общий HTTP-клиент Bitrix. Вызывается при остановке приложения.
+    """
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+        logging.info("HTTP-клиент Bitrix закрыт.")
+    _client = None
@@ -1,9 +1,11 @@
-import requests
 import logging
 import httpx
 from datetime import datetime
 from config import webhook_url, bitrix
+from bitrix_client import get_bitrix_client
 from db_management import find_deal_by_track
+from db_async import append_final_deal_track, get_final_deal_track_numbers
+from crm_sync import find_mirrored_deals_by_track, find_mirrored_deals_by_contact
 from tenacity import retry, stop_after_attempt, wait_fixed
 
 
@@ -31,21 +33,28 @@ stage_mapping = {
 
 
 # Получение информации о сделках и контактах
-def get_deals_by_track(track_number):
+async def get_deals_by_track(track_number):
     """
     Получает список сделок по значению пользовательского поля UF_CRM_1723542556619.
-    Возвращает список сделок с полями ID, STAGE_ID, UF_CRM_1743357179, UF_CRM_1723542556619 и CONTACT_ID.
+    Возвращает список сделок со всеми стандартными и пользовательскими полями.
+    Если зеркало сделок актуально и содержит сделки с этим трек-номером, они берутся из него без запроса к Bitrix.
+    Пустой результат зеркала не считается окончательным: в нём нет воронок вне SYNC_CATEGORIES и сделок,
+    созданных после последнего цикла синхронизации, поэтому проверка наличия выполняется в Bitrix.
     """
+    deals = await find_mirrored_deals_by_track(track_number)
+    if deals:
+        return deals
+
     url = webhook_url + 'crm.deal.list'
 
     params_deal = {
         'filter': {
             'UF_CRM_1723542556619': track_number
         },
-        'select': ['*']
+        'select': ['*', 'UF_*']  # Пользовательские поля нужны, чтобы ответ можно было положить в кэш сделок
     }
 
-    response = requests.post(url, json={'filter': params_deal['filter'], 'select': params_deal['select']})
+    response = await get_bitrix_client().post(url, json={'filter': params_deal['filter'], 'select': params_deal['select']})
 
     if response.status_code == 200:
         deals = response.json().get('result', [])
@@ -57,7 +66,7 @@ def get_deals_by_track(track_number):
         return []
 
 
-def get_deals_by_track_ident(track_number):
+async def get_deals_by_track_ident(track_number):
     """
     Получает список сделок по значению пользовательского поля UF_CRM_1723542556619.
     Возвращает список сделок, у которых трек-номер полностью совпадает с указанным значением.
@@ -71,7 +80,7 @@ def get_deals_by_track_ident(track_number):
         'select': ['ID', 'STAGE_ID', 'UF_CRM_1743357179', 'UF_CRM_1723542556619', 'CONTACT_ID']  # Выбираем только нужные поля
     }
 
-    response = requests.post(url, json={'filter': params_deal['filter'], 'select': params_deal['select']})
+    response = await get_bitrix_client().post(url, json={'filter': params_deal['filter'], 'select': params_deal['select']})
 
     if response.status_code == 200:
         deals = response.json().get('result', [])
@@ -94,7 +103,7 @@ async def get_deal_info(deal_id):
         'id': deal_id
     }
 
-    response = requests.get(url, params=params)
+    response = await get_bitrix_client().get(url, params=params)
 
     if response.status_code == 200:
         deal_info = response.json().get('result', {})
@@ -105,7 +114,7 @@ async def get_deal_info(deal_id):
         return None
 
 
-def get_contact_info(contact_id):
+async def get_contact_info(contact_id):
     """
     Получает информацию о контакте по его ID.
     Возвращает словарь с полями ID, NAME, LAST_NAME, PHONE, ADDRESS_CITY.
@@ -116,7 +125,7 @@ def get_contact_info(contact_id):
         'id': contact_id
     }
 
-    response = requests.get(url, params=params_contact)
+    response = await get_bitrix_client().get(url, params=params_contact)
 
     if response.status_code == 200:
         contact = response.json().get('result', {})
@@ -126,7 +135,7 @@ def get_contact_info(contact_id):
         return None
 
 
-def get_contact_id_by_phone(phone):
+async def get_contact_id_by_phone(phone):
     """
     Использует API Bitrix24 для поиска CONTACT_ID по номеру телефона.
     """
@@ -136,7 +145,7 @@ def get_contact_id_by_phone(phone):
         'select': ['ID']
     }
 
-    response = requests.post(url, json=params)
+    response = await get_bitrix_client().post(url, json=params)
 
     if response.status_code == 200:
         result = response.json().get('result', [])
@@ -149,7 +158,7 @@ def get_contact_id_by_phone(phone):
     return None
 
 
-def get_deals_by_contact_id(contact_id):
+async def get_deals_by_contact_id(contact_id):
     """
     Использует API Bitrix24 для получения списка сделок по CONTACT_ID.
     """
@@ -159,7 +168,7 @@ def get_deals_by_contact_id(contact_id):
         'select': ['ID', 'UF_CRM_1723542556619']  # ID и поле с трек-номером
     }
 
-    response = requests.post(url, json=params)
+    response = await get_bitrix_client().post(url, json=params)
 
     if response.status_code == 200:
         logging.info(response)
@@ -171,7 +180,7 @@ def get_deals_by_contact_id(contact_id):
     return []
 
 
-def get_latest_deal_info(contact_id):
+async def get_latest_deal_info(contact_id):
     """
     Получает последнюю сделку для указанного CONTACT_ID из Bitrix24.
     """
@@ -182,7 +191,7 @@ def get_latest_deal_info(contact_id):
         'select': ['ID', 'TITLE', 'UF_CRM_1723542922949', 'NAME', 'DATE_CREATE']
     }
 
-    response = requests.post(url, json=params)
+    response = await get_bitrix_client().post(url, json=params)
 
     if response.status_code == 200:
         result = response.json().get('result', [])
@@ -196,7 +205,7 @@ def get_latest_deal_info(contact_id):
     return None
 
 
-def get_active_deals_by_contact(contact_id):
+async def get_active_deals_by_contact(contact_id):
     """
     Возвращает список активных сделок для контакта, находящихся на этапах 'Прибыл в Пункт выдачи'.
     """
@@ -211,7 +220,7 @@ def get_active_deals_by_contact(contact_id):
         'select': ['ID', 'TITLE', 'STAGE_ID', 'UF_CRM_1723542556619']  # Добавляем поле трек-номера
     }
 
-    response = requests.post(url, json=params)
+    response = await get_bitrix_client().post(url, json=params)
     if response.status_code == 200:
         deals = response.json().get('result')
         if deals:
@@ -225,7 +234,13 @@ def get_active_deals_by_contact(contact_id):
         return None
 
 
-def find_deal_by_track_number(track_number, current_deal_id=None):
+async def find_deal_by_track_number(track_number, current_deal_id=None):
+    # Если в зеркале подходящей сделки нет, проверяем в Bitrix (см. get_deals_by_track)
+    deals = await find_mirrored_deals_by_track(track_number)
+    filtered_deals = [deal for deal in deals or [] if deal['ID'] != current_deal_id]
+    if filtered_deals:
+        return filtered_deals[0]
+
     url = webhook_url + 'crm.deal.list'
 
     params = {
@@ -233,7 +248,7 @@ def find_deal_by_track_number(track_number, current_deal_id=None):
         'select': ['ID', 'TITLE', 'CONTACT_ID', 'STAGE_ID']
     }
 
-    response = requests.post(url, json=params)
+    response = await get_bitrix_client().post(url, json=params)
 
     if response.status_code == 200:
         deals = response.json().get('result', [])
@@ -254,11 +269,16 @@ def find_deal_by_track_number(track_number, current_deal_id=None):
         return None
 
 
-def get_final_deal_for_today(contact_id, pipeline_name):
+async def get_final_deal_for_today(contact_id, pipeline_name):
     today_date = datetime.now().strftime('%Y-%m-%d')
     issued_stage_id = stage_mapping.get(pipeline_name, {}).get('issued',
                                                                'WON')  # Получаем идентификатор этапа "Выдан" для указанной воронки
 
+    deals = await find_mirrored_deals_by_contact(contact_id, [issued_stage_id])
+    deals = [deal for deal in deals or [] if (deal.get('DATE_CREATE') or '').startswith(today_date)]
+    if deals:
+        return deals[0]
+
     url = f"{webhook_url}/crm.deal.list"
     params = {
         'filter': {
@@ -269,7 +289,7 @@ def get_final_deal_for_today(contact_id, pipeline_name):
         },
         'select': ['ID', 'UF_CRM_1727870320443', 'UF_CRM_1729104281', 'UF_CRM_1729115312']  # Поля итоговой сделки
     }
-    response = requests.post(url, json=params)
+    response = await get_bitrix_client().post(url, json=params)
     if response.status_code == 200:
         deals = response.json().get('result')
         if deals:
@@ -289,6 +309,11 @@ async def find_final_deal_for_contact(contact_id, exclude_deal_id=None):
     # Получаем список стадий 'awaiting_pickup' из stage_mapping
     awaiting_pickup_stages = [details['awaiting_pickup'] for details in stage_mapping.values()]
 
+    deals = await find_mirrored_deals_by_contact(contact_id, awaiting_pickup_stages, final_only=True)
+    deals = [deal for deal in deals or [] if deal['ID'] != exclude_deal_id]
+    if deals:
+        return deals[0]
+
     url = f"{webhook_url}/crm.deal.list"
     params = {
         'filter': {
@@ -299,19 +324,18 @@ async def find_final_deal_for_contact(contact_id, exclude_deal_id=None):
         'select': ['*']  # Запрашиваем все поля сделки
     }
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(url, json=params)
-        if response.status_code == 200:
-            deals = response.json().get('result')
-            for deal in deals:
-                if deal['ID'] != exclude_deal_id:
-                    logging.info(f"Найдена итоговая сделка для контакта {contact_id} с ID: {deal['ID']}")
-                    return deal  # Возвращаем итоговую сделку
-            logging.info(f"Итоговая сделка для контакта {contact_id} не найдена.")
-            return None
-        else:
-            logging.error(f"Ошибка при поиске итоговой сделки для контакта {contact_id}: {response.text}")
-            return None
+    response = await get_bitrix_client().post(url, json=params)
+    if response.status_code == 200:
+        deals = response.json().get('result')
+        for deal in deals:
+            if deal['ID'] != exclude_deal_id:
+                logging.info(f"Найдена итоговая сделка для контакта {contact_id} с ID: {deal['ID']}")
+                return deal  # Возвращаем итоговую сделку
+        logging.info(f"Итоговая сделка для контакта {contact_id} не найдена.")
+        return None
+    else:
+        logging.error(f"Ошибка при поиске итоговой сделки для контакта {contact_id}: {response.text}")
+        return None
 
 
 # Создание и обновление контактов
@@ -323,7 +347,7 @@ locations = {
 }
 
 
-def create_contact(name, personal_code, phone, city, pickup_point):
+async def create_contact(name, personal_code, phone, city, pickup_point):
     """
     Создает контакт с указанными данными и затем обновляет его пользовательское поле UF_CRM_1737381798322.
     Возвращает ID созданного контакта.
@@ -347,12 +371,12 @@ def create_contact(name, personal_code, phone, city, pickup_point):
         }
     }
 
-    response = requests.post(url_create, json=params_contact)
+    response = await get_bitrix_client().post(url_create, json=params_contact)
 
     if response.status_code == 200:
         contact_id = response.json().get('result')
         if contact_id:
-            update_contact_pickup(contact_id, pickup_point)  # Отдельный запрос на обновление пользовательского поля
+            await update_contact_pickup(contact_id, pickup_point)  # Отдельный запрос на обновление пользовательского поля
         return contact_id
     else:
         print(f"Ошибка при создании контакта: {response.status_code}")
@@ -360,14 +384,14 @@ def create_contact(name, personal_code, phone, city, pickup_point):
         return None
 
 
-def update_contact(contact_id, name=None, personal_code=None, phone=None, city=None, pickup_point=None):
+async def update_contact(contact_id, name=None, personal_code=None, phone=None, city=None, pickup_point=None):
     """
     Обновляет данные контакта в Битрикс по contact_id, а затем обновляет его пользовательское поле UF_CRM_1737381798322.
     """
     url_update = webhook_url + 'crm.contact.update'
 
     # Получаем текущие данные контакта
-    existing_contact_data = requests.get(webhook_url + f'crm.contact.get?id={contact_id}').json()
+    existing_contact_data = (await get_bitrix_client().get(webhook_url + f'crm.contact.get?id={contact_id}')).json()
 
     city_codes = {
         "astana": "44",
@@ -397,13 +421,13 @@ def update_contact(contact_id, name=None, personal_code=None, phone=None, city=N
     }
 
     # Отправляем запрос на обновление данных
-    response = requests.post(url_update, json=params_contact)
+    response = await get_bitrix_client().post(url_update, json=params_contact)
 
     if response.status_code == 200:
         result = response.json().get('result')
         if result:
             print(f"Контакт с ID {contact_id} успешно обновлен.")
-            update_contact_pickup(contact_id, pickup_point)  # Обновляем пользовательское поле отдельно
+            await update_contact_pickup(contact_id, pickup_point)  # Обновляем пользовательское поле отдельно
         else:
             print(f"Ошибка при обновлении контакта: {response.json().get('error_description')}")
     else:
@@ -411,7 +435,7 @@ def update_contact(contact_id, name=None, personal_code=None, phone=None, city=N
         print(f"Ответ сервера: {response.text}")
 
 
-def update_contact_pickup(contact_id, pickup_point):
+async def update_contact_pickup(contact_id, pickup_point):
     """
     Отдельно обновляет пользовательское поле UF_CRM_1737381798322 у контакта.
     """
@@ -426,7 +450,7 @@ def update_contact_pickup(contact_id, pickup_point):
         }
     }
 
-    response = requests.post(url_userfield_update, json=params_userfield)
+    response = await get_bitrix_client().post(url_userfield_update, json=params_userfield)
 
     if response.status_code == 200:
         print(f"Пользовательское поле UF_CRM_1737381798322 у контакта {contact_id} успешно обновлено.")
@@ -454,8 +478,7 @@ async def update_contact_fields_in_bitrix(contact_id, sum_weight, sum_amount, or
     }
 
     # Отправляем запрос на обновление данных контакта
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(url, json=params_contact)
+    response = await get_bitrix_client().post(url, json=params_contact)
 
     # Обработка ответа
     if response.status_code == 200:
@@ -469,7 +492,7 @@ async def update_contact_fields_in_bitrix(contact_id, sum_weight, sum_amount, or
         logging.error(f"Ответ сервера: {response.text}")
 
 
-def update_contact_code_in_bitrix(contact_id, new_code):
+async def update_contact_code_in_bitrix(contact_id, new_code):
     """
     Обновляет персональный код в Битриксе как `NAME` и как пользовательское поле.
     """
@@ -487,7 +510,7 @@ def update_contact_code_in_bitrix(contact_id, new_code):
 
     try:
         # Отправляем запрос на обновление данных
-        response = requests.post(url, json=params_contact)
+        response = await get_bitrix_client().post(url, json=params_contact)
 
         if response.status_code == 200:
             result = response.json().get('result')
@@ -500,14 +523,14 @@ def update_contact_code_in_bitrix(contact_id, new_code):
         else:
             logging.error(f"Ошибка при обновлении контакта в Битрикс: {response.status_code}")
             logging.error(f"Ответ сервера: {response.text}")
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Сетевая ошибка при обновлении контакта в Битрикс: {e}")
 
     return False
 
 
 # Создание и обновление сделок
-def create_deal(contact_id, personal_code, track_number, pickup_point, phone, chat_id):
+async def create_deal(contact_id, personal_code, track_number, pickup_point, phone, chat_id):
     """
     Создает сделку, связывая её с указанным контактом и добавляет выбранный пункт выдачи.
     Возвращает ID созданной сделки.
@@ -535,17 +558,17 @@ def create_deal(contact_id, personal_code, track_number, pickup_point, phone, ch
             }
         }
 
-        response = requests.post(url, json=params_deal)
+        response = await get_bitrix_client().post(url, json=params_deal)
         response.raise_for_status()  # бросить исключение при ошибке HTTP
 
         deal_id = response.json().get('result')
         return deal_id
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Ошибка при создании сделки: {e}")
         return None
 
 
-def update_deal_contact(deal_id, contact_id, personal_code, name_translit, chat_id, phone, city, pickup_point):
+async def update_deal_contact(deal_id, contact_id, personal_code, name_translit, chat_id, phone, city, pickup_point):
     """
     Обновляет контакт и дополнительные поля для существующей сделки в Битрикс.
     Возвращает результат обновления (True или False).
@@ -575,7 +598,7 @@ def update_deal_contact(deal_id, contact_id, personal_code, name_translit, chat_
         }
 
         # Выполняем запрос на обновление
-        response = requests.post(url, json=params_update)
+        response = await get_bitrix_client().post(url, json=params_update)
         response.raise_for_status()  # выбрасываем исключение при ошибке HTTP
 
         result = response.json().get('result')
@@ -586,16 +609,16 @@ def update_deal_contact(deal_id, contact_id, personal_code, name_translit, chat_
             logging.error(f"Не удалось обновить сделку {deal_id}. Ответ: {response.json()}")
             return False
 
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Ошибка при обновлении сделки {deal_id}: {e}")
         return False
 
 
-def update_tracked_deal_in_bitrix(old_track_number, new_track_number):
+async def update_tracked_deal_in_bitrix(old_track_number, new_track_number):
     """
     Обновляет трек-номер в сделке Bitrix.
     """
-    deals = get_deals_by_track(old_track_number)  # Получаем сделку по старому трек-номеру
+    deals = await get_deals_by_track(old_track_number)  # Получаем сделку по старому трек-номеру
 
     if not deals:
         logging.warning(f"❌ Сделка с трек-номером {old_track_number} не найдена в Bitrix!")
@@ -613,7 +636,7 @@ def update_tracked_deal_in_bitrix(old_track_number, new_track_number):
     }
 
     logging.info(f"📤 Отправка запроса в Bitrix для сделки {deal_id}: {params}")
-    response = requests.post(url, json=params)
+    response = await get_bitrix_client().post(url, json=params)
 
     if response.status_code == 200:
         result = response.json()
@@ -630,7 +653,7 @@ def update_tracked_deal_in_bitrix(old_track_number, new_track_number):
         return False
 
 
-def create_deal_with_stage(contact_id, track_number, personal_code, name_translit, pickup_point, chat_id, phone, pipeline_stage, category_id):
+async def create_deal_with_stage(contact_id, track_number, personal_code, name_translit, pickup_point, chat_id, phone, pipeline_stage, category_id):
     """
     Создает сделку для данного контакта на определенном этапе и с указанием категории.
     """
@@ -665,7 +688,7 @@ def create_deal_with_stage(contact_id, track_number, personal_code, name_transli
 
     try:
         # Отправляем запрос на создание сделки
-        response = requests.post(url, json=data)
+        response = await get_bitrix_client().post(url, json=data)
         response.raise_for_status()
 
         deal_id = response.json().get('result')
@@ -675,12 +698,12 @@ def create_deal_with_stage(contact_id, track_number, personal_code, name_transli
         else:
             logging.error(f"Не удалось создать сделку. Ответ сервера: {response.json()}")
             return None
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Ошибка при создании сделки: {e}")
         return None
 
 
-def update_deal_stage(deal_id, stage_id):
+async def update_deal_stage(deal_id, stage_id):
     url = f"{webhook_url}/crm.deal.update"
     data = {
         'id': deal_id,
@@ -688,7 +711,7 @@ def update_deal_stage(deal_id, stage_id):
             'STAGE_ID': stage_id
         }
     }
-    response = requests.post(url, json=data)
+    response = await get_bitrix_client().post(url, json=data)
     if response.status_code == 200:
         logging.info(f"Сделка с ID {deal_id} обновлена на этап {stage_id}.")
         return True
@@ -862,8 +885,7 @@ async def create_final_deal(contact_id, weight, amount, number_of_orders, track_
         }
     }
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(url, json=data)
+    response = await get_bitrix_client().post(url, json=data)
 
     if response.status_code == 200:
         deal_id = response.json().get('result')
@@ -880,19 +902,24 @@ async def create_final_deal(contact_id, weight, amount, number_of_orders, track_
 async def update_final_deal(deal_id, track_number):
     logging.info(f"Запуск обновления итоговой сделки {deal_id} с трек-номером {track_number}")
 
-    # Получаем информацию о сделке
-    deal_info = await get_deal_info(deal_id)
-
-    if not deal_info:
-        logging.error(f"Не удалось получить информацию о сделке {deal_id}")
-        return False
+    # Трек-номера итоговой сделки хранятся локально в final_deal_tracks
+    track_numbers = await get_final_deal_track_numbers(deal_id)
+    if track_numbers:
+        if track_number in track_numbers:
+            logging.info(f"Трек-номер {track_number} уже входит в итоговую сделку {deal_id}.")
+            return True
+        updated_track_numbers = ", ".join(track_numbers + [track_number])
+    else:
+        # Итоговой сделки нет в локальной базе: дополняем значение поля из Bitrix
+        deal_info = await get_deal_info(deal_id)
 
-    # Получаем текущие трек-номера
-    current_track_numbers = deal_info.get('UF_CRM_1729115312', '')
-    logging.info(f"Текущие трек-номера для сделки {deal_id}: {current_track_numbers}")
+        if not deal_info:
+            logging.error(f"Не удалось получить информацию о сделке {deal_id}")
+            return False
 
-    # Обновляем только трек-номера, объединяя с новыми
-    updated_track_numbers = f"{current_track_numbers}, {track_number}".strip(', ') if current_track_numbers else track_number
+        current_track_numbers = deal_info.get('UF_CRM_1729115312', '')
+        logging.info(f"Текущие трек-номера для сделки {deal_id}: {current_track_numbers}")
+        updated_track_numbers = f"{current_track_numbers}, {track_number}".strip(', ') if current_track_numbers else track_number
 
     # Данные для обновления
     url = f"{webhook_url}/crm.deal.update"
@@ -904,14 +931,15 @@ async def update_final_deal(deal_id, track_number):
     }
 
     # Выполняем асинхронный запрос
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(url, json=data)
-        if response.status_code == 200:
-            logging.info(f"Сделка {deal_id} успешно обновлена.")
-            return True
-        else:
-            logging.error(f"Ошибка обновления сделки {deal_id}: {response.status_code} - {response.text}")
-            return False
+    response = await get_bitrix_client().post(url, json=data)
+    if response.status_code == 200:
+        logging.info(f"Сделка {deal_id} успешно обновлена.")
+        if track_numbers:
+            await append_final_deal_track(deal_id, track_number)
+        return True
+    else:
+        logging.error(f"Ошибка обновления сделки {deal_id}: {response.status_code} - {response.text}")
+        return False
 
 
 # Архивация и удаление сделок
@@ -951,14 +979,14 @@ def detach_contact_from_deal(deal_id, contact_id):
     logging.info(f"Операция для отвязывания контакта {contact_id} от сделки {deal_id} добавлена в batch.")
 
 
-def delete_deal(deal_id):
+async def delete_deal(deal_id):
     url = webhook_url + 'crm.deal.delete'
 
     params = {
         'id': deal_id  # Важно передавать правильный параметр 'id' для удаления
     }
 
-    response = requests.post(url, json=params)
+    response = await get_bitrix_client().post(url, json=params)
 
     if response.status_code == 200:
         result = response.json().get('result')
@@ -1021,11 +1049,10 @@ async def send_batch_request(batch_requests):
     payload = {"cmd": batch_requests}
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=payload)
-            response.raise_for_status()  # Проверка на статус ответа
-            response_data = response.json()
-            return response_data.get("result", {}).get("result", {})
+        response = await get_bitrix_client().post(url, json=payload)
+        response.raise_for_status()  # Проверка на статус ответа
+        response_data = response.json()
+        return response_data.get("result", {}).get("result", {})
     except httpx.HTTPStatusError as http_err:
         logging.error(f"HTTP ошибка: {http_err}")
     except Exception as e:
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import time
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest, TelegramAPIError
+from rate_limiter import TokenBucket
+from db_async import get_broadcast, get_broadcast_recipients, save_broadcast_results, update_broadcast, \
+    get_unfinished_broadcast_ids
+
+
+# ========== Настройки рассылки ==========
+# Telegram допускает около 30 сообщений в секунду от бота суммарно и не больше одного сообщения
+# в секунду в один чат. Оставляем запас, чтобы служебные ответы бота не упирались в лимит во время рассылки.
+MESSAGES_PER_SECOND = 25
+MESSAGES_BURST = 25
+PER_CHAT_INTERVAL = 1.0      # Минимальный интервал между запросами в один чат (с)
+BROADCAST_WORKERS = 20       # Количество одновременных запросов к Telegram
+MAX_ATTEMPTS = 3             # Попыток на получателя (RetryAfter не считается попыткой)
+RESULTS_FLUSH_SIZE = 100     # Результаты доставки пишутся в базу пакетами
+PROGRESS_INTERVAL = 5.0      # Как часто обновлять сообщение о ходе рассылки (с)
+
+telegram_bucket = TokenBucket(MESSAGES_PER_SECOND, MESSAGES_BURST)
+
+# Рассылки, выполняющиеся сейчас: broadcast_id -> задача
+_running = {}
+
+# Момент (time.monotonic), до которого все запросы приостановлены после ответа RetryAfter
+_paused_until = 0.0
+
+# Ошибки, после которых сообщение считается уже удалённым или неизменённым — повторять не нужно
+_ALREADY_DONE_ERRORS = ("message is not modified", "message to delete not found")
+
+
+async def _wait_for_pause():
+    while True:
+        delay = _paused_until - time.monotonic()
+        if delay <= 0:
+            return
+        await asyncio.sleep(delay)
+
+
+def _pause(seconds):
+    """
+    Приостанавливает все запросы рассылки: RetryAfter относится ко всему боту, а не к одному чату.
+    """
+    global _paused_until
+    _paused_until = max(_paused_until, time.monotonic() + seconds)
+    logging.warning(f"Telegram ограничил частоту запросов. Рассылка приостановлена на {seconds} с.")
+
+
+async def _perform(bot, action, chat_id, message_id, text):
+    if action == "send":
+        sent_message = await bot.send_message(chat_id=chat_id, text=text)
+        return sent_message.message_id
+    if action == "edit":
+        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+        return message_id
+    await bot.delete_message(chat_id=chat_id, message_id=message_id)
+    return message_id
+
+
+async def _deliver(bot, action, chat_id, message_id, text, last_sent_at):
+    """
+    Выполняет действие для одного получателя с учётом лимитов Telegram.
+    Возвращает кортеж (status, message_id, error) для save_broadcast_results.
+    """
+    ok_status = "deleted" if action == "delete" else "sent"
+    # Неудачное редактирование или удаление не отменяет факт доставки исходного сообщения
+    failed_status = "failed" if action == "send" else "sent"
+
+    attempt = 0
+    while True:
+        await _wait_for_pause()
+        wait = last_sent_at.get(chat_id, 0.0) + PER_CHAT_INTERVAL - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await telegram_bucket.acquire()
+        last_sent_at[chat_id] = time.monotonic()
+
+        try:
+            return ok_status, await _perform(bot, action, chat_id, message_id, text), None
+        except TelegramRetryAfter as e:
+            _pause(e.retry_after)
+        except TelegramForbiddenError as e:
+            # Пользователь заблокировал бота — повторять бессмысленно
+            return failed_status, message_id, str(e)
+        except TelegramBadRequest as e:
+            if any(reason in str(e) for reason in _ALREADY_DONE_ERRORS):
+                return ok_status, message_id, None
+            return failed_status, message_id, str(e)
+        except (TelegramAPIError, asyncio.TimeoutError) as e:
+            attempt += 1
+            if attempt >= MAX_ATTEMPTS:
+                return failed_status, message_id, str(e)
+            logging.warning(f"Ошибка рассылки для {chat_id} (попытка {attempt}): {e}")
+            await asyncio.sleep(attempt)
+
+
+async def run_broadcast(bot, broadcast_id, action, text=None, progress=None):
+    """
+    Выполняет действие рассылки для всех получателей кампании broadcast_id:
+    - "send" — отправляет сообщение получателям со статусом pending (продолжение прерванной рассылки);
+    - "edit" — заменяет текст доставленных сообщений на text;
+    - "delete" — удаляет доставленные сообщения.
+    progress — необязательная корутина progress(done, total, failed) для отчёта о ходе рассылки.
+    Возвращает кортеж (done, failed).
+    """
+    broadcast = await get_broadcast(broadcast_id)
+    if not broadcast:
+        logging.error(f"Рассылка {broadcast_id} не найдена.")
+        return 0, 0
+
+    text = text if text is not None else broadcast["text"]
+    recipients = await get_broadcast_recipients(broadcast_id, "pending" if action == "send" else "sent")
+    total = len(recipients)
+    logging.info(f"Рассылка {broadcast_id} ({action}): {total} получателей.")
+
+    queue = asyncio.Queue()
+    for recipient in recipients:
+        queue.put_nowait(recipient)
+
+    results = []
+    last_sent_at = {}
+    counters = {"done": 0, "failed": 0}
+    last_report = time.monotonic()
+
+    async def flush():
+        nonlocal results
+        pending, results = results, []
+        await save_broadcast_results(broadcast_id, pending)
+
+    async def report(force=False):
+        nonlocal last_report
+        if progress and (force or time.monotonic() - last_report >= PROGRESS_INTERVAL):
+            last_report = time.monotonic()
+            try:
+                await progress(counters["done"], total, counters["failed"])
+            except Exception as e:
+                logging.warning(f"Не удалось обновить ход рассылки {broadcast_id}: {e}")
+
+    async def worker():
+        while True:
+            try:
+                chat_id, message_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            status, new_message_id, error = await _deliver(bot, action, chat_id, message_id, text, last_sent_at)
+            results.append((chat_id, status, new_message_id, error))
+            counters["done"] += 1
+            if error:
+                counters["failed"] += 1
+                logging.error(f"Рассылка {broadcast_id}: не удалось выполнить {action} для {chat_id}: {error}")
+            if len(results) >= RESULTS_FLUSH_SIZE:
+                await flush()
+            await report()
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(BROADCAST_WORKERS, total))))
+    finally:
+        # Результаты сохраняются и при отмене задачи, чтобы продолжение не отправило сообщение повторно
+        await flush()
+
+    if action == "send":
+        await update_broadcast(broadcast_id, status="done")
+    elif action == "edit":
+        await update_broadcast(broadcast_id, text=text)
+    else:
+        await update_broadcast(broadcast_id, status="deleted")
+
+    await report(force=True)
+    logging.info(f"Рассылка {broadcast_id} ({action}) завершена: {counters['done']} из {total}, ошибок {counters['failed']}.")
+    return counters["done"], counters["failed"]
+
+
+def is_broadcast_running(broadcast_id):
+    task = _running.get(broadcast_id)
+    return task is not None and not task.done()
+
+
+def start_broadcast(bot, broadcast_id, action, text=None, progress=None):
+    """
+    Запускает run_broadcast фоновой задачей, чтобы обработчик команды администратора не ждал окончания рассылки.
+    Возвращает None, если по этой рассылке уже выполняется другое действие.
+    """
+    if is_broadcast_running(broadcast_id):
+        return None
+    task = asyncio.create_task(run_broadcast(bot, broadcast_id, action, text=text, progress=progress))
+    _running[broadcast_id] = task
+    task.add_done_callback(lambda _: _running.pop(broadcast_id, None))
+    return task
+
+
+async def resume_unfinished_broadcasts(bot):
+    """
+    Продолжает рассылки, прерванные перезапуском бота. Получатели, которым сообщение уже доставлено, пропускаются.
+    """
+    for broadcast_id in await get_unfinished_broadcast_ids():
+        logging.info(f"Продолжение прерванной рассылки {broadcast_id}.")
+        start_broadcast(bot, broadcast_id, "send")
@@ -9,6 +9,8 @@ proxy_bot_token = os.getenv("PROXY_BOT_TOKEN")
 webhook_url = os.getenv("WEBHOOK_URL")
 bitrix = BitrixAsync(webhook_url)
 DATABASE_PATH = os.getenv("DATABASE_PATH", "/data/clients.db")
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(DATABASE_PATH), "archive"))
+REDIS_URL = os.getenv("REDIS_URL")  # Если задан, состояние FSM хранится в Redis вместо SQLite
 
 
 CELERY_ACCEPT_CONTENT = ['json']
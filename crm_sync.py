@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+import httpx
+from config import webhook_url
+from bitrix_client import get_bitrix_client
+from rate_limiter import TokenBucket, backoff_delay
+from db_async import save_crm_records, get_crm_sync_state, save_crm_sync_run, \
+    get_mirrored_deals_by_track, get_mirrored_deals_by_tracks, get_mirrored_deals_by_contact
+
+
+# ========== Настройки синхронизации ==========
+SYNC_CATEGORIES = [8, 2, 4, 6]    # Воронки, сделки которых хранятся в зеркале
+PAGE_SIZE = 50                    # crm.*.list возвращает не больше 50 записей за запрос
+MAX_PAGES_PER_CYCLE = 200         # Первичная загрузка растягивается на несколько циклов
+MAX_RETRIES = 5
+SYNC_OVERLAP = 300                # Насколько раньше начала прохода начинается следующий (с), на случай расхождения часов
+SYNC_START_DELAY = 30             # Первый цикл через 30 секунд после старта бота
+SYNC_INTERVAL = 60                # Пауза между циклами (с)
+MIRROR_MAX_LAG = 180              # Зеркало используется для поиска, только если отстаёт от Bitrix не больше (с)
+
+# Поля, которые бот читает из сделок и контактов: обработчики вебхуков (process_functions, batch_context)
+# и потребители зеркала и кэша сделок (handlers, bitrix_integration). Запросы выбирают только их.
+DEAL_FIELDS = [
+    "ID", "CATEGORY_ID", "STAGE_ID", "CONTACT_ID", "OPPORTUNITY", "DATE_CREATE", "DATE_MODIFY",
+    "UF_CRM_1723542556619",  # Трек-номер
+    "UF_CRM_1743357179",     # Дата перехода на этап
+    "UF_CRM_1727870320443",  # Вес
+    "UF_CRM_1729539412",     # Признак итоговой сделки
+    "UF_CRM_1729104281",     # Поле итоговой сделки (get_final_deal_for_today)
+    "UF_CRM_1729115312",     # Трек-номера итоговой сделки
+    "UF_CRM_1730185262",     # Количество заказов
+]
+CONTACT_FIELDS = [
+    "ID", "NAME", "PHONE", "DATE_MODIFY",
+    "UF_CRM_1726123664764",  # Персональный код
+    "UF_CRM_1730093824027",  # Имя латиницей
+    "UF_CRM_1726207792191",  # Вес к выдаче
+    "UF_CRM_1726207809637",  # Сумма к оплате
+    "UF_CRM_1730182877",     # Количество заказов
+]
+
+# Синхронизация — фоновая задача, поэтому у неё отдельный и более медленный ограничитель,
+# чтобы она не забирала лимит запросов у пакетной обработки вебхуков
+sync_bucket = TokenBucket(rate=0.5, capacity=2)
+
+SYNC_ENTITIES = {
+    "deal": {
+        "method": "crm.deal.list",
+        "filter": {"CATEGORY_ID": SYNC_CATEGORIES},
+        "select": DEAL_FIELDS,
+    },
+    "contact": {
+        "method": "crm.contact.list",
+        "filter": {},
+        "select": CONTACT_FIELDS,
+    },
+}
+
+
+# ========== Загрузка из Bitrix ==========
+
+def _format_watermark(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec="seconds")
+
+
+async def fetch_page(entity, watermark, last_id):
+    """
+    Запрашивает следующую страницу записей, изменённых не раньше watermark, с ID больше last_id.
+    Страницы выбираются по ID (keyset), а не смещением, и без подсчёта общего количества (start=-1),
+    поэтому стоимость запроса не растёт с размером выборки.
+    """
+    config = SYNC_ENTITIES[entity]
+    filters = dict(config["filter"], **{">ID": last_id})
+    if watermark:
+        filters[">=DATE_MODIFY"] = watermark
+    payload = {"filter": filters, "order": {"ID": "ASC"}, "select": config["select"], "start": -1}
+
+    for attempt in range(MAX_RETRIES):
+        await sync_bucket.acquire()
+        try:
+            response = await get_bitrix_client().post(webhook_url + config["method"], json=payload)
+            body = response.json()
+            if response.status_code == 200 and "error" not in body:
+                sync_bucket.recover()
+                return body.get("result", [])
+            error = body.get("error", response.status_code)
+        except (httpx.HTTPError, ValueError) as e:
+            error = e
+        if "QUERY_LIMIT_EXCEEDED" in str(error):
+            sync_bucket.slow_down()
+        delay = backoff_delay(attempt)
+        logging.warning(f"Синхронизация CRM: ошибка {config['method']} ({error}). Повтор через {delay:.1f} с.")
+        await asyncio.sleep(delay)
+    raise RuntimeError(f"{config['method']} не выполнен после {MAX_RETRIES} попыток")
+
+
+async def sync_entity(entity, max_pages=MAX_PAGES_PER_CYCLE):
+    """
+    Один цикл синхронизации зеркала сделок или контактов.
+
+    Проход выбирает все записи с DATE_MODIFY не раньше водяного знака, страницами по возрастанию ID.
+    Каждая страница записывается одной транзакцией вместе с позицией прохода. Когда проход завершён,
+    водяным знаком следующего становится время начала текущего (с запасом SYNC_OVERLAP),
+    а зеркало считается актуальным на это время. Результат цикла записывается в crm_sync_runs.
+    Возвращает количество записанных строк.
+    """
+    started_at = time.time()
+    state = await get_crm_sync_state(entity) or {"watermark": None, "pass_started_at": None, "last_id": 0,
+                                                 "synced_at": None}
+    if state["pass_started_at"] is None:
+        state = dict(state, pass_started_at=started_at, last_id=0)
+
+    pages = rows = 0
+    error = None
+    try:
+        while pages < max_pages:
+            records = await fetch_page(entity, state["watermark"], state["last_id"])
+            pages += 1
+            new_state = dict(state)
+            if records:
+                new_state["last_id"] = max(int(record["ID"]) for record in records)
+            finished = len(records) < PAGE_SIZE
+            if finished:
+                new_state.update(watermark=_format_watermark(state["pass_started_at"] - SYNC_OVERLAP),
+                                 synced_at=state["pass_started_at"], pass_started_at=None, last_id=0)
+            count = await save_crm_records(entity, records, new_state)
+            if count is None:
+                raise RuntimeError("не удалось записать страницу в базу")
+            state = new_state
+            rows += count
+            if finished:
+                break
+    except Exception as e:
+        error = str(e)
+        logging.error(f"Ошибка синхронизации зеркала CRM ({entity}): {e}")
+
+    finished_at = time.time()
+    lag = finished_at - state["synced_at"] if state["synced_at"] else None
+    await save_crm_sync_run(entity, started_at, finished_at, pages, rows, state["watermark"], lag, error)
+    logging.info(f"Синхронизация CRM ({entity}): {rows} записей, {pages} страниц за {finished_at - started_at:.1f} с, "
+                 f"отставание {f'{lag:.0f} с' if lag is not None else 'не определено (первичная загрузка)'}.")
+    return rows
+
+
+async def crm_sync_loop():
+    """
+    Периодически синхронизирует зеркало сделок и контактов. Запускается вместе с ботом и сервером.
+    """
+    await asyncio.sleep(SYNC_START_DELAY)
+    while True:
+        for entity in SYNC_ENTITIES:
+            try:
+                await sync_entity(entity)
+            except Exception as e:
+                logging.error(f"Ошибка в цикле синхронизации CRM ({entity}): {e}")
+        await asyncio.sleep(SYNC_INTERVAL)
+
+
+# ========== Обновление зеркала вне цикла ==========
+
+async def mirror_records(entity, records):
+    """
+    Записывает в зеркало сделки или контакты, уже полученные из Bitrix (например, при обработке вебхуков),
+    чтобы изменения были видны до следующего цикла синхронизации.
+    """
+    if entity == "deal":
+        categories = {str(category_id) for category_id in SYNC_CATEGORIES}
+        records = [record for record in records
+                   if isinstance(record, dict) and str(record.get("CATEGORY_ID")) in categories]
+    if records:
+        await save_crm_records(entity, records)
+
+
+# ========== Чтение из зеркала ==========
+# Функции возвращают None, если зеркало отстаёт больше чем на MIRROR_MAX_LAG, — тогда поиск выполняется в Bitrix.
+# Пустой результат не доказывает, что сделки нет: зеркало хранит только SYNC_CATEGORIES и не видит сделок,
+# созданных после последнего цикла, поэтому проверки наличия при пустом результате обращаются к Bitrix.
+
+async def mirror_is_fresh(entity="deal"):
+    state = await get_crm_sync_state(entity)
+    return bool(state and state["synced_at"] and time.time() - state["synced_at"] <= MIRROR_MAX_LAG)
+
+
+async def find_mirrored_deals_by_track(track_number):
+    if not await mirror_is_fresh():
+        return None
+    return await get_mirrored_deals_by_track(track_number)
+
+
+async def find_mirrored_deals_by_tracks(track_numbers):
+    if not await mirror_is_fresh():
+        return None
+    return await get_mirrored_deals_by_tracks(track_numbers)
+
+
+async def find_mirrored_deals_by_contact(contact_id, stage_ids, final_only=False):
+    if not await mirror_is_fresh():
+        return None
+    return await get_mirrored_deals_by_contact(contact_id, stage_ids, final_only)
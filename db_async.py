@@ -0,0 +1,171 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import db_management
+from lookup_cache import client_cache, track_cache, cached, invalidates
+
+
+# Все запросы к базе данных выполняются в одном выделенном потоке.
+# Исполнитель хранит очередь заданий, поэтому запросы обрабатываются строго по порядку,
+# а цикл событий (polling Telegram и FastAPI) не блокируется на записи и ожидании блокировок.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+
+async def run_in_db(func, *args, **kwargs):
+    """
+    Выполняет синхронную функцию работы с базой в потоке базы данных и возвращает её результат.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def shutdown_db_executor():
+    """
+    Дожидается выполнения поставленных в очередь запросов и останавливает поток базы данных.
+    """
+    _executor.shutdown(wait=True)
+    logging.info("Поток базы данных остановлен.")
+
+
+def _async(func):
+    """
+    Создаёт асинхронный вариант функции из db_management с тем же именем и сигнатурой.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_in_db(func, *args, **kwargs)
+    return wrapper
+
+
+# Клиенты и персональные коды
+# Частые выборки клиентов и трек-номеров читаются через кэш в памяти (lookup_cache),
+# функции записи сбрасывают затронутые записи кэша.
+generate_unique_code = _async(db_management.generate_unique_code)
+is_vip_code_available = _async(db_management.is_vip_code_available)
+is_code_used_by_another_client = _async(db_management.is_code_used_by_another_client)
+update_personal_code = invalidates(client_cache, _async(db_management.update_personal_code))
+remove_vip_code = _async(db_management.remove_vip_code)
+save_client_data = invalidates(client_cache, _async(db_management.save_client_data))
+update_client_data = invalidates(client_cache, _async(db_management.update_client_data))
+get_all_clients = _async(db_management.get_all_clients)
+get_client_by_chat_id = cached(client_cache, _async(db_management.get_client_by_chat_id))
+get_client_by_contact_id = cached(client_cache, _async(db_management.get_client_by_contact_id))
+get_chat_id_by_phone = cached(client_cache, _async(db_management.get_chat_id_by_phone))
+check_chat_id_exists = cached(client_cache, _async(db_management.check_chat_id_exists))
+get_all_chat_ids = _async(db_management.get_all_chat_ids)
+get_personal_code_by_chat_id = cached(client_cache, _async(db_management.get_personal_code_by_chat_id))
+get_chat_id_by_personal_code = cached(client_cache, _async(db_management.get_chat_id_by_personal_code))
+get_contact_id_by_code = cached(client_cache, _async(db_management.get_contact_id_by_code))
+get_chat_id_by_contact_id = cached(client_cache, _async(db_management.get_chat_id_by_contact_id))
+delete_client_from_db = invalidates(client_cache, _async(db_management.delete_client_from_db))
+
+# Трек-номера и отслеживаемые сделки
+get_name_track_by_track_number = cached(track_cache, _async(db_management.get_name_track_by_track_number))
+update_name_track_by_track_number = invalidates(track_cache, _async(db_management.update_name_track_by_track_number),
+                                                ['track_number'])
+save_track_number = invalidates(track_cache, _async(db_management.save_track_number), ['track_number'])
+update_track_number = invalidates(track_cache, _async(db_management.update_track_number), ['track_number'])
+update_track_number_in_all_tables = invalidates(track_cache, _async(db_management.update_track_number_in_all_tables),
+                                                ['old_track_number', 'new_track_number'])
+get_track_data_by_track_number = cached(track_cache, _async(db_management.get_track_data_by_track_number))
+get_track_numbers_by_chat_id = _async(db_management.get_track_numbers_by_chat_id)
+get_track_from_db = cached(track_cache, _async(db_management.get_track_from_db))
+get_all_track_numbers = _async(db_management.get_all_track_numbers)
+save_deal_to_db = _async(db_management.save_deal_to_db)
+update_tracked_deal = _async(db_management.update_tracked_deal)
+find_deal_by_track = _async(db_management.find_deal_by_track)
+delete_deal_by_track_number = invalidates(track_cache, _async(db_management.delete_deal_by_track_number),
+                                          ['track_number'])
+
+# Вебхуки и результаты обработки
+save_webhook_to_db = _async(db_management.save_webhook_to_db)
+get_latest_webhook_timestamp = _async(db_management.get_latest_webhook_timestamp)
+mark_webhook_as_processed = _async(db_management.mark_webhook_as_processed)
+claim_webhooks = _async(db_management.claim_webhooks)
+release_webhooks = _async(db_management.release_webhooks)
+save_processed_result = _async(db_management.save_processed_result)
+get_unprocessed_results = _async(db_management.get_unprocessed_results)
+mark_results_as_processed = _async(db_management.mark_results_as_processed)
+enqueue_operations = _async(db_management.enqueue_operations)
+claim_outbox = _async(db_management.claim_outbox)
+complete_outbox = _async(db_management.complete_outbox)
+get_outbox_stats = _async(db_management.get_outbox_stats)
+get_dead_letters = _async(db_management.get_dead_letters)
+retry_dead_letters = _async(db_management.retry_dead_letters)
+
+# Итоговые сделки
+get_final_deal_from_db = _async(db_management.get_final_deal_from_db)
+save_final_deal_to_db = _async(db_management.save_final_deal_to_db)
+append_final_deal_track = _async(db_management.append_final_deal_track)
+get_final_deal_track_numbers = _async(db_management.get_final_deal_track_numbers)
+find_final_deal_by_track = _async(db_management.find_final_deal_by_track)
+update_final_deal_id = _async(db_management.update_final_deal_id)
+get_all_final_deals_by_contact_id = _async(db_management.get_all_final_deals_by_contact_id)
+delete_final_deal_from_db = _async(db_management.delete_final_deal_from_db)
+
+# Задачи, рассылки и история сделок
+save_task_to_db = _async(db_management.save_task_to_db)
+get_task_id_by_deal_id = _async(db_management.get_task_id_by_deal_id)
+delete_task_from_db = _async(db_management.delete_task_from_db)
+get_last_broadcast_messages = _async(db_management.get_last_broadcast_messages)
+create_broadcast = _async(db_management.create_broadcast)
+get_broadcast = _async(db_management.get_broadcast)
+get_last_broadcast_id = _async(db_management.get_last_broadcast_id)
+get_unfinished_broadcast_ids = _async(db_management.get_unfinished_broadcast_ids)
+update_broadcast = _async(db_management.update_broadcast)
+get_broadcast_recipients = _async(db_management.get_broadcast_recipients)
+save_broadcast_results = _async(db_management.save_broadcast_results)
+save_deal_history = _async(db_management.save_deal_history)
+get_original_date_by_track = _async(db_management.get_original_date_by_track)
+save_stage_transitions = _async(db_management.save_stage_transitions)
+get_stage_dwell_times = _async(db_management.get_stage_dwell_times)
+get_stage_dwell_percentiles = _async(db_management.get_stage_dwell_percentiles)
+
+# Пакетные выборки
+get_tracks_by_numbers = _async(db_management.get_tracks_by_numbers)
+get_clients_by_chat_ids = _async(db_management.get_clients_by_chat_ids)
+get_clients_by_contact_ids = _async(db_management.get_clients_by_contact_ids)
+find_deals_by_tracks = _async(db_management.find_deals_by_tracks)
+get_deal_history_for_tracks = _async(db_management.get_deal_history_for_tracks)
+get_final_deals_by_contact_ids = _async(db_management.get_final_deals_by_contact_ids)
+get_final_deal_tracks_by_ids = _async(db_management.get_final_deal_tracks_by_ids)
+get_task_ids_by_deal_ids = _async(db_management.get_task_ids_by_deal_ids)
+
+# Отложенные записи пакета вебхуков
+TRACK_WRITE_STATEMENTS = {"update_name_track", "delete_track"}  # Трек-номер — последний параметр записи
+
+
+async def apply_local_writes(writes):
+    """
+    Выполняет записи пакета одной транзакцией и сбрасывает из кэша затронутые трек-номера.
+    """
+    try:
+        return await run_in_db(db_management.apply_local_writes, writes)
+    finally:
+        track_numbers = [params[-1] for statement, params in writes if statement in TRACK_WRITE_STATEMENTS]
+        if track_numbers:
+            track_cache.invalidate(*track_numbers)
+
+# Кэш сделок Bitrix
+cache_deals = _async(db_management.cache_deals)
+cache_track_deals = _async(db_management.cache_track_deals)
+get_cached_deal = _async(db_management.get_cached_deal)
+get_cached_deals_by_track = _async(db_management.get_cached_deals_by_track)
+invalidate_cached_deal = _async(db_management.invalidate_cached_deal)
+invalidate_cached_track = _async(db_management.invalidate_cached_track)
+
+# Зеркало сделок и контактов Bitrix
+save_crm_records = _async(db_management.save_crm_records)
+get_crm_sync_state = _async(db_management.get_crm_sync_state)
+save_crm_sync_run = _async(db_management.save_crm_sync_run)
+delete_crm_record = _async(db_management.delete_crm_record)
+get_mirrored_deals_by_track = _async(db_management.get_mirrored_deals_by_track)
+get_mirrored_deals_by_tracks = _async(db_management.get_mirrored_deals_by_tracks)
+get_mirrored_deals_by_contact = _async(db_management.get_mirrored_deals_by_contact)
+
+# Хранилище состояний FSM
+get_fsm_record = _async(db_management.get_fsm_record)
+get_fsm_version = _async(db_management.get_fsm_version)
+set_fsm_state = _async(db_management.set_fsm_state)
+set_fsm_data = _async(db_management.set_fsm_data)
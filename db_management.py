@@ -1,14 +1,18 @@
 import sqlite3
-import random
 import logging
 import json
+import time
 from datetime import datetime
-from config import DATABASE_PATH
+from itertools import groupby
+from db_pool import get_connection, configure_database
+from db_migrations import run_migrations, check_query_plans, fill_code_pool, stage_pipeline
+from batch_planner import Operation
 
 
 # Инициализация и настройка базы данных
 def init_db():
-    conn = sqlite3.connect(DATABASE_PATH)  # путь к базе берётся из переменной
+    conn = get_connection()
+    configure_database(conn)  # WAL и постоянные настройки файла базы применяются один раз при старте
     cursor = conn.cursor()
 
     # Создаем таблицу clients, если её нет
@@ -109,7 +113,7 @@ def init_db():
             final_deal_id INTEGER NOT NULL,    -- ID итоговой сделки в Bitrix
             creation_date TEXT,                -- Дата создания итоговой сделки
             current_stage_id TEXT,             -- Текущий этап сделки
-            track_numbers TEXT,                -- Список трек-номеров, связанных с итоговой сделкой
+            track_numbers TEXT,                -- Устарело: трек-номера хранятся в final_deal_tracks
             total_weight REAL DEFAULT 0,       -- Общий вес заказов
             total_amount REAL DEFAULT 0,       -- Общая сумма оплаты
             number_of_orders INTEGER DEFAULT 0 -- Общее количество заказов
@@ -146,52 +150,95 @@ def init_db():
     """)
 
     conn.commit()
-    conn.close()
+
+    # Индексы и последующие изменения схемы применяются версионными миграциями
+    run_migrations(conn)
+    check_query_plans(conn, HOT_QUERIES)
 
 
 # Генерация и проверка уникальных кодов
-def generate_unique_code():
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+CODE_POOL_LOW_WATERMARK = 500  # Когда свободных кодов остаётся меньше, пул расширяется кодами на разряд длиннее
+
+
+def _release_code(cursor, code):
+    """
+    Возвращает код в пул свободных, если он не VIP и не занят другим клиентом.
+    """
+    if not code:
+        return
+    cursor.execute("""
+    INSERT OR IGNORE INTO free_codes (code, sort_key)
+    SELECT ?, random()
+    WHERE NOT EXISTS (SELECT 1 FROM vip_codes WHERE vip_code = ?)
+      AND NOT EXISTS (SELECT 1 FROM clients WHERE personal_code = ?)
+    """, (code, code, code))
 
-    while True:
-        # Генерация случайного 4-значного кода с ведущими нулями
-        personal_code = f"{random.randint(1, 9999):04d}"
 
-        # Проверяем, существует ли этот код в базе данных клиентов
-        cursor.execute('SELECT personal_code FROM clients WHERE personal_code = ?', (personal_code,))
-        result_clients = cursor.fetchone()
+def generate_unique_code():
+    """
+    Выдаёт свободный персональный код из пула free_codes.
 
-        # Проверяем, существует ли этот код в списке VIP-номеров
-        cursor.execute('SELECT vip_code FROM vip_codes WHERE vip_code = ?', (personal_code,))
-        result_vip = cursor.fetchone()
+    Код удаляется из пула в той же транзакции, в которой выбирается (BEGIN IMMEDIATE),
+    поэтому два одновременных запроса не получат один код. Выборка идёт по индексу sort_key.
+    Если в пуле осталось меньше CODE_POOL_LOW_WATERMARK кодов, он дополняется кодами на разряд длиннее.
+    Возвращает None, если выдать код не удалось.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
 
-        # Если код не найден ни в базе клиентов, ни в списке VIP, то он уникален и мы можем выйти из цикла
-        if not result_clients and not result_vip:
-            break
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+
+        cursor.execute("SELECT 1 FROM free_codes LIMIT 1 OFFSET ?", (CODE_POOL_LOW_WATERMARK,))
+        if cursor.fetchone() is None:
+            cursor.execute("SELECT digits FROM code_pool WHERE id = 1")
+            row = cursor.fetchone()
+            digits = (row[0] if row else 4) + 1
+            fill_code_pool(cursor, digits)
+            logging.warning(f"Пул персональных кодов расширен до {digits}-значных кодов.")
+
+        while True:
+            cursor.execute("""
+            DELETE FROM free_codes
+            WHERE code = (SELECT code FROM free_codes ORDER BY sort_key LIMIT 1)
+            RETURNING code
+            """)
+            row = cursor.fetchone()
+            if row is None:
+                conn.rollback()
+                logging.error("Пул свободных персональных кодов пуст.")
+                return None
+            personal_code = row[0]
+
+            # Код мог быть назначен вручную (/reappropriation) в обход пула
+            cursor.execute("SELECT 1 FROM clients WHERE personal_code = ?", (personal_code,))
+            if cursor.fetchone() is None:
+                break
 
-    conn.close()
-    return personal_code
+        conn.commit()
+        return personal_code
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при выдаче персонального кода: {e}")
+        return None
 
 
 def is_vip_code_available(code):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT vip_code FROM vip_codes WHERE vip_code = ?", (code,))
     result = cursor.fetchone()
-    conn.close()
     return result is not None
 
 
 def is_code_used_by_another_client(new_code):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute("""
         SELECT 1 FROM clients WHERE personal_code = ?
     """, (new_code,))
     result = cursor.fetchone()
-    conn.close()
 
     return result is not None
 
@@ -200,7 +247,7 @@ def update_personal_code(old_code, new_code):
     """
     Обновляет персональный код в таблицах `clients` и `tracked_deals`.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     try:
@@ -214,6 +261,9 @@ def update_personal_code(old_code, new_code):
 
         # Проверяем, были ли изменения в обеих таблицах
         if updated_clients or updated_tracked_deals:
+            # Новый код больше не свободен, старый возвращается в пул
+            cursor.execute("DELETE FROM free_codes WHERE code = ?", (new_code,))
+            _release_code(cursor, old_code)
             conn.commit()
             logging.info(f"Персональный код обновлен с {old_code} на {new_code} в таблицах.")
             return True
@@ -224,23 +274,20 @@ def update_personal_code(old_code, new_code):
         logging.error(f"Ошибка при обновлении персонального кода: {e}")
         conn.rollback()
         return False
-    finally:
-        conn.close()
 
 
 def remove_vip_code(code):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM vip_codes WHERE vip_code = ?", (code,))
     conn.commit()
-    conn.close()
 
 
 def get_name_track_by_track_number(track_number):
     """
     Получает name_track по track_number из таблицы track_numbers.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         cursor.execute("SELECT name_track FROM track_numbers WHERE track_number = ?", (track_number,))
@@ -249,15 +296,13 @@ def get_name_track_by_track_number(track_number):
     except Exception as e:
         logging.error(f"Ошибка при извлечении name_track для трек-номера {track_number}: {e}")
         return None
-    finally:
-        conn.close()
 
 
 def update_name_track_by_track_number(track_number, new_name):
     """
     Обновляет name_track для track_number в таблице track_numbers.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         logging.info(f"Попытка обновления name_track для {track_number} на '{new_name}'.")
@@ -276,13 +321,10 @@ def update_name_track_by_track_number(track_number, new_name):
     except Exception as e:
         logging.error(f"🔥 Ошибка при обновлении name_track для {track_number}: {e}")
 
-    finally:
-        conn.close()
-
 
 # Операции с данными клиентов
 def save_client_data(chat_id, contact_id, personal_code, name_cyrillic, name_translit, phone, city, pickup_point):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Вставка данных в таблицу
@@ -292,13 +334,12 @@ def save_client_data(chat_id, contact_id, personal_code, name_cyrillic, name_tra
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
     ''', (chat_id, contact_id, personal_code, name_cyrillic, name_translit, phone, city, pickup_point))
 
-    # Сохраняем изменения и закрываем соединение
+    # Сохраняем изменения
     conn.commit()
-    conn.close()
 
 
 def update_client_data(chat_id, contact_id, personal_code, name_cyrillic, name_translit, phone, city, pickup_point):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Обновляем данные в таблице, если chat_id уже существует
@@ -308,34 +349,29 @@ def update_client_data(chat_id, contact_id, personal_code, name_cyrillic, name_t
         WHERE chat_id = ?
     ''', (contact_id, personal_code, name_cyrillic, name_translit, phone, city, pickup_point, chat_id))
 
-    # Сохраняем изменения и закрываем соединение
+    # Сохраняем изменения
     conn.commit()
-    conn.close()
 
 
 def get_all_clients():
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Выполняем запрос на выборку всех данных из таблицы
     cursor.execute('SELECT * FROM clients')
     rows = cursor.fetchall()
 
-    # Закрываем соединение
-    conn.close()
-
     return rows
 
 
 def get_client_by_chat_id(chat_id):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute('SELECT contact_id, personal_code, name_cyrillic, name_translit, '
                    'phone, city, pickup_point FROM clients WHERE chat_id = ?',
                    (chat_id,))
     result = cursor.fetchone()
-    conn.close()
 
     if result:
         # Возвращаем данные в формате словаря
@@ -354,7 +390,7 @@ def get_client_by_chat_id(chat_id):
 
 
 def get_client_by_contact_id(contact_id):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute("SELECT * FROM clients WHERE contact_id = ?", (contact_id,))
@@ -373,57 +409,54 @@ def get_client_by_contact_id(contact_id):
     return None
 
 
+CHAT_ID_BY_PHONE_QUERY = "SELECT chat_id FROM clients WHERE phone = ?"
+
+
 def get_chat_id_by_phone(phone):
     """
     Проверяет, зарегистрирован ли пользователь с данным номером телефона.
     Возвращает chat_id, если пользователь найден.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT chat_id FROM clients WHERE phone = ?", (phone,))
+    cursor.execute(CHAT_ID_BY_PHONE_QUERY, (phone,))
     result = cursor.fetchone()
-    conn.close()
 
     return result[0] if result else None
 
 
 def check_chat_id_exists(chat_id):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Выполняем запрос на проверку наличия chat_id
     cursor.execute('SELECT 1 FROM clients WHERE chat_id = ?', (chat_id,))
     result = cursor.fetchone()
 
-    conn.close()
-
     # Возвращаем True, если запись найдена, иначе False
     return result is not None
 
 
 def get_all_chat_ids():
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Запрос на получение всех chat_id из таблицы clients
     cursor.execute('SELECT chat_id FROM clients')
     rows = cursor.fetchall()
 
-    conn.close()
-
     # Преобразуем список кортежей в простой список chat_id
     chat_ids = [row[0] for row in rows]
     return chat_ids
 
 
 def get_personal_code_by_chat_id(chat_id):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute('SELECT personal_code FROM clients WHERE chat_id = ?', (chat_id,))
     result = cursor.fetchone()
-    conn.close()
 
     if result:
         return result[0]  # Возвращаем personal_code
@@ -435,12 +468,11 @@ def get_chat_id_by_personal_code(personal_code):
     """
     Получает chat_id по указанному personal_code из таблицы clients.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute('SELECT chat_id FROM clients WHERE personal_code = ?', (personal_code,))
     result = cursor.fetchone()
-    conn.close()
 
     if result:
         return result[0]  # Возвращаем chat_id
@@ -449,30 +481,30 @@ def get_chat_id_by_personal_code(personal_code):
 
 
 def get_contact_id_by_code(code):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     logging.info(f"Проверка кода в базе данных: {code} (тип: {type(code)})")
     cursor.execute('SELECT contact_id FROM clients WHERE personal_code = ?', (code,))
     result = cursor.fetchone()
-    conn.close()
     if result:
         return result[0]
     return None
 
 
+CHAT_ID_BY_CONTACT_QUERY = "SELECT chat_id FROM clients WHERE contact_id = ?"
+
+
 def get_chat_id_by_contact_id(contact_id):
     """
     Получает chat_id из базы данных по contact_id.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Выполняем запрос для получения chat_id по contact_id
-    cursor.execute('SELECT chat_id FROM clients WHERE contact_id = ?', (contact_id,))
+    cursor.execute(CHAT_ID_BY_CONTACT_QUERY, (contact_id,))
     result = cursor.fetchone()
 
-    conn.close()
-
     if result:
         return result[0]  # Возвращаем chat_id
     return None
@@ -480,7 +512,7 @@ def get_chat_id_by_contact_id(contact_id):
 
 # Работа с трек-номерами
 def save_track_number(track_number, name_track, chat_id):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Вставка трек-номера и его названия в таблицу
@@ -490,11 +522,10 @@ def save_track_number(track_number, name_track, chat_id):
     ''', (track_number, name_track, chat_id))
 
     conn.commit()
-    conn.close()
 
 
 def update_track_number(track_number, name_track, chat_id):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     logging.info(f"Изменение названия для трек-номера {track_number} на {name_track} для пользователя {chat_id}")
     # Обновление названия трек-номера по track_number и chat_id
@@ -505,7 +536,6 @@ def update_track_number(track_number, name_track, chat_id):
     ''', (name_track, track_number, chat_id))
 
     conn.commit()
-    conn.close()
 
 
 def update_track_number_in_all_tables(old_track_number, new_track_number, chat_id):
@@ -515,7 +545,7 @@ def update_track_number_in_all_tables(old_track_number, new_track_number, chat_i
     :param new_track_number: Новый трек-номер, на который нужно заменить.
     :param chat_id: ID чата пользователя.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     logging.info(f"Обновление трек-номера {old_track_number} на {new_track_number} для пользователя {chat_id}")
 
@@ -541,19 +571,18 @@ def update_track_number_in_all_tables(old_track_number, new_track_number, chat_i
         logging.error(f"Ошибка при обновлении трек-номера {old_track_number} на {new_track_number}: {e}")
         conn.rollback()
         return False
-    finally:
-        conn.close()
+
+
+TRACK_BY_NUMBER_QUERY = "SELECT track_number, name_track, chat_id FROM track_numbers WHERE track_number = ?"
 
 
 def get_track_data_by_track_number(track_number):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Поиск трек-номера в таблице track_numbers
-    cursor.execute('SELECT track_number, name_track, chat_id FROM track_numbers WHERE track_number = ?',
-                   (track_number,))
+    cursor.execute(TRACK_BY_NUMBER_QUERY, (track_number,))
     result = cursor.fetchone()
-    conn.close()
 
     if result:
         logging.info(result)
@@ -568,15 +597,17 @@ def get_track_data_by_track_number(track_number):
         return None  # Если трек-номер не найден
 
 
+TRACKS_BY_CHAT_QUERY = "SELECT track_number, name_track FROM track_numbers WHERE chat_id = ?"
+
+
 def get_track_numbers_by_chat_id(chat_id):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Выбор всех трек-номеров для данного chat_id
-    cursor.execute('SELECT track_number, name_track FROM track_numbers WHERE chat_id = ?', (chat_id,))
+    cursor.execute(TRACKS_BY_CHAT_QUERY, (chat_id,))
     rows = cursor.fetchall()
     logging.info(rows)
-    conn.close()
 
     return rows
 
@@ -586,13 +617,12 @@ def get_track_from_db(track_number):
     Проверяет наличие трек-номера в базе данных.
     Возвращает True, если трек-номер существует, иначе False.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Поиск трек-номера в таблице track_numbers
     cursor.execute('SELECT 1 FROM track_numbers WHERE track_number = ?', (track_number,))
     result = cursor.fetchone()
-    conn.close()
 
     if result:
         logging.info(f"Трек-номер {track_number} найден в базе данных.")
@@ -603,7 +633,7 @@ def get_track_from_db(track_number):
 
 
 def get_all_track_numbers():
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Выбираем все данные из таблицы track_numbers
@@ -616,14 +646,12 @@ def get_all_track_numbers():
     else:
         print("Таблица track_numbers пуста.")
 
-    conn.close()
-
 
 def save_deal_to_db(deal_id, contact_id, personal_code, track_number, pickup_point, phone, chat_id):
     """
     Сохраняет информацию о сделке в таблицу tracked_deals.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     try:
@@ -636,8 +664,6 @@ def save_deal_to_db(deal_id, contact_id, personal_code, track_number, pickup_poi
         logging.info(f"Сделка ID {deal_id} с трек-номером {track_number} успешно сохранена в базе данных.")
     except sqlite3.IntegrityError as e:
         logging.warning(f"Сделка с трек-номером {track_number} уже существует в базе данных: {e}")
-    finally:
-        conn.close()
 
 
 def update_tracked_deal(deal_id, track_number):
@@ -646,7 +672,7 @@ def update_tracked_deal(deal_id, track_number):
     :param deal_id: ID сделки.
     :param track_number: Трек-номер сделки.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     try:
@@ -659,8 +685,6 @@ def update_tracked_deal(deal_id, track_number):
         logging.info(f"Поле deal_id обновлено для трек-номера {track_number} с новым значением {deal_id}.")
     except sqlite3.Error as e:
         logging.error(f"Ошибка при обновлении таблицы tracked_deals: {e}")
-    finally:
-        conn.close()
 
 
 def find_deal_by_track(track_number, current_deal_id=None):
@@ -670,7 +694,7 @@ def find_deal_by_track(track_number, current_deal_id=None):
     :param current_deal_id: ID текущей сделки для исключения из результата.
     :return: Словарь с ID сделки или None, если ничего не найдено.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Выполняем запрос к таблице tracked_deals
@@ -681,7 +705,6 @@ def find_deal_by_track(track_number, current_deal_id=None):
     """, (track_number,))
 
     result = cursor.fetchone()
-    conn.close()
 
     if result:
         deal = {"ID": result[0]}
@@ -698,18 +721,18 @@ def find_deal_by_track(track_number, current_deal_id=None):
         return None
 
 
-# Асинхронные операции
-async def delete_deal_by_track_number(track_number):
+def delete_deal_by_track_number(track_number):
     """
     Удаляет сделку из базы данных по трек-номеру.
+    Возвращает True, если запись была удалена, иначе False.
     """
     if not track_number:
         logging.info("Трек номер пуст. Удаление сделки не требуется.")
-        return
+        return False
 
     logging.info(f"Трек номер для удаления: {track_number}")
 
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Проверим, хранится ли трек-номер в базе перед удалением
@@ -721,31 +744,42 @@ async def delete_deal_by_track_number(track_number):
         cursor.execute('DELETE FROM track_numbers WHERE track_number = ?', (track_number,))
         conn.commit()
         logging.info(f"Удалена сделка с трек номером: {track_number}")
+        return True
     else:
         logging.info(f"Сделка с трек номером {track_number} не найдена в базе данных.")
-
-    conn.close()
+        return False
 
 
 # Операции с таблицей вебхуков
 def save_webhook_to_db(entity_id, event_type):
     """
     Сохраняет данные вебхука в таблицу webhooks.
+
+    Для каждой пары (entity_id, event_type) хранится только один необработанный вебхук:
+    повторное событие обновляет его метку времени и увеличивает счётчик duplicates.
+    Аренда не снимается: запись остаётся у обработчика, который её взял, а новая метка времени не даёт
+    mark_webhook_processed отметить её обработанной, и обработчик возвращает её в очередь (release_webhooks).
+    Возвращает True, если создана новая необработанная запись, и False, если событие схлопнуто с существующей.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Текущая метка времени для записи
     timestamp = datetime.utcnow().isoformat()
 
-    # Вставляем запись вебхука в таблицу
+    # Вставляем запись вебхука или обновляем уже ожидающую обработки
     cursor.execute("""
-    INSERT INTO webhooks (entity_id, event_type, timestamp, processed)
-    VALUES (?, ?, ?, 0)
+    INSERT INTO webhooks (entity_id, event_type, timestamp, processed, duplicates)
+    VALUES (?, ?, ?, 0, 0)
+    ON CONFLICT (entity_id, event_type) WHERE processed = 0 DO UPDATE SET
+        timestamp = excluded.timestamp,
+        duplicates = duplicates + 1
+    RETURNING duplicates
     """, (entity_id, event_type, timestamp))
+    duplicates = cursor.fetchone()[0]
 
     conn.commit()
-    conn.close()
+    return duplicates == 0
 
 
 def get_latest_webhook_timestamp():
@@ -753,7 +787,7 @@ def get_latest_webhook_timestamp():
     Получает время последнего поступившего вебхука из базы данных.
     Возвращает datetime объекта или None, если вебхуков нет.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -765,7 +799,6 @@ def get_latest_webhook_timestamp():
     """)
 
     result = cursor.fetchone()
-    conn.close()
 
     return datetime.fromisoformat(result[0]) if result else None
 
@@ -774,7 +807,7 @@ def mark_webhook_as_processed(webhook_id):
     """
     Помечает вебхук с заданным ID как обработанный.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -784,47 +817,81 @@ def mark_webhook_as_processed(webhook_id):
     """, (webhook_id,))
 
     conn.commit()
-    conn.close()
 
 
-def get_unprocessed_webhooks():
+CLAIM_WEBHOOKS_QUERY = """
+    UPDATE webhooks
+    SET lease_owner = ?, lease_expires = ?
+    WHERE id IN (
+        SELECT id FROM webhooks
+        WHERE processed = 0 AND (lease_expires IS NULL OR lease_expires < ?)
+        ORDER BY timestamp ASC
+        LIMIT ?
+    )
+    RETURNING id, entity_id, event_type, timestamp, duplicates
+"""
+
+
+def claim_webhooks(worker_id, limit, lease_seconds):
     """
-    Получает все необработанные вебхуки из базы данных.
+    Атомарно берёт в аренду до limit необработанных вебхуков в порядке поступления.
+
+    Выбираются вебхуки без аренды или с истёкшим сроком аренды. Выборка и установка аренды
+    выполняются в одной транзакции BEGIN IMMEDIATE, поэтому два обработчика не получат одну запись.
     Возвращает список словарей с данными вебхуков.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
+    now = time.time()
 
-    cursor.execute("""
-    SELECT id, entity_id, event_type, timestamp
-    FROM webhooks
-    WHERE processed = 0
-    ORDER BY timestamp ASC
-    """)
-
-    rows = cursor.fetchall()
-    conn.close()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(CLAIM_WEBHOOKS_QUERY, (worker_id, now + lease_seconds, now, limit))
+        rows = cursor.fetchall()
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при получении вебхуков в обработку: {e}")
+        return []
 
-    # Преобразуем данные в список словарей
+    # RETURNING не гарантирует порядок строк, восстанавливаем порядок поступления
     webhooks = [
         {
             "id": row[0],
             "entity_id": row[1],
             "event_type": row[2],
-            "timestamp": row[3]
+            "timestamp": row[3],
+            "duplicates": row[4] or 0
         }
-        for row in rows
+        for row in sorted(rows, key=lambda row: row[3])
     ]
 
     return webhooks
 
 
+def release_webhooks(webhooks, worker_id):
+    """
+    Снимает аренду с вебхуков, которые не удалось обработать, чтобы они сразу попали в следующую порцию.
+    """
+    if not webhooks:
+        return
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.executemany("""
+    UPDATE webhooks
+    SET lease_owner = NULL, lease_expires = NULL
+    WHERE id = ? AND lease_owner = ? AND processed = 0
+    """, [(webhook['id'], worker_id) for webhook in webhooks])
+    conn.commit()
+
+
 # Операции с таблицей результатов
 def save_processed_result(entity_id, event_type, data):
     """
     Сохраняет обработанные данные вебхука в таблицу processed_results.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Преобразуем данные в JSON-строку для хранения
@@ -837,7 +904,6 @@ def save_processed_result(entity_id, event_type, data):
     """, (entity_id, event_type, data_json, timestamp))
 
     conn.commit()
-    conn.close()
 
 
 def get_unprocessed_results():
@@ -845,7 +911,7 @@ def get_unprocessed_results():
     Получает все необработанные результаты для пакетной отправки.
     Возвращает список словарей с данными обработанных вебхуков.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -856,7 +922,6 @@ def get_unprocessed_results():
     """)
 
     rows = cursor.fetchall()
-    conn.close()
 
     # Преобразуем данные в список словарей
     results = [
@@ -891,7 +956,7 @@ def mark_results_as_processed(result_ids):
         return
 
     # Подключение и обновление базы данных
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     try:
@@ -905,26 +970,169 @@ def mark_results_as_processed(result_ids):
         logging.info("Результаты успешно помечены как отправленные.")
     except sqlite3.Error as e:
         logging.error(f"Ошибка при обновлении базы данных: {e}")
-    finally:
-        conn.close()
+
+
+# Очередь исходящих операций Bitrix (outbox.py)
+def outbox_writes(operations, source):
+    """
+    Возвращает записи [(вид записи, параметры), ...], которые ставят операции {ключ: команда} в очередь.
+    Сначала снимаются неотправленные операции с теми же ключами, затем добавляются новые, поэтому ключ
+    должен однозначно определять действие над сущностью (например, update_deal_{ID}), а не позицию в пакете.
+    source — кто сформировал операции (сохраняется в event_type).
+    """
+    timestamp = datetime.utcnow().isoformat()
+    now = time.time()
+    writes = [("supersede_operation", (key,)) for key in operations]
+    for key, command in operations.items():
+        operation = Operation.parse(key, command)
+        entity_id = operation.entity.partition(":")[2] if operation.entity else ""
+        writes.append(("enqueue_operation", (key, int(entity_id) if entity_id.isdigit() else None, source,
+                                             operation.method, json.dumps(command, ensure_ascii=False),
+                                             timestamp, now)))
+    return writes
+
+
+def enqueue_operations(operations, source):
+    """
+    Ставит операции {ключ: команда} в очередь одной транзакцией. Возвращает True при успехе.
+    """
+    return apply_local_writes(outbox_writes(operations, source)) is not None
+
+
+CLAIM_OUTBOX_QUERY = """
+    UPDATE processed_results
+    SET next_attempt_at = ?
+    WHERE id IN (
+        SELECT id FROM processed_results
+        WHERE sent = 0 AND next_attempt_at <= ?
+        ORDER BY next_attempt_at
+        LIMIT ?
+    )
+    RETURNING id, operation_key, data, attempts
+"""
+
+
+def claim_outbox(limit, lease_seconds):
+    """
+    Атомарно берёт до limit операций, срок отправки которых наступил, и откладывает их на lease_seconds,
+    чтобы другой обработчик не отправил их повторно. Возвращает список {'id', 'key', 'command', 'attempts'}
+    в порядке постановки в очередь.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    now = time.time()
+
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(CLAIM_OUTBOX_QUERY, (now + lease_seconds, now, limit))
+        rows = cursor.fetchall()
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при получении операций из очереди: {e}")
+        return []
+
+    return [
+        {"id": row[0], "key": row[1], "command": json.loads(row[2]), "attempts": row[3]}
+        for row in sorted(rows)
+    ]
+
+
+def complete_outbox(sent_ids, failures, max_attempts, retry_delay, max_retry_delay):
+    """
+    Фиксирует результат отправки: sent_ids помечаются выполненными, failures [(id, ошибка), ...]
+    откладываются с экспоненциально растущей задержкой, а после max_attempts попыток
+    переводятся в sent = 2 (представление outbox_dead_letters).
+    Операции, заменённые за время отправки более новыми, не меняются.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    now = time.time()
+
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.executemany("UPDATE processed_results SET sent = 1, last_error = NULL WHERE id = ? AND sent = 0",
+                           [(result_id,) for result_id in sent_ids])
+        cursor.executemany("""
+        UPDATE processed_results
+        SET attempts = attempts + 1,
+            last_error = ?,
+            sent = CASE WHEN attempts + 1 >= ? THEN 2 ELSE 0 END,
+            next_attempt_at = ? + MIN(?, ? * (1 << attempts))
+        WHERE id = ? AND sent = 0
+        """, [(str(error), max_attempts, now, max_retry_delay, retry_delay, result_id)
+              for result_id, error in failures])
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при сохранении результата отправки операций: {e}")
+        return False
+
+
+def get_outbox_stats():
+    """
+    Возвращает словарь {'pending', 'sent', 'dead', 'superseded'} с количеством операций в очереди.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT sent, COUNT(*) FROM processed_results WHERE operation_key IS NOT NULL GROUP BY sent")
+    counts = dict(cursor.fetchall())
+    return {"pending": counts.get(0, 0), "sent": counts.get(1, 0), "dead": counts.get(2, 0),
+            "superseded": counts.get(3, 0)}
+
+
+def get_dead_letters(limit=20):
+    """
+    Последние операции, для которых исчерпаны попытки отправки.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, operation_key, action, source, attempts, last_error, timestamp
+        FROM outbox_dead_letters ORDER BY id DESC LIMIT ?
+    """, (limit,))
+    columns = ("id", "key", "action", "source", "attempts", "last_error", "timestamp")
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def retry_dead_letters():
+    """
+    Возвращает в очередь операции, для которых исчерпаны попытки. Возвращает их количество.
+    Операции, после которых с тем же ключом поставлена более новая, не возвращаются.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE processed_results SET sent = 0, attempts = 0, next_attempt_at = 0
+        WHERE sent = 2 AND NOT EXISTS (
+            SELECT 1 FROM processed_results AS newer
+            WHERE newer.operation_key = processed_results.operation_key AND newer.id > processed_results.id
+        )
+    """)
+    conn.commit()
+    return cursor.rowcount
 
 
 # Операции с таблицей итоговых сделок
+FINAL_DEAL_BY_CONTACT_QUERY = """
+    SELECT id, contact_id, final_deal_id, creation_date, current_stage_id, track_count,
+           total_weight, total_amount, number_of_orders
+    FROM final_deals WHERE contact_id = ? ORDER BY creation_date DESC LIMIT 1
+"""
+
+
 def get_final_deal_from_db(contact_id):
     """
     Извлекает информацию об итоговой сделке для заданного контакта из таблицы final_deals.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Извлекаем последнюю итоговую сделку для указанного контакта
-    cursor.execute("""
-        SELECT * FROM final_deals WHERE contact_id = ? ORDER BY creation_date DESC LIMIT 1
-    """, (contact_id,))
+    cursor.execute(FINAL_DEAL_BY_CONTACT_QUERY, (contact_id,))
     result = cursor.fetchone()
 
-    conn.close()
-
     if result:
         return {
             'id': result[0],
@@ -932,7 +1140,7 @@ def get_final_deal_from_db(contact_id):
             'final_deal_id': result[2],
             'creation_date': result[3],
             'current_stage_id': result[4],
-            'track_numbers': result[5],
+            'track_count': result[5],
             'total_weight': result[6],
             'total_amount': result[7],
             'number_of_orders': result[8]
@@ -942,53 +1150,84 @@ def get_final_deal_from_db(contact_id):
 
 def save_final_deal_to_db(contact_id, deal_id, creation_date, track_number, current_stage_id, weight=0, amount=0, number_of_orders=1):
     """
-    Сохраняет новую итоговую сделку в таблицу final_deals.
+    Сохраняет новую итоговую сделку в таблицу final_deals вместе с её первым трек-номером.
+    Итоги сделки (вес, сумма, заказы) заполняются триггером final_deal_tracks по данным трек-номера.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
-    # Вставляем новую итоговую сделку в таблицу
-    cursor.execute("""
-        INSERT INTO final_deals (contact_id, final_deal_id, creation_date, current_stage_id, track_numbers, total_weight, total_amount, number_of_orders)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (contact_id, deal_id, creation_date, current_stage_id, track_number, weight, amount, number_of_orders))
-
-    conn.commit()
-    conn.close()
-    print(f"Сохранена новая итоговая сделка с ID {deal_id} для контакта {contact_id}")
+    try:
+        cursor.execute("""
+            INSERT INTO final_deals (contact_id, final_deal_id, creation_date, current_stage_id)
+            VALUES (?, ?, ?, ?)
+        """, (contact_id, deal_id, creation_date, current_stage_id))
+        cursor.execute("""
+            INSERT OR IGNORE INTO final_deal_tracks (final_deal_id, track_number, weight, amount, number_of_orders)
+            VALUES (?, ?, ?, ?, ?)
+        """, (deal_id, track_number, weight, amount, number_of_orders))
+        conn.commit()
+        print(f"Сохранена новая итоговая сделка с ID {deal_id} для контакта {contact_id}")
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при сохранении итоговой сделки {deal_id}: {e}")
 
 
-def update_final_deal_in_db(deal_id, track_numbers, stage_id, weight=None, amount=None, orders=None):
+def append_final_deal_track(final_deal_id, track_number, weight=0, amount=0, number_of_orders=0):
     """
-    Обновляет информацию об итоговой сделке в таблице final_deals.
-    Если переданы значения weight, amount и orders – обновляет и их, иначе обновляет только track_numbers и stage_id.
+    Добавляет трек-номер в итоговую сделку. Вес, сумма и количество заказов трек-номера
+    прибавляются к итогам сделки триггером final_deal_tracks.
+    Возвращает True, если трек-номер добавлен, и False, если он уже входит в сделку.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
-    if weight is not None and amount is not None and orders is not None:
-        cursor.execute("""
-            UPDATE final_deals
-            SET track_numbers = ?, current_stage_id = ?, total_weight = ?, total_amount = ?, number_of_orders = ?
-            WHERE final_deal_id = ?
-        """, (track_numbers, stage_id, weight, amount, orders, deal_id))
-    else:
+    try:
         cursor.execute("""
-            UPDATE final_deals
-            SET track_numbers = ?, current_stage_id = ?
-            WHERE final_deal_id = ?
-        """, (track_numbers, stage_id, deal_id))
+            INSERT OR IGNORE INTO final_deal_tracks (final_deal_id, track_number, weight, amount, number_of_orders)
+            VALUES (?, ?, ?, ?, ?)
+        """, (final_deal_id, track_number, weight, amount, number_of_orders))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при добавлении трек-номера {track_number} в итоговую сделку {final_deal_id}: {e}")
+        return False
+
+
+FINAL_DEAL_TRACKS_QUERY = "SELECT track_number FROM final_deal_tracks WHERE final_deal_id = ? ORDER BY id"
+
+
+def get_final_deal_track_numbers(final_deal_id):
+    """
+    Возвращает трек-номера итоговой сделки в порядке добавления.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(FINAL_DEAL_TRACKS_QUERY, (final_deal_id,))
+    return [row[0] for row in cursor.fetchall()]
 
-    conn.commit()
-    conn.close()
-    print(f"Обновлена итоговая сделка с ID {deal_id}")
+
+FINAL_DEAL_BY_TRACK_QUERY = """
+    SELECT final_deal_id FROM final_deal_tracks WHERE track_number = ? ORDER BY id DESC LIMIT 1
+"""
+
+
+def find_final_deal_by_track(track_number):
+    """
+    Возвращает ID итоговой сделки, в которую последней добавлен трек-номер, или None.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(FINAL_DEAL_BY_TRACK_QUERY, (track_number,))
+    result = cursor.fetchone()
+    return result[0] if result else None
 
 
 def update_final_deal_id(contact_id, timestamp, new_deal_id):
     """
     Обновляет ID итоговой сделки в таблице final_deals, основываясь на contact_id и временной метке.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Обновляем ID итоговой сделки
@@ -999,25 +1238,24 @@ def update_final_deal_id(contact_id, timestamp, new_deal_id):
     """, (new_deal_id, contact_id, timestamp))
 
     conn.commit()
-    conn.close()
     logging.info(f"Обновлен final_deal_id для контакта {contact_id} на {new_deal_id}")
 
 
 def get_all_final_deals_by_contact_id(contact_id):
     """
     Извлекает все итоговые сделки для заданного contact_id из таблицы final_deals.
-    Возвращает список словарей.
+    Возвращает список словарей, track_numbers — список трек-номеров сделки.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT id, contact_id, final_deal_id, creation_date, current_stage_id, track_numbers, total_weight, total_amount, number_of_orders
+        SELECT id, contact_id, final_deal_id, creation_date, current_stage_id, total_weight, total_amount, number_of_orders
         FROM final_deals
         WHERE contact_id = ?
         ORDER BY creation_date DESC
     """, (contact_id,))
     rows = cursor.fetchall()
-    conn.close()
+    track_numbers = get_final_deal_tracks_by_ids([row[2] for row in rows])
 
     deals = []
     for row in rows:
@@ -1027,10 +1265,10 @@ def get_all_final_deals_by_contact_id(contact_id):
             "final_deal_id": row[2],
             "creation_date": row[3],
             "current_stage_id": row[4],
-            "track_numbers": row[5],
-            "total_weight": row[6],
-            "total_amount": row[7],
-            "number_of_orders": row[8]
+            "track_numbers": track_numbers.get(str(row[2]), []),
+            "total_weight": row[5],
+            "total_amount": row[6],
+            "number_of_orders": row[7]
         })
     return deals
 
@@ -1040,101 +1278,172 @@ def delete_final_deal_from_db(final_deal_id):
     Удаляет итоговую сделку из таблицы final_deals по final_deal_id.
     Возвращает True, если удаление прошло успешно, иначе False.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM final_deals WHERE final_deal_id = ?", (final_deal_id,))
     conn.commit()
     deleted = cursor.rowcount > 0
-    conn.close()
     return deleted
 
 
-
 # Функция для сохранения TASK_ID в базу данных
 def save_task_to_db(deal_id, task_id):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
         'INSERT OR REPLACE INTO deal_tasks (deal_id, task_id) VALUES (?, ?)',
         (deal_id, task_id)
     )
     conn.commit()
-    conn.close()
     logging.info(f"Сохранен task_id {task_id} для сделки deal_id {deal_id}.")
 
 
 # Функция для получения TASK_ID по DEAL_ID из базы данных
 def get_task_id_by_deal_id(deal_id):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
         'SELECT task_id FROM deal_tasks WHERE deal_id = ?',
         (deal_id,)
     )
     result = cursor.fetchone()
-    conn.close()
     return result[0] if result else None
 
 
 def delete_task_from_db(deal_id):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
         'DELETE FROM deal_tasks WHERE deal_id = ?',
         (deal_id,)
     )
     conn.commit()
-    conn.close()
     logging.info(f"Удалена запись из базы данных для сделки deal_id {deal_id}.")
 
 
-def save_broadcast_message(chat_id, message_id):
-    conn = sqlite3.connect(DATABASE_PATH)
+def create_broadcast(text, chat_ids):
+    """
+    Создаёт кампанию рассылки и список получателей со статусом pending одной транзакцией.
+    Возвращает broadcast_id.
+    """
+    conn = get_connection()
     cursor = conn.cursor()
+    chat_ids = list(dict.fromkeys(chat_ids))  # Убираем повторы, сохраняя порядок
 
-    cursor.execute("""
-    INSERT INTO broadcast_messages (chat_id, message_id)
-    VALUES (?, ?)
-    """, (chat_id, message_id))
+    try:
+        cursor.execute("INSERT INTO broadcasts (text, status, total) VALUES (?, 'running', ?)", (text, len(chat_ids)))
+        broadcast_id = cursor.lastrowid
+        cursor.executemany("""
+        INSERT INTO broadcast_messages (broadcast_id, chat_id, status)
+        VALUES (?, ?, 'pending')
+        """, [(broadcast_id, chat_id) for chat_id in chat_ids])
+        conn.commit()
+        return broadcast_id
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при создании рассылки: {e}")
+        return None
 
-    conn.commit()
-    conn.close()
+
+def get_broadcast(broadcast_id):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, text, status, total FROM broadcasts WHERE id = ?", (broadcast_id,))
+    row = cursor.fetchone()
+    return {"id": row[0], "text": row[1], "status": row[2], "total": row[3]} if row else None
 
 
-def get_last_broadcast_messages():
-    conn = sqlite3.connect(DATABASE_PATH)
+def get_last_broadcast_id():
+    """
+    Возвращает ID последней не удалённой рассылки.
+    """
+    conn = get_connection()
     cursor = conn.cursor()
+    cursor.execute("SELECT id FROM broadcasts WHERE status != 'deleted' ORDER BY id DESC LIMIT 1")
+    row = cursor.fetchone()
+    return row[0] if row else None
 
+
+def get_unfinished_broadcast_ids():
+    """
+    Возвращает ID рассылок, отправка которых была прервана (например, перезапуском бота).
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def update_broadcast(broadcast_id, status=None, text=None):
+    conn = get_connection()
+    cursor = conn.cursor()
+    if status is not None:
+        cursor.execute("UPDATE broadcasts SET status = ? WHERE id = ?", (status, broadcast_id))
+    if text is not None:
+        cursor.execute("UPDATE broadcasts SET text = ? WHERE id = ?", (text, broadcast_id))
+    conn.commit()
+
+
+def get_broadcast_recipients(broadcast_id, status):
+    """
+    Возвращает список (chat_id, message_id) получателей рассылки с заданным статусом.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
     cursor.execute("""
     SELECT chat_id, message_id FROM broadcast_messages
-    ORDER BY id DESC
-    """)
-    messages = cursor.fetchall()
-    conn.close()
-    return messages
+    WHERE broadcast_id = ? AND status = ?
+    ORDER BY id
+    """, (broadcast_id, status))
+    return cursor.fetchall()
+
+
+def save_broadcast_results(broadcast_id, results):
+    """
+    Сохраняет результаты доставки пакетом.
+    results — список кортежей (chat_id, status, message_id, error).
+    """
+    if not results:
+        return
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.executemany("""
+        UPDATE broadcast_messages
+        SET status = ?, message_id = COALESCE(?, message_id), error = ?, timestamp = CURRENT_TIMESTAMP
+        WHERE broadcast_id = ? AND chat_id = ?
+        """, [(status, message_id, error, broadcast_id, chat_id) for chat_id, status, message_id, error in results])
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при сохранении результатов рассылки {broadcast_id}: {e}")
+
+
+def get_last_broadcast_messages():
+    """
+    Возвращает список (chat_id, message_id) доставленных сообщений последней рассылки.
+    """
+    broadcast_id = get_last_broadcast_id()
+    if broadcast_id is None:
+        return []
+    return get_broadcast_recipients(broadcast_id, 'sent')
 
 
 def save_deal_history(deal_id, track_number, original_date_modify, stage_id, china_shipment_date=None):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
-    cursor.execute("""
-        INSERT INTO deal_history (deal_id, track_number, original_date_modify, stage_id, china_shipment_date)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(track_number) DO UPDATE SET
-            original_date_modify = excluded.original_date_modify,
-            stage_id = excluded.stage_id
-            {china_update}
-    """.format(china_update=", china_shipment_date = excluded.china_shipment_date" if china_shipment_date is not None else ""),
-        (deal_id, track_number, original_date_modify, stage_id, china_shipment_date)
-    )
+    # Те же выражения, что и у отложенных записей пакета вебхуков (LOCAL_WRITE_STATEMENTS)
+    statement = "save_deal_history_china" if china_shipment_date is not None else "save_deal_history"
+    cursor.execute(LOCAL_WRITE_STATEMENTS[statement],
+                   (deal_id, track_number, original_date_modify, stage_id, china_shipment_date))
 
     conn.commit()
-    conn.close()
 
 
 def get_original_date_by_track(track_number):
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("""
         SELECT original_date_modify, stage_id, china_shipment_date 
@@ -1142,21 +1451,93 @@ def get_original_date_by_track(track_number):
         WHERE track_number = ?
     """, (track_number,))
     result = cursor.fetchone()
-    conn.close()
     return result  # Теперь возвращает (original_date_modify, stage_id, china_shipment_date)
 
 
+def save_stage_transitions(transitions):
+    """
+    Добавляет переходы [(track_number, deal_id, stage_id, changed_at), ...] в журнал stage_transitions
+    одной транзакцией. Новые коды этапов заносятся в справочник stages.
+    """
+    transitions = [tuple(transition) for transition in transitions]
+    if not transitions:
+        return True
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.executemany(LOCAL_WRITE_STATEMENTS["register_stage"],
+                           [(code, stage_pipeline(code)) for code in {transition[2] for transition in transitions}])
+        cursor.executemany(LOCAL_WRITE_STATEMENTS["stage_transition"], transitions)
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при сохранении переходов между этапами: {e}")
+        return False
+
+
+STAGE_DWELL_TIMES_QUERY = """
+    SELECT s.pipeline, t.pickup_point,
+           (SELECT n.ts FROM stage_transitions n
+            WHERE n.track_number = t.track_number
+              AND (n.ts > t.ts OR (n.ts = t.ts AND n.id > t.id))
+            ORDER BY n.ts, n.id LIMIT 1) - t.ts AS dwell
+    FROM stages s
+    JOIN stage_transitions t ON t.stage = s.id
+    WHERE s.code = ? AND t.ts >= ?
+"""
+
+
+def get_stage_dwell_times(stage_id, since=None):
+    """
+    Возвращает время пребывания посылок на этапе stage_id: список (pipeline, pickup_point, секунды).
+    Учитываются только завершённые пребывания (за переходом на этап следует переход на другой этап),
+    начавшиеся не раньше since (Unix time), если он задан.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(STAGE_DWELL_TIMES_QUERY, (stage_id, since or 0))
+    return [row for row in cursor.fetchall() if row[2] is not None]
+
+
+def get_stage_dwell_percentiles(stage_id, since=None, percentiles=(50, 90, 95)):
+    """
+    Перцентили времени пребывания на этапе stage_id по воронкам и пунктам выдачи.
+    Возвращает список словарей {'pipeline', 'pickup_point', 'count', 'p50', 'p90', ...} (значения в секундах),
+    отсортированный по убыванию количества посылок.
+    """
+    groups = {}
+    for pipeline, pickup_point, dwell in get_stage_dwell_times(stage_id, since):
+        groups.setdefault((pipeline, pickup_point), []).append(dwell)
+
+    stats = []
+    for (pipeline, pickup_point), values in groups.items():
+        values.sort()
+        row = {'pipeline': pipeline, 'pickup_point': pickup_point, 'count': len(values)}
+        for percentile in percentiles:
+            # Метод ближайшего ранга
+            rank = max(1, -(-percentile * len(values) // 100))
+            row[f'p{percentile}'] = values[rank - 1]
+        stats.append(row)
+    stats.sort(key=lambda row: -row['count'])
+    return stats
+
+
 def delete_client_from_db(phone):
     """
-    Удаляет клиента из таблицы `clients` по номеру телефона.
+    Удаляет клиента из таблицы `clients` по номеру телефона и возвращает его персональный код в пул свободных.
     """
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = get_connection()
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM clients WHERE phone = ?", (phone,))
-        deleted_rows = cursor.rowcount
+        cursor.execute("DELETE FROM clients WHERE phone = ? RETURNING personal_code", (phone,))
+        released_codes = [row[0] for row in cursor.fetchall()]
+        deleted_rows = len(released_codes)
+        for personal_code in released_codes:
+            _release_code(cursor, personal_code)
         conn.commit()
-        conn.close()
         if deleted_rows > 0:
             logging.info(f"Удалена запись из базы данных для телефона {phone}.")
         else:
@@ -1165,3 +1546,667 @@ def delete_client_from_db(phone):
     except Exception as e:
         logging.error(f"Ошибка при удалении записи с телефоном {phone}: {e}")
         return False
+
+
+# Пакетные выборки
+# Варианты одиночных выборок для целого пакета сделок: один запрос IN (...) на порцию
+# из BULK_CHUNK_SIZE значений вместо запроса на каждое значение. Результат — словарь,
+# ключи которого совпадают с переданными значениями (ID из Bitrix приходят строками, в базе — числами).
+BULK_CHUNK_SIZE = 500  # Не больше лимита параметров в одном запросе SQLite
+
+
+def _bulk_select(query, values):
+    """
+    Выполняет query с подставленным списком плейсхолдеров {placeholders} порциями
+    и возвращает словарь {str(ключ): строка}, где ключ — первая колонка строки.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    unique_values = list(dict.fromkeys(value for value in values if value is not None))
+    rows = {}
+    for i in range(0, len(unique_values), BULK_CHUNK_SIZE):
+        chunk = unique_values[i:i + BULK_CHUNK_SIZE]
+        cursor.execute(query.format(placeholders=",".join("?" * len(chunk))), chunk)
+        for row in cursor.fetchall():
+            rows.setdefault(str(row[0]), row)
+    return rows
+
+
+def _keyed_by(values, rows, convert):
+    return {value: convert(rows[str(value)]) for value in values if value is not None and str(value) in rows}
+
+
+def get_tracks_by_numbers(track_numbers):
+    """
+    Пакетный вариант get_track_data_by_track_number: {track_number: {"track_number", "name_track", "chat_id"}}.
+    """
+    rows = _bulk_select(
+        "SELECT track_number, name_track, chat_id FROM track_numbers WHERE track_number IN ({placeholders})",
+        track_numbers)
+    return _keyed_by(track_numbers, rows,
+                     lambda row: {"track_number": row[0], "name_track": row[1], "chat_id": row[2]})
+
+
+def get_clients_by_chat_ids(chat_ids):
+    """
+    Пакетный вариант get_client_by_chat_id: {chat_id: данные клиента}.
+    """
+    rows = _bulk_select(
+        "SELECT chat_id, contact_id, personal_code, name_cyrillic, name_translit, phone, city, pickup_point "
+        "FROM clients WHERE chat_id IN ({placeholders})",
+        chat_ids)
+    return _keyed_by(chat_ids, rows, lambda row: {
+        "contact_id": row[1],
+        "personal_code": row[2],
+        "name_cyrillic": row[3],
+        "name_translit": row[4],
+        "phone": row[5],
+        "city": row[6],
+        "pickup_point": row[7],
+        "chat_id": row[0]
+    })
+
+
+def get_clients_by_contact_ids(contact_ids):
+    """
+    Пакетный вариант get_client_by_contact_id: {contact_id: данные клиента}.
+    """
+    rows = _bulk_select(
+        "SELECT contact_id, chat_id, personal_code, name_cyrillic, name_translit, phone, city, pickup_point "
+        "FROM clients WHERE contact_id IN ({placeholders})",
+        contact_ids)
+    return _keyed_by(contact_ids, rows, lambda row: {
+        "chat_id": row[1],
+        "contact_id": row[0],
+        "personal_code": row[2],
+        "name_cyrillic": row[3],
+        "name_translit": row[4],
+        "phone": row[5],
+        "city": row[6],
+        "pickup_point": row[7]
+    })
+
+
+def find_deals_by_tracks(track_numbers):
+    """
+    Пакетный вариант find_deal_by_track: {track_number: {"ID": deal_id}}.
+    Исключение текущей сделки (current_deal_id) выполняет вызывающий код.
+    """
+    rows = _bulk_select("SELECT track_number, deal_id FROM tracked_deals WHERE track_number IN ({placeholders})",
+                        track_numbers)
+    return _keyed_by(track_numbers, rows, lambda row: {"ID": row[1]})
+
+
+def get_deal_history_for_tracks(track_numbers):
+    """
+    Пакетный вариант get_original_date_by_track:
+    {track_number: (original_date_modify, stage_id, china_shipment_date)}.
+    """
+    rows = _bulk_select(
+        "SELECT track_number, original_date_modify, stage_id, china_shipment_date "
+        "FROM deal_history WHERE track_number IN ({placeholders})",
+        track_numbers)
+    return _keyed_by(track_numbers, rows, lambda row: tuple(row[1:]))
+
+
+def get_final_deals_by_contact_ids(contact_ids):
+    """
+    Пакетный вариант get_final_deal_from_db: {contact_id: последняя итоговая сделка контакта}.
+    """
+    rows = _bulk_select("""
+        SELECT contact_id, id, final_deal_id, creation_date, current_stage_id, track_count,
+               total_weight, total_amount, number_of_orders
+        FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY contact_id ORDER BY creation_date DESC) AS position
+            FROM final_deals WHERE contact_id IN ({placeholders})
+        )
+        WHERE position = 1
+    """, contact_ids)
+    return _keyed_by(contact_ids, rows, lambda row: {
+        'id': row[1],
+        'contact_id': row[0],
+        'final_deal_id': row[2],
+        'creation_date': row[3],
+        'current_stage_id': row[4],
+        'track_count': row[5],
+        'total_weight': row[6],
+        'total_amount': row[7],
+        'number_of_orders': row[8]
+    })
+
+
+def get_final_deal_tracks_by_ids(final_deal_ids):
+    """
+    Пакетный вариант get_final_deal_track_numbers: {str(final_deal_id): [трек-номера в порядке добавления]}.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    unique_ids = list(dict.fromkeys(value for value in final_deal_ids if value is not None))
+    tracks = {}
+    for i in range(0, len(unique_ids), BULK_CHUNK_SIZE):
+        chunk = unique_ids[i:i + BULK_CHUNK_SIZE]
+        cursor.execute(f"""
+            SELECT final_deal_id, track_number FROM final_deal_tracks
+            WHERE final_deal_id IN ({",".join("?" * len(chunk))}) ORDER BY id
+        """, chunk)
+        for final_deal_id, track_number in cursor.fetchall():
+            tracks.setdefault(str(final_deal_id), []).append(track_number)
+    return tracks
+
+
+def get_task_ids_by_deal_ids(deal_ids):
+    """
+    Пакетный вариант get_task_id_by_deal_id: {deal_id: task_id}.
+    """
+    rows = _bulk_select("SELECT deal_id, task_id FROM deal_tasks WHERE deal_id IN ({placeholders})", deal_ids)
+    return _keyed_by(deal_ids, rows, lambda row: row[1])
+
+
+# Отложенные записи пакета вебхуков
+# UnitOfWork (unit_of_work.py) собирает локальные записи, сделанные при обработке пакета,
+# и выполняет их здесь одной транзакцией. Параметры записи повторяют аргументы одноимённых функций.
+LOCAL_WRITE_STATEMENTS = {
+    "update_tracked_deal": "UPDATE tracked_deals SET deal_id = ? WHERE track_number = ?",
+    "save_deal_history": """
+        INSERT INTO deal_history (deal_id, track_number, original_date_modify, stage_id, china_shipment_date)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(track_number) DO UPDATE SET
+            original_date_modify = excluded.original_date_modify,
+            stage_id = excluded.stage_id
+    """,
+    "save_deal_history_china": """
+        INSERT INTO deal_history (deal_id, track_number, original_date_modify, stage_id, china_shipment_date)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(track_number) DO UPDATE SET
+            original_date_modify = excluded.original_date_modify,
+            stage_id = excluded.stage_id,
+            china_shipment_date = excluded.china_shipment_date
+    """,
+    "save_final_deal": """
+        INSERT INTO final_deals (contact_id, final_deal_id, creation_date, current_stage_id) VALUES (?, ?, ?, ?)
+    """,
+    "append_final_deal_track": """
+        INSERT OR IGNORE INTO final_deal_tracks (final_deal_id, track_number, weight, amount, number_of_orders)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+    "register_stage": "INSERT OR IGNORE INTO stages (code, pipeline) VALUES (?, ?)",
+    # Параметры: трек-номер, ID сделки, код этапа, время перехода (ISO 8601; если не разобрано — текущее).
+    # Переход не записывается, если последний записанный этап трек-номера тот же.
+    "stage_transition": """
+        INSERT INTO stage_transitions (track_number, deal_id, stage, ts, pickup_point)
+        SELECT ?1, ?2, s.id,
+               COALESCE(CAST(strftime('%s', ?4) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)),
+               (SELECT c.pickup_point FROM track_numbers t JOIN clients c ON c.chat_id = t.chat_id
+                WHERE t.track_number = ?1)
+        FROM stages s
+        WHERE s.code = ?3
+          AND s.id IS NOT (SELECT stage FROM stage_transitions WHERE track_number = ?1
+                           ORDER BY ts DESC, id DESC LIMIT 1)
+    """,
+    "update_name_track": "UPDATE track_numbers SET name_track = ? WHERE track_number = ?",
+    "delete_track": "DELETE FROM track_numbers WHERE track_number = ?",
+    "save_task": "INSERT OR REPLACE INTO deal_tasks (deal_id, task_id) VALUES (?, ?)",
+    "delete_task": "DELETE FROM deal_tasks WHERE deal_id = ?",
+    # Очередь операций Bitrix: более новая операция с тем же ключом заменяет ещё не отправленную
+    "supersede_operation": """
+        UPDATE processed_results SET sent = 3, last_error = 'Заменена более новой операцией'
+        WHERE operation_key = ? AND sent IN (0, 2)
+    """,
+    "enqueue_operation": """
+        INSERT INTO processed_results (operation_key, entity_id, event_type, action, data, timestamp, sent,
+                                       attempts, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?, ?, 0, 0, ?)
+    """,
+    "mark_webhook_processed": """
+        UPDATE webhooks
+        SET processed = 1, lease_owner = NULL, lease_expires = NULL
+        WHERE id = ? AND timestamp = ? AND processed = 0
+    """,
+}
+
+
+def apply_local_writes(writes):
+    """
+    Выполняет записи [(вид записи, параметры), ...] одной транзакцией.
+    Подряд идущие записи одного вида выполняются одним executemany, порядок записей сохраняется.
+    Возвращает словарь {вид записи: количество изменённых строк} или None, если транзакция откатилась.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    counts = {}
+
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        for statement, group in groupby(writes, key=lambda write: write[0]):
+            cursor.executemany(LOCAL_WRITE_STATEMENTS[statement], [params for _, params in group])
+            counts[statement] = counts.get(statement, 0) + cursor.rowcount
+        conn.commit()
+        return counts
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при сохранении записей пакета: {e}")
+        return None
+
+
+# Операции с кэшем сделок Bitrix
+TRACK_FIELD = 'UF_CRM_1723542556619'  # Поле сделки с трек-номером
+
+
+def _remove_deal_from_track_cache(cursor, track_number, deal_id):
+    cursor.execute("SELECT deal_ids FROM track_deal_cache WHERE track_number = ?", (track_number,))
+    row = cursor.fetchone()
+    if row:
+        deal_ids = [cached_id for cached_id in json.loads(row[0]) if cached_id != deal_id]
+        if deal_ids:
+            cursor.execute("UPDATE track_deal_cache SET deal_ids = ? WHERE track_number = ?",
+                           (json.dumps(deal_ids), track_number))
+        else:
+            cursor.execute("DELETE FROM track_deal_cache WHERE track_number = ?", (track_number,))
+
+
+def _upsert_cached_deal(cursor, deal, cached_at):
+    """
+    Сохраняет сделку в кэш. Если у сделки сменился трек-номер, убирает её из списка старого трек-номера,
+    а в уже закэшированный список нового трек-номера добавляет её в конец.
+    """
+    deal_id = int(deal['ID'])
+    track_number = deal.get(TRACK_FIELD) or None
+
+    cursor.execute("SELECT track_number FROM deal_cache WHERE deal_id = ?", (deal_id,))
+    row = cursor.fetchone()
+    if row and row[0] and row[0] != track_number:
+        _remove_deal_from_track_cache(cursor, row[0], deal_id)
+
+    cursor.execute("""
+    INSERT INTO deal_cache (deal_id, track_number, data, cached_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(deal_id) DO UPDATE SET
+        track_number = excluded.track_number,
+        data = excluded.data,
+        cached_at = excluded.cached_at
+    """, (deal_id, track_number, json.dumps(deal, ensure_ascii=False), cached_at))
+
+    if track_number:
+        cursor.execute("SELECT deal_ids FROM track_deal_cache WHERE track_number = ?", (track_number,))
+        track_row = cursor.fetchone()
+        if track_row:
+            deal_ids = json.loads(track_row[0])
+            if deal_id not in deal_ids:
+                deal_ids.append(deal_id)
+                cursor.execute("UPDATE track_deal_cache SET deal_ids = ? WHERE track_number = ?",
+                               (json.dumps(deal_ids), track_number))
+
+
+def cache_deals(deals):
+    """
+    Обновляет кэш данными сделок, уже полученными из Bitrix (например, в batch_send_to_bitrix).
+    """
+    deals = [deal for deal in deals if isinstance(deal, dict) and deal.get('ID')]
+    if not deals:
+        return
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    cached_at = time.time()
+    try:
+        for deal in deals:
+            _upsert_cached_deal(cursor, deal, cached_at)
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при обновлении кэша сделок: {e}")
+
+
+def cache_track_deals(track_number, deals):
+    """
+    Сохраняет полный список сделок по трек-номеру (ответ crm.deal.list) и данные каждой сделки.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cached_at = time.time()
+    try:
+        for deal in deals:
+            _upsert_cached_deal(cursor, deal, cached_at)
+        cursor.execute("""
+        INSERT INTO track_deal_cache (track_number, deal_ids, cached_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT(track_number) DO UPDATE SET
+            deal_ids = excluded.deal_ids,
+            cached_at = excluded.cached_at
+        """, (track_number, json.dumps([int(deal['ID']) for deal in deals]), cached_at))
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при сохранении кэша сделок для трек-номера {track_number}: {e}")
+
+
+def get_cached_deal(deal_id, max_age):
+    """
+    Возвращает данные сделки из кэша или None, если записи нет или она старше max_age секунд.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT data FROM deal_cache WHERE deal_id = ? AND cached_at >= ?",
+                   (int(deal_id), time.time() - max_age))
+    row = cursor.fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def get_cached_deals_by_track(track_number, max_age):
+    """
+    Возвращает список сделок по трек-номеру из кэша или None, если список не закэширован,
+    устарел или какая-либо из его сделок отсутствует в кэше.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    min_cached_at = time.time() - max_age
+
+    cursor.execute("SELECT deal_ids FROM track_deal_cache WHERE track_number = ? AND cached_at >= ?",
+                   (track_number, min_cached_at))
+    row = cursor.fetchone()
+    if not row:
+        return None
+
+    deal_ids = json.loads(row[0])
+    placeholders = ", ".join("?" for _ in deal_ids)
+    cursor.execute(f"SELECT deal_id, data FROM deal_cache WHERE deal_id IN ({placeholders}) AND cached_at >= ?",
+                   (*deal_ids, min_cached_at))
+    deals_by_id = {deal_id: json.loads(data) for deal_id, data in cursor.fetchall()}
+    if len(deals_by_id) != len(deal_ids):
+        return None
+    return [deals_by_id[deal_id] for deal_id in deal_ids]
+
+
+def invalidate_cached_deal(deal_id):
+    """
+    Удаляет сделку из кэша вместе со списками трек-номеров, в которые она входит. Вызывается при вебхуке по сделке.
+    """
+    try:
+        deal_id = int(deal_id)
+    except (TypeError, ValueError):
+        return
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    # crm.deal.list ищет трек-номер по вхождению, поэтому сделка может быть в списках нескольких трек-номеров
+    cursor.execute("""
+    DELETE FROM track_deal_cache
+    WHERE EXISTS (SELECT 1 FROM json_each(track_deal_cache.deal_ids) WHERE value = ?)
+    """, (deal_id,))
+    cursor.execute("DELETE FROM deal_cache WHERE deal_id = ?", (deal_id,))
+    conn.commit()
+
+
+def invalidate_cached_track(track_number):
+    """
+    Удаляет из кэша список сделок трек-номера и сами сделки. Вызывается после изменения сделок из бота.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM track_deal_cache WHERE track_number = ?", (track_number,))
+    cursor.execute("DELETE FROM deal_cache WHERE track_number = ?", (track_number,))
+    conn.commit()
+
+
+# Зеркало сделок и контактов Bitrix (crm_sync.py)
+FINAL_DEAL_FIELD = 'UF_CRM_1729539412'     # Признак итоговой сделки
+PERSONAL_CODE_FIELD = 'UF_CRM_1726123664764'  # Персональный код контакта
+
+CRM_MIRROR_STATEMENTS = {
+    # Запись не перезаписывается более старыми данными (например, ответом, полученным до вебхука)
+    "deal": """
+        INSERT INTO crm_deals (deal_id, category_id, stage_id, contact_id, track_number, is_final,
+                               date_create, date_modify, data, synced_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(deal_id) DO UPDATE SET
+            category_id = excluded.category_id,
+            stage_id = excluded.stage_id,
+            contact_id = excluded.contact_id,
+            track_number = excluded.track_number,
+            is_final = excluded.is_final,
+            date_create = excluded.date_create,
+            date_modify = excluded.date_modify,
+            data = excluded.data,
+            synced_at = excluded.synced_at
+        WHERE excluded.date_modify >= COALESCE(crm_deals.date_modify, '')
+    """,
+    "contact": """
+        INSERT INTO crm_contacts (contact_id, personal_code, date_modify, data, synced_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(contact_id) DO UPDATE SET
+            personal_code = excluded.personal_code,
+            date_modify = excluded.date_modify,
+            data = excluded.data,
+            synced_at = excluded.synced_at
+        WHERE excluded.date_modify >= COALESCE(crm_contacts.date_modify, '')
+    """,
+}
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _crm_mirror_row(entity, record, synced_at):
+    data = json.dumps(record, ensure_ascii=False)
+    if entity == "deal":
+        return (int(record['ID']), _int_or_none(record.get('CATEGORY_ID')), record.get('STAGE_ID'),
+                _int_or_none(record.get('CONTACT_ID')), record.get(TRACK_FIELD) or None,
+                1 if str(record.get(FINAL_DEAL_FIELD)) == '1' else 0,
+                record.get('DATE_CREATE'), record.get('DATE_MODIFY') or '', data, synced_at)
+    return (int(record['ID']), record.get(PERSONAL_CODE_FIELD) or None, record.get('DATE_MODIFY') or '', data,
+            synced_at)
+
+
+def save_crm_records(entity, records, state=None):
+    """
+    Записывает сделки или контакты (entity = 'deal' / 'contact') в зеркало одним executemany.
+    Если передан state, в той же транзакции сохраняется позиция синхронизации,
+    поэтому после сбоя выборка продолжается с последней записанной страницы.
+    Возвращает количество записанных строк или None при ошибке.
+    """
+    rows = [_crm_mirror_row(entity, record, time.time())
+            for record in records if isinstance(record, dict) and record.get('ID')]
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        if rows:
+            cursor.executemany(CRM_MIRROR_STATEMENTS[entity], rows)
+        if state is not None:
+            cursor.execute("""
+            INSERT INTO crm_sync_state (entity, watermark, pass_started_at, last_id, synced_at)
+            VALUES (:entity, :watermark, :pass_started_at, :last_id, :synced_at)
+            ON CONFLICT(entity) DO UPDATE SET
+                watermark = excluded.watermark,
+                pass_started_at = excluded.pass_started_at,
+                last_id = excluded.last_id,
+                synced_at = excluded.synced_at
+            """, dict(state, entity=entity))
+        conn.commit()
+        return len(rows)
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при записи в зеркало CRM ({entity}): {e}")
+        return None
+
+
+def get_crm_sync_state(entity):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT watermark, pass_started_at, last_id, synced_at FROM crm_sync_state WHERE entity = ?
+    """, (entity,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return dict(zip(("watermark", "pass_started_at", "last_id", "synced_at"), row))
+
+
+def save_crm_sync_run(entity, started_at, finished_at, pages, rows, watermark, lag_seconds, error=None):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO crm_sync_runs (entity, started_at, finished_at, pages, rows, watermark, lag_seconds, error)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (entity, started_at, finished_at, pages, rows, watermark, lag_seconds, error))
+    conn.commit()
+
+
+def delete_crm_record(entity, entity_id):
+    """
+    Удаляет сделку или контакт из зеркала. Вызывается по вебхуку об удалении: crm.*.list удалённые записи не возвращает.
+    """
+    entity_id = _int_or_none(entity_id)
+    if entity_id is None:
+        return
+    conn = get_connection()
+    cursor = conn.cursor()
+    if entity == "deal":
+        cursor.execute("DELETE FROM crm_deals WHERE deal_id = ?", (entity_id,))
+    else:
+        cursor.execute("DELETE FROM crm_contacts WHERE contact_id = ?", (entity_id,))
+    conn.commit()
+
+
+MIRRORED_DEALS_BY_TRACK_QUERY = "SELECT data FROM crm_deals WHERE track_number = ? ORDER BY deal_id"
+# {placeholders} — параметры stage_id, {final_filter} — условие для итоговых сделок или пустая строка
+MIRRORED_DEALS_BY_CONTACT_QUERY = """
+    SELECT data FROM crm_deals
+    WHERE contact_id = ? AND stage_id IN ({placeholders}) {final_filter}
+    ORDER BY deal_id
+"""
+
+
+def get_mirrored_deals_by_track(track_number):
+    """
+    Сделки зеркала с трек-номером track_number в порядке ID (как в ответе crm.deal.list).
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(MIRRORED_DEALS_BY_TRACK_QUERY, (track_number,))
+    return [json.loads(row[0]) for row in cursor.fetchall()]
+
+
+def get_mirrored_deals_by_tracks(track_numbers):
+    """
+    Пакетный вариант get_mirrored_deals_by_track: {track_number: [сделки в порядке ID]}.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    unique_tracks = list(dict.fromkeys(value for value in track_numbers if value))
+    deals = {}
+    for i in range(0, len(unique_tracks), BULK_CHUNK_SIZE):
+        chunk = unique_tracks[i:i + BULK_CHUNK_SIZE]
+        cursor.execute(f"""
+            SELECT track_number, data FROM crm_deals
+            WHERE track_number IN ({",".join("?" * len(chunk))}) ORDER BY deal_id
+        """, chunk)
+        for track_number, data in cursor.fetchall():
+            deals.setdefault(track_number, []).append(json.loads(data))
+    return deals
+
+
+def get_mirrored_deals_by_contact(contact_id, stage_ids, final_only=False):
+    """
+    Сделки зеркала контакта contact_id на этапах stage_ids в порядке ID.
+    final_only — только итоговые сделки.
+    """
+    stage_ids = list(stage_ids)
+    if not stage_ids:
+        return []
+    conn = get_connection()
+    cursor = conn.cursor()
+    placeholders = ", ".join("?" for _ in stage_ids)
+    query = MIRRORED_DEALS_BY_CONTACT_QUERY.format(placeholders=placeholders,
+                                                   final_filter="AND is_final = 1" if final_only else "")
+    cursor.execute(query, (_int_or_none(contact_id), *stage_ids))
+    return [json.loads(row[0]) for row in cursor.fetchall()]
+
+
+# Операции с хранилищем состояний FSM
+def get_fsm_record(key):
+    """
+    Возвращает кортеж (state, data, version) для ключа FSM или (None, {}, None), если записи нет.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT state, data, version FROM fsm_storage WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    if not row:
+        return None, {}, None
+    return row[0], json.loads(row[1]), row[2]
+
+
+def get_fsm_version(key):
+    """
+    Возвращает версию записи FSM или None, если записи нет. Чтение по первичному ключу без разбора JSON.
+    Новая запись получает версию time.time_ns(), поэтому запись, удалённая и созданная заново,
+    не совпадёт по версии с прежней; каждое изменение увеличивает версию на 1.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT version FROM fsm_storage WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _save_fsm_record(cursor, key):
+    """
+    Завершает изменение записи FSM: пустые записи удаляются, чтобы таблица не росла вместе с числом
+    пользователей. Возвращает запись после изменения (state, data, version), включая поля,
+    которые мог изменить другой процесс.
+    """
+    cursor.execute("DELETE FROM fsm_storage WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+    cursor.execute("SELECT state, data, version FROM fsm_storage WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    cursor.connection.commit()
+    if not row:
+        return None, {}, None
+    return row[0], json.loads(row[1]), row[2]
+
+
+def set_fsm_state(key, state):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("""
+    INSERT INTO fsm_storage (key, state, updated_at, version) VALUES (?, ?, ?, ?)
+    ON CONFLICT (key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at, version = version + 1
+    """, (key, state, time.time(), time.time_ns()))
+    return _save_fsm_record(cursor, key)
+
+
+def set_fsm_data(key, data):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("""
+    INSERT INTO fsm_storage (key, data, updated_at, version) VALUES (?, ?, ?, ?)
+    ON CONFLICT (key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at, version = version + 1
+    """, (key, json.dumps(data, ensure_ascii=False), time.time(), time.time_ns()))
+    return _save_fsm_record(cursor, key)
+
+
+# Частые запросы, план которых проверяется при старте (check_query_plans) и в тестах:
+# те же выражения, что выполняют функции выше, с параметрами-образцами
+HOT_QUERIES = {
+    "get_chat_id_by_phone": (CHAT_ID_BY_PHONE_QUERY, ("",)),
+    "get_chat_id_by_contact_id": (CHAT_ID_BY_CONTACT_QUERY, (0,)),
+    "get_track_data_by_track_number": (TRACK_BY_NUMBER_QUERY, ("",)),
+    "get_track_numbers_by_chat_id": (TRACKS_BY_CHAT_QUERY, (0,)),
+    "claim_webhooks": (CLAIM_WEBHOOKS_QUERY, ("", 0, 0, 1)),
+    "claim_outbox": (CLAIM_OUTBOX_QUERY, (0, 0, 1)),
+    "supersede_operation": (LOCAL_WRITE_STATEMENTS["supersede_operation"], ("",)),
+    "get_final_deal_from_db": (FINAL_DEAL_BY_CONTACT_QUERY, (0,)),
+    "get_final_deal_track_numbers": (FINAL_DEAL_TRACKS_QUERY, (0,)),
+    "find_final_deal_by_track": (FINAL_DEAL_BY_TRACK_QUERY, ("",)),
+    "get_stage_dwell_times": (STAGE_DWELL_TIMES_QUERY, ("", 0)),
+    "get_mirrored_deals_by_track": (MIRRORED_DEALS_BY_TRACK_QUERY, ("",)),
+    "get_mirrored_deals_by_contact": (
+        MIRRORED_DEALS_BY_CONTACT_QUERY.format(placeholders="?, ?", final_filter="AND is_final = 1"), (0, "", "")),
+}
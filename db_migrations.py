@@ -0,0 +1,542 @@
+import logging
+import re
+import sqlite3
+
+
+# ========== Миграции схемы ==========
+# Каждая миграция получает курсор и выполняется в отдельной транзакции.
+# Номер последней применённой миграции хранится в PRAGMA user_version файла базы,
+# поэтому при старте применяются только новые миграции. Уже выпущенные миграции не меняются —
+# любое изменение схемы добавляется новой функцией в конец списка MIGRATIONS.
+
+def _column_exists(cursor, table, column):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in cursor.fetchall())
+
+
+def _migration_1_lookup_indexes(cursor):
+    """
+    Индексы для частых выборок по трек-номерам, итоговым сделкам, клиентам и очередям.
+    """
+    # Поиск по трек-номеру (get_track_data_by_track_number, get_track_from_db, get_name_track_by_track_number)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_track_numbers_track_number
+    ON track_numbers (track_number, chat_id, name_track)
+    """)
+    # Список трек-номеров клиента (get_track_numbers_by_chat_id)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_track_numbers_chat_id
+    ON track_numbers (chat_id, track_number, name_track)
+    """)
+    # Последняя итоговая сделка контакта (get_final_deal_from_db, get_all_final_deals_by_contact_id)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_final_deals_contact_id
+    ON final_deals (contact_id, creation_date)
+    """)
+    # Обновление и удаление итоговой сделки по ID из Bitrix
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_final_deals_final_deal_id ON final_deals (final_deal_id)")
+    # Поиск клиента по контакту и телефону
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_clients_contact_id ON clients (contact_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_clients_phone ON clients (phone)")
+    # Выборка необработанных записей в порядке поступления
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhook_processed_timestamp ON webhooks (processed, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_processed_results_sent ON processed_results (sent, timestamp)")
+
+
+def _migration_2_deal_history_china_shipment_date(cursor):
+    """
+    Колонка china_shipment_date в deal_history, которую используют save_deal_history
+    и get_original_date_by_track. На части баз она уже была добавлена вручную.
+    """
+    if not _column_exists(cursor, "deal_history", "china_shipment_date"):
+        cursor.execute("ALTER TABLE deal_history ADD COLUMN china_shipment_date TEXT")
+
+
+def _migration_3_coalesce_pending_webhooks(cursor):
+    """
+    Не более одного необработанного вебхука на пару (entity_id, event_type).
+    Повторные события увеличивают счётчик duplicates вместо добавления новой строки.
+    """
+    if not _column_exists(cursor, "webhooks", "duplicates"):
+        cursor.execute("ALTER TABLE webhooks ADD COLUMN duplicates INTEGER DEFAULT 0")
+
+    # Схлопываем уже накопленные дубликаты: оставляем последнюю запись и переносим в неё счётчик
+    cursor.execute("""
+    UPDATE webhooks
+    SET duplicates = (
+        SELECT COUNT(*) - 1 FROM webhooks AS w
+        WHERE w.entity_id = webhooks.entity_id AND w.event_type = webhooks.event_type AND w.processed = 0
+    ),
+    timestamp = (
+        SELECT MAX(w.timestamp) FROM webhooks AS w
+        WHERE w.entity_id = webhooks.entity_id AND w.event_type = webhooks.event_type AND w.processed = 0
+    )
+    WHERE processed = 0 AND id IN (
+        SELECT MAX(id) FROM webhooks WHERE processed = 0 GROUP BY entity_id, event_type
+    )
+    """)
+    cursor.execute("""
+    DELETE FROM webhooks
+    WHERE processed = 0 AND id NOT IN (
+        SELECT MAX(id) FROM webhooks WHERE processed = 0 GROUP BY entity_id, event_type
+    )
+    """)
+
+    cursor.execute("""
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_webhook_pending
+    ON webhooks (entity_id, event_type) WHERE processed = 0
+    """)
+
+
+def _migration_4_deal_cache(cursor):
+    """
+    Локальный кэш сделок Bitrix: данные сделки по ID и список сделок по трек-номеру.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS deal_cache (
+        deal_id INTEGER PRIMARY KEY,       -- ID сделки в Bitrix
+        track_number TEXT,                 -- Трек-номер сделки на момент кэширования
+        data TEXT NOT NULL,                -- JSON с полями сделки (crm.deal.get)
+        cached_at REAL NOT NULL            -- Время кэширования (Unix time)
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_deal_cache_track_number ON deal_cache (track_number)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS track_deal_cache (
+        track_number TEXT PRIMARY KEY,
+        deal_ids TEXT NOT NULL,            -- JSON-список ID сделок в порядке ответа crm.deal.list
+        cached_at REAL NOT NULL
+    )
+    """)
+
+
+def _migration_5_broadcasts(cursor):
+    """
+    Рассылки как отдельные кампании. broadcast_messages пересоздаётся с привязкой к broadcast_id
+    и статусом доставки по каждому получателю, чтобы рассылку можно было продолжить после перезапуска
+    и редактировать или удалять только последнюю кампанию.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,                -- Текущий текст рассылки
+        status TEXT NOT NULL,              -- running, done, deleted
+        total INTEGER DEFAULT 0,           -- Количество получателей
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    cursor.execute("""
+    CREATE TABLE broadcast_messages_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        broadcast_id INTEGER NOT NULL REFERENCES broadcasts(id),
+        chat_id INTEGER NOT NULL,
+        message_id INTEGER,                -- Заполняется после успешной отправки
+        status TEXT NOT NULL DEFAULT 'pending',  -- pending, sent, failed, deleted
+        error TEXT,                        -- Текст ошибки для failed
+        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (broadcast_id, chat_id)
+    )
+    """)
+
+    # Сообщения прошлых рассылок переносятся в одну архивную кампанию
+    cursor.execute("SELECT COUNT(*) FROM broadcast_messages")
+    if cursor.fetchone()[0]:
+        cursor.execute("""
+        INSERT INTO broadcasts (text, status, total)
+        SELECT '', 'done', COUNT(DISTINCT chat_id) FROM broadcast_messages
+        """)
+        legacy_broadcast_id = cursor.lastrowid
+        cursor.execute("""
+        INSERT OR IGNORE INTO broadcast_messages_new (broadcast_id, chat_id, message_id, status, timestamp)
+        SELECT ?, chat_id, message_id, 'sent', timestamp FROM broadcast_messages ORDER BY id DESC
+        """, (legacy_broadcast_id,))
+
+    cursor.execute("DROP TABLE broadcast_messages")
+    cursor.execute("ALTER TABLE broadcast_messages_new RENAME TO broadcast_messages")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_messages_status ON broadcast_messages (broadcast_id, status)")
+
+
+def _migration_6_webhook_leases(cursor):
+    """
+    Аренда вебхуков: обработчик забирает очередную порцию, помечая её своим идентификатором и сроком аренды.
+    Если обработчик упал, порция снова становится доступной после истечения срока.
+    """
+    if not _column_exists(cursor, "webhooks", "lease_owner"):
+        cursor.execute("ALTER TABLE webhooks ADD COLUMN lease_owner TEXT")
+    if not _column_exists(cursor, "webhooks", "lease_expires"):
+        cursor.execute("ALTER TABLE webhooks ADD COLUMN lease_expires REAL")
+
+
+def _migration_7_fsm_storage(cursor):
+    """
+    Состояния и данные FSM aiogram, чтобы сценарии пользователей переживали перезапуск бота.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_storage (
+        key TEXT PRIMARY KEY,              -- bot_id:chat_id:user_id[:thread_id][:business_connection_id]:destiny
+        state TEXT,                        -- Текущее состояние или NULL
+        data TEXT NOT NULL DEFAULT '{}',   -- JSON с данными состояния
+        updated_at REAL NOT NULL           -- Время последнего изменения (Unix time)
+    )
+    """)
+
+
+def fill_code_pool(cursor, digits):
+    """
+    Добавляет в пул свободных кодов все коды длины digits, которые не заняты клиентами и не являются VIP.
+    Коды получают случайный порядок выдачи (sort_key), чтобы новые коды не шли подряд.
+    """
+    low = 1 if digits == 4 else 10 ** (digits - 1)  # 4-значные коды с ведущими нулями: 0001-9999
+    high = 10 ** digits - 1
+    cursor.execute(f"""
+    WITH RECURSIVE numbers (n) AS (
+        SELECT ? UNION ALL SELECT n + 1 FROM numbers WHERE n < ?
+    )
+    INSERT OR IGNORE INTO free_codes (code, sort_key)
+    SELECT printf('%0{digits}d', n), random() FROM numbers
+    WHERE printf('%0{digits}d', n) NOT IN (SELECT personal_code FROM clients WHERE personal_code IS NOT NULL)
+      AND printf('%0{digits}d', n) NOT IN (SELECT vip_code FROM vip_codes)
+    """, (low, high))
+    cursor.execute("""
+    INSERT INTO code_pool (id, digits) VALUES (1, ?)
+    ON CONFLICT (id) DO UPDATE SET digits = excluded.digits
+    """, (digits,))
+
+
+def _migration_8_free_code_pool(cursor):
+    """
+    Пул свободных персональных кодов, из которого generate_unique_code выдаёт коды без перебора.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS free_codes (
+        code TEXT PRIMARY KEY,
+        sort_key INTEGER NOT NULL          -- Случайный ключ, задающий порядок выдачи
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_free_codes_sort_key ON free_codes (sort_key)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS code_pool (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        digits INTEGER NOT NULL            -- Длина кодов, добавленных в пул последними
+    )
+    """)
+    fill_code_pool(cursor, 4)
+
+
+def _migration_9_final_deal_tracks(cursor):
+    """
+    Трек-номера итоговой сделки в отдельной таблице final_deal_tracks вместо строки final_deals.track_numbers.
+    Итоги итоговой сделки (вес, сумма, заказы, количество трек-номеров) поддерживаются триггерами
+    при добавлении и удалении трек-номера. Колонка final_deals.track_numbers больше не обновляется.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS final_deal_tracks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, -- Порядок добавления трек-номеров
+        final_deal_id INTEGER NOT NULL,       -- ID итоговой сделки в Bitrix
+        track_number TEXT NOT NULL,
+        weight REAL DEFAULT 0,                -- Вклад трек-номера в итоги итоговой сделки
+        amount REAL DEFAULT 0,
+        number_of_orders INTEGER DEFAULT 0,
+        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (final_deal_id, track_number)
+    )
+    """)
+    # Индексы неявно продолжаются rowid, поэтому выборки в порядке добавления не требуют сортировки
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_final_deal_tracks_final_deal_id ON final_deal_tracks (final_deal_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_final_deal_tracks_track_number ON final_deal_tracks (track_number)")
+    if not _column_exists(cursor, "final_deals", "track_count"):
+        cursor.execute("ALTER TABLE final_deals ADD COLUMN track_count INTEGER DEFAULT 0")
+
+    # Перенос существующих списков: итоги уже посчитаны, поэтому вклад перенесённых трек-номеров нулевой
+    cursor.execute("SELECT final_deal_id, track_numbers FROM final_deals WHERE track_numbers IS NOT NULL")
+    rows = [(final_deal_id, track.strip())
+            for final_deal_id, track_numbers in cursor.fetchall()
+            for track in track_numbers.split(",") if track.strip()]
+    cursor.executemany("INSERT OR IGNORE INTO final_deal_tracks (final_deal_id, track_number) VALUES (?, ?)", rows)
+    cursor.execute("""
+    UPDATE final_deals
+    SET track_count = (SELECT COUNT(*) FROM final_deal_tracks t WHERE t.final_deal_id = final_deals.final_deal_id)
+    """)
+
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS final_deal_tracks_after_insert AFTER INSERT ON final_deal_tracks
+    BEGIN
+        UPDATE final_deals
+        SET total_weight = total_weight + NEW.weight,
+            total_amount = total_amount + NEW.amount,
+            number_of_orders = number_of_orders + NEW.number_of_orders,
+            track_count = track_count + 1
+        WHERE final_deal_id = NEW.final_deal_id;
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS final_deal_tracks_after_delete AFTER DELETE ON final_deal_tracks
+    BEGIN
+        UPDATE final_deals
+        SET total_weight = total_weight - OLD.weight,
+            total_amount = total_amount - OLD.amount,
+            number_of_orders = number_of_orders - OLD.number_of_orders,
+            track_count = track_count - 1
+        WHERE final_deal_id = OLD.final_deal_id;
+    END
+    """)
+    # Трек-номера следуют за итоговой сделкой при смене её ID и удаляются вместе с ней
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS final_deals_after_update_id AFTER UPDATE OF final_deal_id ON final_deals
+    BEGIN
+        UPDATE final_deal_tracks SET final_deal_id = NEW.final_deal_id WHERE final_deal_id = OLD.final_deal_id;
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS final_deals_after_delete AFTER DELETE ON final_deals
+    BEGIN
+        DELETE FROM final_deal_tracks WHERE final_deal_id = OLD.final_deal_id;
+    END
+    """)
+
+
+def stage_pipeline(stage_code):
+    """
+    Возвращает ID воронки (категории) Bitrix по коду этапа: "C8:NEW" -> 8, "NEW" -> 0.
+    """
+    prefix, separator, _ = stage_code.partition(":")
+    if separator and prefix.startswith("C") and prefix[1:].isdigit():
+        return int(prefix[1:])
+    return 0
+
+
+def _migration_10_stage_transitions(cursor):
+    """
+    Журнал переходов посылок между этапами. deal_history хранит только последний этап трек-номера,
+    stage_transitions — все переходы: этапы закодированы числами из справочника stages, время — Unix time.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS stages (
+        id INTEGER PRIMARY KEY,
+        code TEXT NOT NULL UNIQUE,         -- Код этапа Bitrix, например C8:PREPAYMENT_INVOICE
+        pipeline INTEGER NOT NULL          -- ID воронки (категории) Bitrix
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS stage_transitions (
+        id INTEGER PRIMARY KEY,
+        track_number TEXT NOT NULL,
+        deal_id INTEGER,
+        stage INTEGER NOT NULL REFERENCES stages (id),
+        ts INTEGER NOT NULL,               -- Время перехода на этап (Unix time)
+        pickup_point TEXT                  -- Пункт выдачи клиента на момент перехода
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stage_transitions_track ON stage_transitions (track_number, ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stage_transitions_stage ON stage_transitions (stage, ts)")
+
+    # Начальное наполнение из deal_history: последний этап и, если была, отгрузка из Китая
+    cursor.execute("SELECT DISTINCT stage_id FROM deal_history WHERE stage_id IS NOT NULL")
+    codes = {row[0] for row in cursor.fetchall()} | {"C8:PREPARATION"}
+    cursor.executemany("INSERT OR IGNORE INTO stages (code, pipeline) VALUES (?, ?)",
+                       [(code, stage_pipeline(code)) for code in codes])
+    pickup_point = """(SELECT c.pickup_point FROM track_numbers t JOIN clients c ON c.chat_id = t.chat_id
+                       WHERE t.track_number = h.track_number)"""
+    cursor.execute(f"""
+    INSERT INTO stage_transitions (track_number, deal_id, stage, ts, pickup_point)
+    SELECT h.track_number, h.deal_id, s.id, CAST(strftime('%s', h.china_shipment_date) AS INTEGER), {pickup_point}
+    FROM deal_history h JOIN stages s ON s.code = 'C8:PREPARATION'
+    WHERE h.china_shipment_date IS NOT NULL AND h.stage_id != 'C8:PREPARATION'
+      AND strftime('%s', h.china_shipment_date) IS NOT NULL
+    """)
+    cursor.execute(f"""
+    INSERT INTO stage_transitions (track_number, deal_id, stage, ts, pickup_point)
+    SELECT h.track_number, h.deal_id, s.id, CAST(strftime('%s', h.original_date_modify) AS INTEGER), {pickup_point}
+    FROM deal_history h JOIN stages s ON s.code = h.stage_id
+    WHERE strftime('%s', h.original_date_modify) IS NOT NULL
+    """)
+
+
+def _migration_11_crm_mirror(cursor):
+    """
+    Локальное зеркало сделок и контактов Bitrix, которое поддерживает crm_sync.
+    crm_sync_state хранит водяной знак (DATE_MODIFY) и позицию постраничной выборки,
+    crm_sync_runs — журнал циклов синхронизации.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS crm_deals (
+        deal_id INTEGER PRIMARY KEY,       -- ID сделки в Bitrix
+        category_id INTEGER,               -- Воронка
+        stage_id TEXT,
+        contact_id INTEGER,
+        track_number TEXT,
+        is_final INTEGER NOT NULL DEFAULT 0,  -- Признак итоговой сделки
+        date_create TEXT,
+        date_modify TEXT,
+        data TEXT NOT NULL,                -- JSON со всеми полями сделки
+        synced_at REAL NOT NULL            -- Время записи в зеркало (Unix time)
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_crm_deals_track_number ON crm_deals (track_number)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_crm_deals_contact ON crm_deals (contact_id)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS crm_contacts (
+        contact_id INTEGER PRIMARY KEY,
+        personal_code TEXT,
+        date_modify TEXT,
+        data TEXT NOT NULL,
+        synced_at REAL NOT NULL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_crm_contacts_personal_code ON crm_contacts (personal_code)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS crm_sync_state (
+        entity TEXT PRIMARY KEY,           -- deal или contact
+        watermark TEXT,                    -- DATE_MODIFY, с которого выбираются записи текущего прохода
+        pass_started_at REAL,              -- Начало текущего прохода (Unix time), NULL — проход не начат
+        last_id INTEGER NOT NULL DEFAULT 0,  -- Последний полученный ID текущего прохода
+        synced_at REAL                     -- Начало последнего завершённого прохода: зеркало актуально на этот момент
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS crm_sync_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        entity TEXT NOT NULL,
+        started_at REAL NOT NULL,
+        finished_at REAL,
+        pages INTEGER NOT NULL DEFAULT 0,
+        rows INTEGER NOT NULL DEFAULT 0,
+        watermark TEXT,                    -- Водяной знак после цикла
+        lag_seconds REAL,                  -- Отставание зеркала от Bitrix после цикла
+        error TEXT
+    )
+    """)
+
+
+def _migration_12_outbox(cursor):
+    """
+    Очередь исходящих операций Bitrix (transactional outbox) в таблице processed_results.
+    Строка — одна команда batch-запроса: operation_key — ключ операции OperationsBuilder, action — метод Bitrix,
+    data — команда в виде JSON-строки. sent: 0 — ожидает отправки, 1 — выполнена, 2 — исчерпаны попытки,
+    3 — заменена более новой операцией с тем же ключом.
+    """
+    if not _column_exists(cursor, "processed_results", "operation_key"):
+        cursor.execute("ALTER TABLE processed_results ADD COLUMN operation_key TEXT")
+    if not _column_exists(cursor, "processed_results", "attempts"):
+        cursor.execute("ALTER TABLE processed_results ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    if not _column_exists(cursor, "processed_results", "next_attempt_at"):
+        cursor.execute("ALTER TABLE processed_results ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0")
+    if not _column_exists(cursor, "processed_results", "last_error"):
+        cursor.execute("ALTER TABLE processed_results ADD COLUMN last_error TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_processed_results_next_attempt "
+                   "ON processed_results (sent, next_attempt_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_processed_results_operation_key "
+                   "ON processed_results (operation_key, sent)")
+    cursor.execute("""
+    CREATE VIEW IF NOT EXISTS outbox_dead_letters AS
+    SELECT id, operation_key, action, data, event_type AS source, attempts, last_error, timestamp
+    FROM processed_results
+    WHERE sent = 2
+    """)
+
+
+def _migration_13_fsm_version(cursor):
+    """
+    Номер версии записи FSM: увеличивается при каждом изменении, чтобы процесс бота мог проверить,
+    не изменил ли запись в кэше другой процесс, не перечитывая её целиком.
+    """
+    if not _column_exists(cursor, "fsm_storage", "version"):
+        cursor.execute("ALTER TABLE fsm_storage ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+
+MIGRATIONS = [
+    _migration_1_lookup_indexes,
+    _migration_2_deal_history_china_shipment_date,
+    _migration_3_coalesce_pending_webhooks,
+    _migration_4_deal_cache,
+    _migration_5_broadcasts,
+    _migration_6_webhook_leases,
+    _migration_7_fsm_storage,
+    _migration_8_free_code_pool,
+    _migration_9_final_deal_tracks,
+    _migration_10_stage_transitions,
+    _migration_11_crm_mirror,
+    _migration_12_outbox,
+    _migration_13_fsm_version,
+]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def run_migrations(conn):
+    """
+    Применяет все миграции, номер которых больше текущего PRAGMA user_version.
+    Каждая миграция и обновление user_version фиксируются одной транзакцией.
+    """
+    current_version = get_schema_version(conn)
+    target_version = len(MIGRATIONS)
+
+    if current_version > target_version:
+        logging.warning(f"Версия схемы базы ({current_version}) новее известной приложению ({target_version}).")
+        return current_version
+
+    for version in range(current_version + 1, target_version + 1):
+        migration = MIGRATIONS[version - 1]
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN")
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+            logging.info(f"Применена миграция схемы {version}: {migration.__name__}")
+        except sqlite3.Error as e:
+            conn.rollback()
+            logging.error(f"Ошибка при применении миграции {version} ({migration.__name__}): {e}")
+            raise
+
+    return target_version
+
+
+# ========== Проверка планов запросов ==========
+# Частые запросы (db_management.HOT_QUERIES и тела триггеров) должны выполняться через индекс. Если план запроса
+# содержит полный просмотр таблицы (SCAN) или временное B-дерево для сортировки, при старте пишется предупреждение,
+# а тест tests/test_query_plans.py падает.
+
+def trigger_queries(conn):
+    """
+    Возвращает выражения из тел триггеров базы в виде {"имя_триггера[номер]": (sql, параметры)}.
+    Ссылки NEW.колонка и OLD.колонка заменяются параметрами, чтобы план можно было получить через EXPLAIN.
+    """
+    queries = {}
+    for name, sql in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' ORDER BY name"):
+        body = sql[sql.upper().index("BEGIN") + len("BEGIN"):sql.upper().rindex("END")]
+        statements = [statement.strip() for statement in body.split(";") if statement.strip()]
+        for number, statement in enumerate(statements):
+            statement = re.sub(r"\b(?:NEW|OLD)\.\w+", "?", statement, flags=re.IGNORECASE)
+            queries[f"{name}[{number}]"] = (statement, (None,) * statement.count("?"))
+    return queries
+
+
+def find_full_scans(conn, queries):
+    """
+    Возвращает словарь {имя запроса: [строки плана]} для запросов {имя: (sql, параметры)}, план которых
+    содержит полный просмотр таблицы или сортировку во временном B-дереве.
+    """
+    problems = {}
+    for name, (sql, params) in queries.items():
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+        bad_steps = [step for step in plan if step.startswith("SCAN") or "TEMP B-TREE" in step]
+        if bad_steps:
+            problems[name] = bad_steps
+    return problems
+
+
+def check_query_plans(conn, queries):
+    """
+    Проверяет планы запросов queries и выражений триггеров и логирует те, что не используют индекс.
+    Возвращает True, если все запросы используют индексы.
+    """
+    problems = find_full_scans(conn, {**queries, **trigger_queries(conn)})
+    for name, steps in problems.items():
+        logging.warning(f"Запрос {name} выполняется без индекса: {'; '.join(steps)}")
+    if not problems:
+        logging.info("Планы частых запросов используют индексы.")
+    return not problems
@@ -0,0 +1,84 @@
+import logging
+import sqlite3
+import threading
+from config import DATABASE_PATH
+
+
+# Параметры соединений с базой данных
+STATEMENT_CACHE_SIZE = 256           # Количество подготовленных выражений, кэшируемых на одно соединение
+BUSY_TIMEOUT = 5.0                   # Сколько секунд ждать снятия блокировки, удерживаемой другим соединением
+CACHE_SIZE_KIB = 20000               # Размер страничного кэша соединения в КиБ
+MMAP_SIZE = 256 * 1024 * 1024        # Объём файла базы, отображаемый в память
+
+_local = threading.local()
+_connections = []                    # Все открытые соединения (для закрытия при остановке)
+_connections_lock = threading.Lock()
+_generation = 0                      # Увеличивается при закрытии пула, чтобы потоки открыли соединения заново
+
+
+def _apply_connection_pragmas(conn):
+    """
+    Применяет PRAGMA, которые действуют в пределах одного соединения.
+    Вызывается один раз при открытии соединения, а не на каждый запрос.
+    """
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}")
+
+
+def configure_database(conn):
+    """
+    Настройки, которые сохраняются в самом файле базы.
+    Выполняется один раз при старте приложения из init_db.
+    """
+    journal_mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+    if journal_mode.lower() != "wal":
+        logging.warning(f"Не удалось включить WAL, текущий режим журнала: {journal_mode}")
+    else:
+        logging.info("База данных работает в режиме WAL.")
+
+
+def get_connection():
+    """
+    Возвращает долгоживущее соединение текущего потока.
+
+    Соединение открывается при первом обращении и затем переиспользуется
+    всеми функциями db_management в этом потоке вместе с кэшем подготовленных выражений.
+    Если предыдущий вызов оставил незавершённую транзакцию (например, из-за исключения),
+    она откатывается, чтобы каждая операция начиналась с чистого состояния.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "generation", None) != _generation:
+        conn = sqlite3.connect(
+            DATABASE_PATH,
+            timeout=BUSY_TIMEOUT,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            check_same_thread=False  # Соединение используется только своим потоком, флаг нужен для close_all_connections
+        )
+        _apply_connection_pragmas(conn)
+        _local.conn = conn
+        _local.generation = _generation
+        with _connections_lock:
+            _connections.append(conn)
+        logging.debug(f"Открыто новое соединение с базой данных для потока {threading.current_thread().name}")
+    elif conn.in_transaction:
+        logging.warning("Обнаружена незавершённая транзакция в соединении потока. Выполняется откат.")
+        conn.rollback()
+    return conn
+
+
+def close_all_connections():
+    """
+    Закрывает все соединения, открытые пулом. Вызывается при остановке приложения.
+    """
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        while _connections:
+            conn = _connections.pop()
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logging.error(f"Ошибка при закрытии соединения с базой данных: {e}")
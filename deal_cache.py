@@ -0,0 +1,37 @@
+import logging
+from bitrix_integration import get_deals_by_track, get_deal_info
+from db_async import cache_track_deals, cache_deals, get_cached_deals_by_track, get_cached_deal
+
+
+# Сколько секунд запись кэша считается актуальной, если по сделке не пришёл вебхук
+DEAL_CACHE_TTL = 10 * 60
+
+
+async def get_deals_by_track_cached(track_number):
+    """
+    Возвращает сделки по трек-номеру из локального кэша, при отсутствии или устаревании — из Bitrix.
+    Кэш заполняется пакетной обработкой вебхуков и сбрасывается вебхуками по сделкам.
+    """
+    deals = await get_cached_deals_by_track(track_number, DEAL_CACHE_TTL)
+    if deals is not None:
+        logging.info(f"Сделки по трек-номеру {track_number} получены из кэша.")
+        return deals
+
+    deals = await get_deals_by_track(track_number)
+    if deals:
+        await cache_track_deals(track_number, deals)
+    return deals
+
+
+async def get_deal_info_cached(deal_id):
+    """
+    Возвращает данные сделки из локального кэша, при отсутствии или устаревании — из Bitrix.
+    """
+    deal_info = await get_cached_deal(deal_id, DEAL_CACHE_TTL)
+    if deal_info is not None:
+        return deal_info
+
+    deal_info = await get_deal_info(deal_id)
+    if deal_info:
+        await cache_deals([deal_info])
+    return deal_info
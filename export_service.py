@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from openpyxl import Workbook
+from config import DATABASE_PATH
+
+
+# Таблицы, доступные для выгрузки. Каждая попадает на отдельный лист книги.
+EXPORT_TABLES = ["clients", "track_numbers", "tracked_deals", "final_deals", "final_deal_tracks"]
+EXPORT_FETCH_SIZE = 1000   # Сколько строк читается из базы за один раз
+
+# Выгрузка выполняется в отдельном потоке со своим соединением только для чтения, чтобы формирование файла
+# не занимало цикл событий и поток базы данных бота. Отдельный процесс (spawn) не используется:
+# он заново импортировал бы main.py и создавал в каждом процессе выгрузки бота, диспетчер и сервер.
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+    return _executor
+
+
+def shutdown_export_executor():
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _build_query(conn, table, filters):
+    """
+    Собирает запрос выгрузки таблицы. Фильтры применяются только к колонкам, которые есть в таблице.
+    """
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    conditions, params = [], []
+    for column, value in (filters or {}).items():
+        if column in columns:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    query = f"SELECT * FROM {table}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return query, params
+
+
+def write_export(database_path, output_file, tables, filters=None):
+    """
+    Построчно выгружает таблицы в xlsx (openpyxl в режиме write-only), не загружая их в память целиком.
+    Выполняется в потоке выгрузки. Возвращает словарь {таблица: количество строк}.
+    """
+    conn = sqlite3.connect(f"file:{database_path}?mode=ro", uri=True)
+    workbook = Workbook(write_only=True)
+    counts = {}
+    try:
+        for table in tables:
+            sheet = workbook.create_sheet(title=table)
+            query, params = _build_query(conn, table, filters)
+            cursor = conn.execute(query, params)
+            sheet.append([column[0] for column in cursor.description])
+            counts[table] = 0
+            while True:
+                rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    sheet.append(row)
+                counts[table] += len(rows)
+        workbook.save(output_file)
+    finally:
+        conn.close()
+    return counts
+
+
+def parse_export_args(args):
+    """
+    Разбирает аргументы команды /export_db: имена таблиц и фильтры вида колонка=значение.
+    Возвращает кортеж (tables, filters, unknown), где unknown — нераспознанные имена таблиц.
+    """
+    tables, filters, unknown = [], {}, []
+    for arg in args:
+        if "=" in arg:
+            column, _, value = arg.partition("=")
+            filters[column] = value
+        elif arg in EXPORT_TABLES:
+            tables.append(arg)
+        else:
+            unknown.append(arg)
+    return tables or list(EXPORT_TABLES), filters, unknown
+
+
+async def export_tables(tables=None, filters=None):
+    """
+    Выгружает таблицы в xlsx-файл рядом с базой данных в отдельном потоке.
+    Возвращает кортеж (путь к файлу, {таблица: количество строк}). Если выгрузка не удалась,
+    недописанный файл удаляется.
+    """
+    tables = tables or list(EXPORT_TABLES)
+    output_file = os.path.join(os.path.dirname(DATABASE_PATH), f"export-{datetime.now():%Y%m%d-%H%M%S}.xlsx")
+    loop = asyncio.get_running_loop()
+    try:
+        counts = await loop.run_in_executor(_get_executor(), write_export, DATABASE_PATH, output_file, tables, filters)
+    except Exception:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        raise
+    logging.info(f"Выгрузка базы данных в {output_file} завершена: {counts}")
+    return output_file, counts
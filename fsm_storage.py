@@ -0,0 +1,86 @@
+import logging
+import time
+from collections import OrderedDict
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from config import REDIS_URL
+from db_async import get_fsm_record, get_fsm_version, set_fsm_state, set_fsm_data
+
+
+FSM_CACHE_SIZE = 10000   # Сколько пользователей держать в памяти
+FSM_CACHE_TTL = 300      # Через сколько секунд запись в памяти перечитывается из базы целиком
+
+
+def _make_key(key: StorageKey) -> str:
+    parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+    if key.thread_id:
+        parts.append(str(key.thread_id))
+    if key.business_connection_id:
+        parts.append(str(key.business_connection_id))
+    parts.append(key.destiny)
+    return ":".join(parts)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM aiogram в таблице fsm_storage с кэшем последних пользователей в памяти.
+
+    Запись сразу попадает в базу (write-through), поэтому состояние переживает перезапуск.
+    Кэш ограничен FSM_CACHE_SIZE записями (вытесняются давно не использованные),
+    а каждая запись живёт в памяти не дольше FSM_CACHE_TTL секунд.
+    Перед использованием записи из кэша её версия сверяется с базой (чтение по первичному ключу
+    без разбора JSON), поэтому несколько процессов бота с одним файлом базы видят изменения друг друга сразу.
+    """
+
+    def __init__(self, max_size=FSM_CACHE_SIZE, ttl=FSM_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache = OrderedDict()  # ключ -> (state, data, version, expires_at)
+
+    def _remember(self, key, state, data, version):
+        self._cache[key] = (state, data, version, time.monotonic() + self.ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key):
+        entry = self._cache.get(key)
+        if entry is not None and entry[3] > time.monotonic() and await get_fsm_version(key) == entry[2]:
+            self._cache.move_to_end(key)
+            return entry[0], entry[1]
+        state, data, version = await get_fsm_record(key)
+        self._remember(key, state, data, version)
+        return state, data
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        storage_key = _make_key(key)
+        state = state.state if isinstance(state, State) else state
+        self._remember(storage_key, *await set_fsm_state(storage_key, state))
+
+    async def get_state(self, key: StorageKey):
+        state, _ = await self._load(_make_key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        storage_key = _make_key(key)
+        self._remember(storage_key, *await set_fsm_data(storage_key, dict(data)))
+
+    async def get_data(self, key: StorageKey):
+        _, data = await self._load(_make_key(key))
+        return dict(data)  # Копия, чтобы изменения обработчика не попадали в кэш без set_data
+
+    async def close(self) -> None:
+        self._cache.clear()
+
+
+def create_fsm_storage():
+    """
+    Возвращает хранилище FSM: Redis, если задан REDIS_URL, иначе SQLiteStorage.
+    Redis общий для всех процессов бота и сам держит данные в памяти, поэтому локальный кэш перед ним не нужен.
+    """
+    if REDIS_URL:
+        from aiogram.fsm.storage.redis import RedisStorage
+        logging.info("Состояния FSM хранятся в Redis.")
+        return RedisStorage.from_url(REDIS_URL)
+    logging.info("Состояния FSM хранятся в SQLite.")
+    return SQLiteStorage()
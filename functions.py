@@ -1,8 +1,5 @@
 import re
-import sqlite3
-import pandas as pd
 from datetime import datetime
-from config import DATABASE_PATH
 
 
 def transliterate(string):
@@ -125,20 +122,6 @@ def generate_address_instructions(name_cyrillic, personal_code, name_translit, p
     return instructions.get(pickup_point_code, "Пункт выдачи не указан или не поддерживается.")
 
 
-def export_database_to_excel():
-    conn = sqlite3.connect(DATABASE_PATH)
-
-    table_name = "clients"
-    query = f"SELECT * FROM {table_name}"
-    df = pd.read_sql_query(query, conn)
-
-    output_file = "/data/output.xlsx"
-    df.to_excel(output_file, index=False, engine='openpyxl')
-
-    conn.close()
-    return output_file
-
-
 def trim_time_from_iso(iso_str):
     return datetime.fromisoformat(iso_str).date().isoformat() if iso_str else None
 
@@ -2,7 +2,7 @@ import logging
 from aiogram import Router, F
 from aiogram.types import CallbackQuery
 from aiogram.fsm.context import FSMContext
-from db_management import get_client_by_chat_id
+from db_async import get_client_by_chat_id
 from keyboards import create_menu_button
 from handlers.utils import send_and_delete_previous
 
@@ -21,7 +21,7 @@ async def process_create_instructions(callback: CallbackQuery, state: FSMContext
     logging.info(f'{chat_id}')
 
     # Извлекаем данные пользователя из базы
-    user_data = get_client_by_chat_id(chat_id)
+    user_data = await get_client_by_chat_id(chat_id)
     contact_id = user_data.get('contact_id')
     personal_code = user_data.get('personal_code')
     name_cyrillic = user_data.get('name_cyrillic')
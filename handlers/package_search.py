@@ -4,10 +4,11 @@ from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
-from db_management import get_client_by_chat_id, get_track_numbers_by_chat_id, update_track_number, \
+from db_async import get_client_by_chat_id, get_track_numbers_by_chat_id, update_track_number, \
     delete_deal_by_track_number, update_track_number_in_all_tables, get_name_track_by_track_number, \
-    get_original_date_by_track
-from bitrix_integration import get_deals_by_track, delete_deal, update_tracked_deal_in_bitrix, get_deal_info
+    get_original_date_by_track, invalidate_cached_track, get_final_deal_track_numbers
+from bitrix_integration import get_deals_by_track, delete_deal, update_tracked_deal_in_bitrix
+from deal_cache import get_deals_by_track_cached, get_deal_info_cached
 from keyboards import create_tracking_keyboard, create_management_keyboard, create_menu_button, \
     create_single_track_management_keyboard
 from states import Track
@@ -39,10 +40,10 @@ async def process_tracking_search(callback: CallbackQuery, state: FSMContext):
     """
     await send_and_delete_previous(callback.message, "Ищем ваши посылки...", state=state)
     chat_id = callback.message.chat.id
-    user_data = get_client_by_chat_id(chat_id)
+    user_data = await get_client_by_chat_id(chat_id)
 
     if user_data:
-        track_numbers = get_track_numbers_by_chat_id(chat_id)
+        track_numbers = await get_track_numbers_by_chat_id(chat_id)
         if track_numbers:
             track_number_list = [(track[0], track[1]) for track in track_numbers]
             await send_and_delete_previous(
@@ -74,10 +75,10 @@ async def process_management_search(callback: CallbackQuery, state: FSMContext):
     """
     await send_and_delete_previous(callback.message, "Загружаем список трек-номеров...", state=state)
     chat_id = callback.message.chat.id
-    user_data = get_client_by_chat_id(chat_id)
+    user_data = await get_client_by_chat_id(chat_id)
 
     if user_data:
-        track_numbers = get_track_numbers_by_chat_id(chat_id)
+        track_numbers = await get_track_numbers_by_chat_id(chat_id)
         if track_numbers:
             track_number_list = [(track[0], track[1]) for track in track_numbers]
             await send_and_delete_previous(
@@ -105,7 +106,7 @@ async def process_management_search(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(lambda callback: callback.data.startswith("backtrack_"))
 async def handle_track_status(callback: CallbackQuery, state: FSMContext):
     track_number = callback.data.split("_")[1]
-    deals = get_deals_by_track(track_number)
+    deals = await get_deals_by_track_cached(track_number)
 
     if not deals:
         await callback.answer("📦 Сделки с этим трек-номером не найдены.", show_alert=True)
@@ -115,7 +116,7 @@ async def handle_track_status(callback: CallbackQuery, state: FSMContext):
     deal_status = last_deal.get('STAGE_ID', 'Неизвестный статус')
 
     # Получаем дату из истории сделки, если она есть, иначе из последней сделки
-    deal_history = get_original_date_by_track(track_number)
+    deal_history = await get_original_date_by_track(track_number)
     if deal_history:
         last_modified_raw, saved_stage_id, china_shipment_date_raw = deal_history
     else:
@@ -135,13 +136,16 @@ async def handle_track_status(callback: CallbackQuery, state: FSMContext):
         "C2:NEW": "🎁 Прибыл в ПВ Астана ALMATINSKIY"
     }
     deal_status_text = status_code_list.get(deal_status, "🎁 Упакован и ожидает выдачи")
-    name_track = get_name_track_by_track_number(track_number)
-    deal_info = await get_deal_info(last_deal['ID'])
+    name_track = await get_name_track_by_track_number(track_number)
+    deal_info = await get_deal_info_cached(last_deal['ID'])
 
     if deal_info.get('UF_CRM_1729539412') == '1':
-        # Если сделка итоговая, выводим только список готовых трек-номеров
-        track_numbers = deal_info.get('UF_CRM_1729115312')
-        ready_track_numbers = [item.strip() for item in track_numbers.split(",") if item.strip()]
+        # Если сделка итоговая, выводим только список готовых трек-номеров (из локальной базы,
+        # для итоговых сделок, которых в ней нет, — из поля сделки)
+        ready_track_numbers = await get_final_deal_track_numbers(last_deal['ID'])
+        if not ready_track_numbers:
+            track_numbers = deal_info.get('UF_CRM_1729115312') or ''
+            ready_track_numbers = [item.strip() for item in track_numbers.split(",") if item.strip()]
         ready_parcels_text = "\n".join(ready_track_numbers)
         alert_text = (
             f"📦 Информация о посылке:\n"
@@ -185,7 +189,7 @@ async def handle_track_status(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.startswith("manage_single_track_"))
 async def manage_single_track(callback: CallbackQuery, state: FSMContext):
     track_number = callback.data.split("_")[3]
-    track_name = get_name_track_by_track_number(track_number)  # Получаем имя
+    track_name = await get_name_track_by_track_number(track_number)  # Получаем имя
 
     if not track_name:
         track_name = "Неизвестный трек"
@@ -215,10 +219,10 @@ async def process_track_name_input(message: Message, state: FSMContext):
     chat_id = message.chat.id
 
     # ✅ Обновляем название в базе
-    update_track_number(track_number, new_track_name, chat_id)
+    await update_track_number(track_number, new_track_name, chat_id)
 
     # ✅ Получаем обновлённое название из БД
-    updated_track_name = get_name_track_by_track_number(track_number)
+    updated_track_name = await get_name_track_by_track_number(track_number)
 
     keyboard = InlineKeyboardBuilder()
 
@@ -260,7 +264,7 @@ async def process_track_name_input(message: Message, state: FSMContext):
 async def process_track_number_edit(callback: CallbackQuery, state: FSMContext):
     track_number = callback.data.split("_", maxsplit=2)[2]
 
-    deals = get_deals_by_track(track_number)
+    deals = await get_deals_by_track(track_number)
     if deals:
         last_deal = deals[0]
         deal_status = last_deal.get('STAGE_ID', None)
@@ -304,7 +308,7 @@ async def process_track_number_input(message: Message, state: FSMContext):
         )
         return
 
-    existing_deal = get_deals_by_track(new_track_number)
+    existing_deal = await get_deals_by_track(new_track_number)
     if existing_deal:
         await send_and_delete_previous(
             message,
@@ -314,8 +318,9 @@ async def process_track_number_input(message: Message, state: FSMContext):
         return
 
     try:
-        update_track_number_in_all_tables(old_track_number, new_track_number, chat_id)
-        update_tracked_deal_in_bitrix(old_track_number, new_track_number)
+        await update_track_number_in_all_tables(old_track_number, new_track_number, chat_id)
+        await update_tracked_deal_in_bitrix(old_track_number, new_track_number)
+        await invalidate_cached_track(old_track_number)
         # Создаем кастомную клавиатуру
         keyboard = InlineKeyboardBuilder()
         keyboard.row(
@@ -354,7 +359,7 @@ async def process_delete_track(callback: CallbackQuery):
     track_number = callback.data.split("_")[2]  # Здесь точно получаем номер
     logging.info(f"⏳ Начало удаления трек-номера: {track_number}")
 
-    deals = get_deals_by_track(track_number)
+    deals = await get_deals_by_track(track_number)
 
     if not deals:
         logging.warning(f"❌ Сделка с трек-номером {track_number} не найдена в Bitrix.")
@@ -379,9 +384,10 @@ async def process_delete_track(callback: CallbackQuery):
             )
             return
 
-        delete_result = delete_deal(deal_id)
+        delete_result = await delete_deal(deal_id)
         if delete_result:
             logging.info(f"✅ Сделка ID {deal_id} ({track_number}) успешно удалена из Bitrix.")
+            await invalidate_cached_track(track_number)
         else:
             logging.error(f"🚨 Ошибка при удалении сделки {deal_id} ({track_number}) в Bitrix!")
             await send_and_delete_previous(
@@ -396,7 +402,7 @@ async def process_delete_track(callback: CallbackQuery):
     logging.info(f"✅ Локальная запись трек-номера {track_number} удалена.")
 
     # Обновляем список треков без удаленного
-    track_data = get_track_numbers_by_chat_id(callback.message.chat.id)  # Получаем все треки пользователя
+    track_data = await get_track_numbers_by_chat_id(callback.message.chat.id)  # Получаем все треки пользователя
     # Используем клавиатуру управления трек-номерами
     keyboard = create_management_keyboard(track_data)
 
@@ -2,7 +2,7 @@ import logging
 from aiogram import Router, F
 from aiogram.types import CallbackQuery
 from aiogram.fsm.context import FSMContext
-from db_management import get_client_by_chat_id
+from db_async import get_client_by_chat_id
 from keyboards import create_settings_keyboard, create_contact_keyboard, create_menu_button
 from states import Upd
 from handlers.utils import send_and_delete_previous
@@ -24,7 +24,7 @@ async def call_settings(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "show_contact_info")
 async def show_contact_info(callback: CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
-    user_data = get_client_by_chat_id(chat_id)
+    user_data = await get_client_by_chat_id(chat_id)
     name_cyrillic = user_data.get("name_cyrillic")
     phone = user_data.get("phone")
     city = user_data.get("city")
@@ -2,8 +2,10 @@ import logging
 from aiogram import Router
 from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
-from bitrix_integration import create_deal, get_deals_by_track, update_deal_contact, create_deal_with_stage, delete_deal
-from db_management import get_client_by_chat_id, save_track_number, save_deal_to_db, get_track_from_db, save_deal_history
+from bitrix_integration import create_deal, update_deal_contact, create_deal_with_stage, delete_deal
+from db_async import get_client_by_chat_id, save_track_number, save_deal_to_db, get_track_from_db, save_deal_history, \
+    invalidate_cached_track
+from deal_cache import get_deals_by_track_cached
 from keyboards import create_menu_button, create_track_added_keyboard
 from states import Track, Menu
 from functions import trim_time_from_iso
@@ -34,7 +36,7 @@ async def process_track_number(message: Message, state: FSMContext):
         return
 
     # Проверка на существование в локальной базе
-    existing_track = get_track_from_db(track_number)  # Реализуйте функцию получения записи
+    existing_track = await get_track_from_db(track_number)  # Реализуйте функцию получения записи
     if existing_track:
         await send_and_delete_previous(
             message,
@@ -43,7 +45,7 @@ async def process_track_number(message: Message, state: FSMContext):
         )
         return
 
-    deals = get_deals_by_track(track_number)
+    deals = await get_deals_by_track_cached(track_number)
     logging.info(f"Сделки, найденные по трек-номеру: {deals}")
 
     if deals:
@@ -54,7 +56,7 @@ async def process_track_number(message: Message, state: FSMContext):
         raw_date = last_deal.get("UF_CRM_1743357179") or last_deal.get("DATE_MODIFY")
         date_modify = trim_time_from_iso(raw_date)
         chat_id = message.chat.id
-        user_data = get_client_by_chat_id(chat_id)
+        user_data = await get_client_by_chat_id(chat_id)
         user_contact_id = str(user_data.get('contact_id'))
         personal_code = user_data.get('personal_code')
         name_translit = user_data.get('name_translit')
@@ -76,7 +78,7 @@ async def process_track_number(message: Message, state: FSMContext):
             logging.info(
                 f"Контакт совпадает. Создаем новую сделку на этапе {pipeline_stage} и удаляем старую сделку ID {last_deal['ID']}")
 
-            new_deal_id = create_deal_with_stage(
+            new_deal_id = await create_deal_with_stage(
                 contact_id=user_contact_id,
                 track_number=track_number,
                 personal_code=personal_code,
@@ -91,7 +93,7 @@ async def process_track_number(message: Message, state: FSMContext):
             # Устанавливаем значение для china_shipment_date только если stage_id == "C8:PREPARATION"
             china_date = date_modify if pipeline_stage == "C8:PREPARATION" else None
 
-            save_deal_history(
+            await save_deal_history(
                 deal_id=new_deal_id,
                 track_number=track_number,
                 original_date_modify=date_modify,  # Сохраняем дату изменения сделки
@@ -101,7 +103,7 @@ async def process_track_number(message: Message, state: FSMContext):
 
             if new_deal_id:
                 logging.info(f"Новая сделка создана с ID: {new_deal_id}. Удаляем старую сделку ID {last_deal['ID']}")
-                save_deal_to_db(
+                await save_deal_to_db(
                     deal_id=new_deal_id,
                     contact_id=user_contact_id,
                     personal_code=personal_code,
@@ -110,7 +112,8 @@ async def process_track_number(message: Message, state: FSMContext):
                     phone=phone,
                     chat_id=chat_id
                 )
-                delete_result = delete_deal(last_deal['ID'])
+                delete_result = await delete_deal(last_deal['ID'])
+                await invalidate_cached_track(track_number)
                 if delete_result:
                     logging.info(f"Старая сделка с ID {last_deal['ID']} успешно удалена.")
                     await send_and_delete_previous(
@@ -135,12 +138,13 @@ async def process_track_number(message: Message, state: FSMContext):
                 )
         elif not deal_contact:
             logging.info(f"Сделка с трек-номером {track_number} без привязанного контакта. Обновляем контакт.")
-            update_result = update_deal_contact(last_deal['ID'], user_contact_id, personal_code, name_translit, chat_id,
-                                                phone, city, pickup_point)
+            update_result = await update_deal_contact(last_deal['ID'], user_contact_id, personal_code, name_translit, chat_id,
+                                                      phone, city, pickup_point)
+            await invalidate_cached_track(track_number)
 
             if update_result:
                 logging.info(f"Сделка обновлена: контакт {user_contact_id} добавлен к сделке {last_deal['ID']}")
-                save_deal_to_db(
+                await save_deal_to_db(
                     deal_id=last_deal['ID'],
                     contact_id=user_contact_id,
                     personal_code=personal_code,
@@ -153,7 +157,7 @@ async def process_track_number(message: Message, state: FSMContext):
                 # Определяем значение china_shipment_date для обновляемой сделки
                 china_date = date_modify if pipeline_stage == "C8:PREPARATION" else None
 
-                save_deal_history(
+                await save_deal_history(
                     deal_id=last_deal['ID'],
                     track_number=track_number,
                     original_date_modify=date_modify,  # Сохраняем дату изменения
@@ -176,16 +180,16 @@ async def process_track_number(message: Message, state: FSMContext):
                 )
     else:
         chat_id = message.chat.id
-        user_data = get_client_by_chat_id(chat_id)
+        user_data = await get_client_by_chat_id(chat_id)
         contact_id = user_data.get('contact_id')
         personal_code = user_data.get('personal_code')
         pickup_point = user_data.get('pickup_point')
         phone = user_data.get('phone')
 
         if user_data:
-            deal_id = create_deal(contact_id, personal_code, track_number, pickup_point, phone, chat_id)
+            deal_id = await create_deal(contact_id, personal_code, track_number, pickup_point, phone, chat_id)
             if deal_id:
-                save_deal_to_db(
+                await save_deal_to_db(
                     deal_id=deal_id,
                     contact_id=contact_id,
                     personal_code=personal_code,
@@ -228,7 +232,7 @@ async def process_track_name_input(message: Message, state: FSMContext):
     track_name = message.text.strip()
     chat_id = message.chat.id
 
-    save_track_number(track_number, track_name, chat_id)
+    await save_track_number(track_number, track_name, chat_id)
     await send_and_delete_previous(
         message,
         f"📄 Трек-номер {track_number} с названием '{track_name}' успешно добавлен!",
@@ -4,7 +4,7 @@ from aiogram import Router
 from aiogram.types import CallbackQuery, Message
 from aiogram.filters.command import Command
 from aiogram.fsm.context import FSMContext
-from db_management import save_client_data, check_chat_id_exists, generate_unique_code, get_chat_id_by_phone
+from db_async import save_client_data, check_chat_id_exists, generate_unique_code, get_chat_id_by_phone
 from handlers.menu_handling import show_inline_menu
 from functions import transliterate, format_phone, validate_phone, generate_address_instructions
 from keyboards import create_inline_main_menu, create_city_keyboard, create_pickup_keyboard, create_yes_no_keyboard
@@ -29,7 +29,7 @@ async def send_welcome(message: Message, state: FSMContext):
     await state.clear()
     chat_id = message.chat.id
 
-    if check_chat_id_exists(chat_id):
+    if await check_chat_id_exists(chat_id):
         await send_and_delete_previous(
             message,
             "Здравствуйте! \nКонтакт с Вашими данными уже зарегистрирован в системе. \nХотите обновить данные?",
@@ -87,7 +87,7 @@ async def process_phone(message: Message, state: FSMContext):
     phone = format_phone(message.text)
     if validate_phone(phone):
         # Проверяем, существует ли пользователь с таким номером телефона
-        existing_chat_id = get_chat_id_by_phone(phone)
+        existing_chat_id = await get_chat_id_by_phone(phone)
         if existing_chat_id and existing_chat_id != message.chat.id:
             await send_and_delete_previous(
                 message,
@@ -149,11 +149,21 @@ async def process_pickup(callback: CallbackQuery, state: FSMContext):
     name_translit = user_data.get('name_translit')
     phone = user_data.get('phone')
     city = user_data.get('city')
-    personal_code = generate_unique_code()
+    personal_code = await generate_unique_code()
+    if personal_code is None:
+        # Без кода нельзя создавать контакт в Bitrix и запись клиента: регистрация прерывается до них
+        logging.error(f"Не удалось выдать персональный код при регистрации chat_id={chat_id}.")
+        await send_and_delete_previous(
+            callback.message,
+            "⚠️ Не удалось завершить регистрацию. Пожалуйста, попробуйте выбрать пункт выдачи ещё раз позже.",
+            reply_markup=create_pickup_keyboard(city),
+            state=state
+        )
+        return
 
-    contact_id = create_contact(name_translit, personal_code, phone, city, pickup_point)
+    contact_id = await create_contact(name_translit, personal_code, phone, city, pickup_point)
     await state.update_data(contact_id=contact_id)
-    save_client_data(
+    await save_client_data(
         chat_id=chat_id,
         contact_id=contact_id,
         personal_code=personal_code,
@@ -2,7 +2,7 @@ import logging
 from aiogram import Router
 from aiogram.types import CallbackQuery, Message
 from aiogram.fsm.context import FSMContext
-from db_management import update_client_data, get_client_by_chat_id, get_chat_id_by_phone
+from db_async import update_client_data, get_client_by_chat_id, get_chat_id_by_phone
 from handlers.menu_handling import show_inline_menu
 from functions import transliterate, format_phone, validate_phone, generate_address_instructions
 from keyboards import create_inline_main_menu, create_city_keyboard, create_pickup_keyboard, create_menu_button
@@ -51,7 +51,7 @@ async def process_update_phone(message: Message, state: FSMContext):
     phone = format_phone(message.text)
     if validate_phone(phone):
         # Проверяем, существует ли пользователь с таким номером телефона
-        existing_chat_id = get_chat_id_by_phone(phone)
+        existing_chat_id = await get_chat_id_by_phone(phone)
         if existing_chat_id and existing_chat_id != message.chat.id:
             await send_and_delete_previous(
                 message,
@@ -113,14 +113,14 @@ async def process_update_pickup(callback: CallbackQuery, state: FSMContext):
     name_translit = user_data.get('name_translit')
     phone = user_data.get('phone')
     city = user_data.get('city')
-    old_client_data = get_client_by_chat_id(chat_id)
+    old_client_data = await get_client_by_chat_id(chat_id)
     personal_code = old_client_data.get('personal_code')
     contact_id = str(old_client_data["contact_id"])
 
     # Обновление данных клиента
-    update_contact(contact_id, name_translit, personal_code, phone, city, pickup_point)
+    await update_contact(contact_id, name_translit, personal_code, phone, city, pickup_point)
     await state.update_data(contact_id=contact_id)
-    update_client_data(
+    await update_client_data(
         chat_id=chat_id,
         contact_id=contact_id,
         personal_code=personal_code,
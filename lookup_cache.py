@@ -0,0 +1,119 @@
+import copy
+import functools
+import inspect
+import time
+from collections import OrderedDict
+
+
+class LookupCache:
+    """
+    Ограниченный по размеру кэш результатов запросов к базе с вытеснением давно не использованных записей.
+
+    Ключ записи — (имя функции, аргументы). Записи сбрасываются обёртками invalidates в этом процессе;
+    изменения, сделанные в обход них (другим процессом бота или вручную в базе), становятся видны
+    только после истечения ttl, то есть могут запаздывать до ttl секунд.
+    generation увеличивается при каждой инвалидации, чтобы чтение, начатое до записи, не сохранило устаревший результат.
+    Счётчики hits/misses показывают, насколько кэш полезен.
+    """
+
+    def __init__(self, name, max_size, ttl):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()  # ключ -> (значение, expires_at)
+
+    def get(self, key):
+        """
+        Возвращает кортеж (найдено, значение).
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, copy.deepcopy(entry[0])
+
+    def set(self, key, value):
+        self._entries[key] = (copy.deepcopy(value), time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *values):
+        """
+        Удаляет записи, у которых первый аргумент совпадает с одним из values (например, трек-номер).
+        Без аргументов очищает кэш целиком.
+        """
+        self.generation += 1
+        if not values:
+            self._entries.clear()
+            return
+        values = {str(value) for value in values}
+        for key in [key for key in self._entries if key[1] and str(key[1][0]) in values]:
+            del self._entries[key]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+# Профили клиентов: ключи chat_id, contact_id, phone, personal_code
+client_cache = LookupCache("clients", max_size=5000, ttl=600)
+# Записи трек-номеров: ключ track_number
+track_cache = LookupCache("tracks", max_size=10000, ttl=600)
+
+
+def cached(cache, func):
+    """
+    Оборачивает асинхронную функцию чтения: результат берётся из cache, при промахе — из базы.
+    Результат не сохраняется, если пока выполнялось чтение, кэш был инвалидирован: запрос мог выполниться
+    до записи, а продолжиться после её инвалидации.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = (func.__name__, tuple(signature.bind(*args, **kwargs).arguments.values()))
+        found, value = cache.get(key)
+        if found:
+            return value
+        generation = cache.generation
+        value = await func(*args, **kwargs)
+        if cache.generation == generation:
+            cache.set(key, value)
+        return value
+    return wrapper
+
+
+def invalidates(cache, func, key_args=None):
+    """
+    Оборачивает асинхронную функцию записи: после её выполнения из cache удаляются затронутые записи.
+    key_args — имена аргументов с ключами затронутых записей; если не заданы, кэш очищается целиком.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            if key_args:
+                bound = signature.bind(*args, **kwargs).arguments
+                cache.invalidate(*(bound[name] for name in key_args if name in bound))
+            else:
+                cache.invalidate()
+    return wrapper
+
+
+def get_cache_stats():
+    return [client_cache.stats(), track_cache.stats()]
@@ -1,29 +1,42 @@
 import logging
 import asyncio
+import os
+import time
 from fastapi import FastAPI, Request
 from aiogram import Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from urllib.parse import parse_qs
 from datetime import datetime, timedelta
 
 from bot_instance import bot
 from handlers import user_registration, user_update, menu_handling, track_management, \
     package_search, information_instructions, settings
-from batch_processing import batch_send_to_bitrix
-from db_management import init_db, get_all_chat_ids, is_vip_code_available, update_personal_code, \
-    remove_vip_code, get_contact_id_by_code, save_webhook_to_db, save_broadcast_message, get_last_broadcast_messages, \
-    get_unprocessed_webhooks, is_code_used_by_another_client, get_chat_id_by_personal_code, \
-    delete_deal_by_track_number, delete_client_from_db, get_all_final_deals_by_contact_id, delete_final_deal_from_db
+from batch_processing import batch_send_to_bitrix, send_plan
+from db_management import init_db
+from db_async import run_in_db, get_all_chat_ids, is_vip_code_available, update_personal_code, \
+    remove_vip_code, get_contact_id_by_code, save_webhook_to_db, create_broadcast, get_last_broadcast_id, \
+    is_code_used_by_another_client, get_chat_id_by_personal_code, \
+    delete_deal_by_track_number, delete_client_from_db, get_all_final_deals_by_contact_id, delete_final_deal_from_db, \
+    shutdown_db_executor, invalidate_cached_deal, get_stage_dwell_percentiles, delete_crm_record, \
+    get_outbox_stats, get_dead_letters, retry_dead_letters
 from bitrix_integration import update_contact_code_in_bitrix, get_deal_info, get_deals_by_track_ident, delete_deal
 from aiogram.filters import Command
 from aiogram.types import Message, BotCommand, BotCommandScopeDefault, BotCommandScopeChat, FSInputFile
-from functions import export_database_to_excel
+from export_service import export_tables, parse_export_args, shutdown_export_executor, EXPORT_TABLES
+from db_pool import close_all_connections
+from bitrix_client import close_bitrix_client
+from webhook_dispatcher import WebhookDispatcher
+from broadcast import start_broadcast, resume_unfinished_broadcasts
+from retention import retention_loop, enable_incremental_vacuum
+from crm_sync import crm_sync_loop
+from outbox import outbox_loop, notify_outbox
+from fsm_storage import create_fsm_storage
+from lookup_cache import get_cache_stats
 
 
 # ========== Инициализация бота и приложения ==========
 
 # bot = Bot(token=bot_token)
-dp = Dispatcher(storage=MemoryStorage())
+dp = Dispatcher(storage=create_fsm_storage())
 dp.include_routers(track_management.router,  # Специфические обработчики
                    package_search.router,   # Обработчики поиска
                    user_registration.router, # Регистрация пользователя
@@ -38,8 +51,9 @@ app = FastAPI()
 # ========== Настройки и конфигурация ==========
 
 ADMIN_IDS = [379337072, 793398371, 7184969628, 414935403]
-CHECK_INTERVAL = 10
-IDLE_THRESHOLD = 10
+WEBHOOK_DEBOUNCE = 10         # Секунд без новых вебхуков до запуска обработки
+WEBHOOK_MAX_LATENCY = 60      # Максимальная задержка обработки первого вебхука в окне
+WEBHOOK_MAX_BATCH_SIZE = 200  # Количество вебхуков, при котором обработка запускается сразу
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
 
@@ -67,7 +81,14 @@ async def set_bot_commands():
                                                         "или /delete_track number {track_number})"),
         BotCommand(command="/delete_client", description="Удалить клиента по номеру телефона "
                                                          "(ввести /delete_client {номер_телефона})"),
-        BotCommand(command="/export_db", description="Выгрузить базу данных в Excel"),
+        BotCommand(command="/export_db", description="Выгрузить базу данных в Excel "
+                                                     "(/export_db [таблицы] [колонка=значение])"),
+        BotCommand(command="/cache_stats", description="Статистика кэша клиентов и трек-номеров"),
+        BotCommand(command="/vacuum", description="Включить освобождение места в файле базы "
+                                                  "(однократно, бот не отвечает до завершения)"),
+        BotCommand(command="/outbox", description="Очередь операций Bitrix (/outbox retry — повторить неотправленные)"),
+        BotCommand(command="/dwell_times", description="Время пребывания посылок на этапе "
+                                                       "(/dwell_times {код этапа} [дней])"),
         BotCommand(command="/get_final_deals", description="Получить итоговые сделки по contact_id, "
                                                            "(ввести /get_final_deals {ID контакта из битрикс})"),
         BotCommand(command="/delete_final_deal", description="Удалить итоговую сделку по final_deal_id"
@@ -77,24 +98,14 @@ async def set_bot_commands():
         await bot.set_my_commands(admin_commands, scope=BotCommandScopeChat(chat_id=admin_id))
 
 
-# ========== Вебхук таймер и обработка ==========
+# ========== Обработка вебхуков ==========
 
-async def webhook_timer():
-    """
-    Таймер для периодической проверки необработанных вебхуков.
-    Запускает обработку, если есть необработанные вебхуки и с момента последнего вебхука прошло достаточно времени.
-    """
-    while True:
-        await asyncio.sleep(CHECK_INTERVAL)
-
-        unprocessed_webhooks = get_unprocessed_webhooks()
-        if unprocessed_webhooks:
-            last_webhook_time = datetime.fromisoformat(unprocessed_webhooks[-1]["timestamp"])
-            if (datetime.utcnow() - last_webhook_time).total_seconds() > IDLE_THRESHOLD:
-                logging.info("Простой вебхуков зафиксирован. Запуск обработки...")
-                await batch_send_to_bitrix()
-            else:
-                logging.info("Новые вебхуки продолжают поступать. Ожидаем простоя для обработки.")
+webhook_dispatcher = WebhookDispatcher(
+    batch_send_to_bitrix,
+    debounce=WEBHOOK_DEBOUNCE,
+    max_latency=WEBHOOK_MAX_LATENCY,
+    max_batch_size=WEBHOOK_MAX_BATCH_SIZE
+)
 
 
 # Асинхронный маршрут для обработки вебхуков от Bitrix
@@ -105,12 +116,35 @@ async def handle_webhook(request: Request):
     event_type = decoded_body.get('event', [''])[0]
     entity_id = decoded_body.get('data[FIELDS][ID]', [''])[0]
     logging.info(f"Received webhook: event_type={event_type}, entity_id={entity_id}")
-    save_webhook_to_db(entity_id, event_type)
+    is_new = await save_webhook_to_db(entity_id, event_type)
+    if event_type.startswith("ONCRMDEAL"):
+        # Данные сделки изменились — кэш обновится при пакетной обработке, до неё читаем из Bitrix
+        await invalidate_cached_deal(entity_id)
+    if event_type == "ONCRMDEALDELETE":
+        await delete_crm_record("deal", entity_id)
+    elif event_type == "ONCRMCONTACTDELETE":
+        await delete_crm_record("contact", entity_id)
+    # Повторное событие по той же сущности продлевает окно ожидания, но не увеличивает размер пакета
+    webhook_dispatcher.notify(1 if is_new else 0)
     return {"status": "Webhook received and saved"}
 
 
 # ========== Команды администратора ==========
 
+def broadcast_progress(status_message, title):
+    """
+    Возвращает корутину для отчёта о ходе рассылки, обновляющую сообщение администратору.
+    """
+    async def progress(done, total, failed):
+        text = f"{title}: {done} из {total}"
+        if failed:
+            text += f", ошибок: {failed}"
+        if done == total:
+            text += ". Готово."
+        await status_message.edit_text(text)
+    return progress
+
+
 @dp.message(Command("broadcast"))
 async def broadcast_message(message: Message):
     if message.from_user.id not in ADMIN_IDS:
@@ -123,22 +157,17 @@ async def broadcast_message(message: Message):
         await message.answer("Пожалуйста, укажите сообщение для рассылки.")
         return
 
-    # Получаем список всех chat_id для рассылки
-    chat_ids = get_all_chat_ids()  # Предполагается, что функция возвращает список chat_id
-
-    # Отправляем сообщение каждому пользователю
-    for chat_id in chat_ids:
-        try:
-            sent_message = await message.bot.send_message(chat_id=chat_id, text=message_text)
-            logging.info(f"Сообщение отправлено пользователю {chat_id}")
-
-            # Сохраняем данные об отправленном сообщении в базу данных
-            save_broadcast_message(chat_id=chat_id, message_id=sent_message.message_id)
-
-        except Exception as e:
-            logging.error(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
+    # Получаем список всех chat_id и сохраняем получателей до начала отправки,
+    # чтобы прерванную рассылку можно было продолжить после перезапуска
+    chat_ids = await get_all_chat_ids()
+    broadcast_id = await create_broadcast(message_text, chat_ids)
+    if broadcast_id is None:
+        await message.answer("Не удалось создать рассылку.")
+        return
 
-    await message.answer("Рассылка завершена.")
+    status_message = await message.answer(f"Рассылка запущена: 0 из {len(chat_ids)}")
+    start_broadcast(message.bot, broadcast_id, "send",
+                    progress=broadcast_progress(status_message, "Рассылка"))
 
 
 @dp.message(Command("delete_broadcast"))
@@ -147,19 +176,15 @@ async def delete_last_broadcast(message: Message):
         await message.answer("У вас нет прав для выполнения этой команды.")
         return
 
-    messages = get_last_broadcast_messages()
-    if not messages:
+    broadcast_id = await get_last_broadcast_id()
+    if broadcast_id is None:
         await message.answer("Нет сообщений для удаления.")
         return
 
-    for chat_id, message_id in messages:
-        try:
-            await message.bot.delete_message(chat_id=chat_id, message_id=message_id)
-            logging.info(f"Сообщение {message_id} удалено для пользователя {chat_id}")
-        except Exception as e:
-            logging.error(f"Не удалось удалить сообщение {message_id} для пользователя {chat_id}: {e}")
-
-    await message.answer("Последняя рассылка успешно удалена.")
+    status_message = await message.answer("Удаление последней рассылки...")
+    if not start_broadcast(message.bot, broadcast_id, "delete",
+                           progress=broadcast_progress(status_message, "Удаление рассылки")):
+        await status_message.edit_text("Последняя рассылка ещё выполняется. Повторите команду позже.")
 
 
 @dp.message(Command("edit_broadcast"))
@@ -174,19 +199,15 @@ async def edit_last_broadcast(message: Message):
         return
 
     new_text = args
-    messages = get_last_broadcast_messages()
-    if not messages:
+    broadcast_id = await get_last_broadcast_id()
+    if broadcast_id is None:
         await message.answer("Нет сообщений для редактирования.")
         return
 
-    for chat_id, message_id in messages:
-        try:
-            await message.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=new_text)
-            logging.info(f"Сообщение {message_id} для пользователя {chat_id} обновлено.")
-        except Exception as e:
-            logging.error(f"Не удалось обновить сообщение {message_id} для пользователя {chat_id}: {e}")
-
-    await message.answer("Последняя рассылка успешно отредактирована.")
+    status_message = await message.answer("Редактирование последней рассылки...")
+    if not start_broadcast(message.bot, broadcast_id, "edit", text=new_text,
+                           progress=broadcast_progress(status_message, "Редактирование рассылки")):
+        await status_message.edit_text("Последняя рассылка ещё выполняется. Повторите команду позже.")
 
 
 @dp.message(Command("reappropriation"))
@@ -204,20 +225,20 @@ async def reappropriation(message: Message):
         return
 
     old_code, new_code = args
-    contact_id = get_contact_id_by_code(old_code)
+    contact_id = await get_contact_id_by_code(old_code)
     logging.info(f"Получен contact_id: {contact_id}")
 
     # Проверяем, есть ли новый код в базе VIP кодов
-    if is_vip_code_available(new_code):
+    if await is_vip_code_available(new_code):
         # Если код доступен в таблице VIP, продолжаем как обычно
-        if update_personal_code(old_code, new_code):
+        if await update_personal_code(old_code, new_code):
             if contact_id:
                 logging.info('update_contact_code_in_bitrix called')
-                update_contact_code_in_bitrix(contact_id, new_code)
-            remove_vip_code(new_code)
+                await update_contact_code_in_bitrix(contact_id, new_code)
+            await remove_vip_code(new_code)
 
             # Отправляем уведомление пользователю
-            chat_id = get_chat_id_by_personal_code(new_code)
+            chat_id = await get_chat_id_by_personal_code(new_code)
             if chat_id:
                 await bot.send_message(
                     chat_id,
@@ -232,14 +253,14 @@ async def reappropriation(message: Message):
             await message.answer(f"Ошибка: пользователь с кодом {old_code} не найден или произошла ошибка при обновлении.")
     else:
         # Если код не в базе VIP, проверяем, не используется ли он
-        if not is_code_used_by_another_client(new_code):
-            if update_personal_code(old_code, new_code):
+        if not await is_code_used_by_another_client(new_code):
+            if await update_personal_code(old_code, new_code):
                 if contact_id:
                     logging.info('update_contact_code_in_bitrix called')
-                    update_contact_code_in_bitrix(contact_id, new_code)
+                    await update_contact_code_in_bitrix(contact_id, new_code)
 
                 # Отправляем уведомление пользователю
-                chat_id = get_chat_id_by_personal_code(new_code)
+                chat_id = await get_chat_id_by_personal_code(new_code)
                 if chat_id:
                     await bot.send_message(
                         chat_id,
@@ -296,7 +317,7 @@ async def delete_track_command(message: Message):
             await message.answer(f"Не удалось найти сделку с ID {deal_id}.")
     elif identifier_type == "number":
         track_number = identifier_value
-        deals = get_deals_by_track_ident(track_number)
+        deals = await get_deals_by_track_ident(track_number)
         if deals:
             for deal in deals:
                 deal_id = deal.get('ID')
@@ -323,7 +344,7 @@ async def delete_track_and_related_data(track_number, deal_id):
             deal_info = await get_deal_info(deal_id)
             if deal_info:
                 # Удаляем сделку из Битрикс
-                delete_result = delete_deal(deal_id)
+                delete_result = await delete_deal(deal_id)
                 if delete_result:
                     logging.info(f"Сделка с ID {deal_id} успешно удалена из Битрикс.")
                 else:
@@ -365,7 +386,7 @@ async def delete_client_command(message: Message):
         return
 
     # Вызываем функцию для удаления клиента
-    is_deleted = delete_client_from_db(phone)
+    is_deleted = await delete_client_from_db(phone)
     if is_deleted:
         await message.answer(f"Запись с номером телефона {phone} успешно удалена.")
     else:
@@ -378,12 +399,130 @@ async def export_database(message: Message):
         await message.answer("У вас нет прав для выполнения этой команды.")
         return
 
+    # Формат: /export_db [таблицы...] [колонка=значение...], например /export_db track_numbers chat_id=123
+    args = message.text[len("/export_db"):].strip().split()
+    tables, filters, unknown = parse_export_args(args)
+    if unknown:
+        await message.answer(f"Неизвестные таблицы: {', '.join(unknown)}. Доступны: {', '.join(EXPORT_TABLES)}")
+        return
+
+    status_message = await message.answer(f"⏳ Выгрузка таблиц {', '.join(tables)} запущена...")
+    output_file = None
     try:
-        output_file = export_database_to_excel()
+        output_file, counts = await export_tables(tables, filters)
+        summary = "\n".join(f"{table}: {count}" for table, count in counts.items())
         document = FSInputFile(output_file)  # Оборачиваем в FSInputFile
-        await message.answer_document(document=document, caption="📂 Вот ваша актуальная версия базы данных")
+        await message.answer_document(document=document,
+                                      caption=f"📂 Вот ваша актуальная версия базы данных\n{summary}")
+        await status_message.delete()
     except Exception as e:
-        await message.answer(f"⚠ Ошибка при выгрузке базы данных: {e}")
+        await status_message.edit_text(f"⚠ Ошибка при выгрузке базы данных: {e}")
+    finally:
+        # Файл удаляется и после неудачной отправки, чтобы выгрузки не накапливались рядом с базой
+        if output_file and os.path.exists(output_file):
+            os.remove(output_file)
+
+
+@dp.message(Command("cache_stats"))
+async def cache_stats_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("У вас нет прав для выполнения этой команды.")
+        return
+
+    lines = [
+        f"{stats['name']}: {stats['size']} записей, попаданий {stats['hits']}, промахов {stats['misses']} "
+        f"({stats['hit_rate']:.0%})"
+        for stats in get_cache_stats()
+    ]
+    await message.answer("\n".join(lines))
+
+
+@dp.message(Command("vacuum"))
+async def vacuum_command(message: Message):
+    """
+    Однократно включает auto_vacuum = INCREMENTAL, после чего очистка устаревших данных
+    возвращает освободившееся место файловой системе. Полный VACUUM блокирует базу до завершения.
+    """
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("У вас нет прав для выполнения этой команды.")
+        return
+
+    status_message = await message.answer("⏳ Перестройка файла базы данных, запросы бота ожидают завершения...")
+    try:
+        enabled = await run_in_db(enable_incremental_vacuum)
+    except Exception as e:
+        await status_message.edit_text(f"⚠ Ошибка при выполнении VACUUM: {e}")
+        return
+    await status_message.edit_text("✅ auto_vacuum = INCREMENTAL включён." if enabled
+                                   else "auto_vacuum = INCREMENTAL уже включён.")
+
+
+@dp.message(Command("outbox"))
+async def outbox_command(message: Message):
+    """
+    Состояние очереди операций Bitrix и последние операции, для которых исчерпаны попытки.
+    Формат команды: /outbox [retry]
+    """
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("У вас нет прав для выполнения этой команды.")
+        return
+
+    command_parts = message.text.split()
+    if len(command_parts) == 2 and command_parts[1] == "retry":
+        count = await retry_dead_letters()
+        if count is None:
+            await message.answer("⚠ Не удалось вернуть операции в очередь.")
+            return
+        notify_outbox()
+        await message.answer(f"Возвращено в очередь операций: {count}.")
+        return
+
+    stats = await get_outbox_stats()
+    if stats is None:
+        await message.answer("⚠ Не удалось получить состояние очереди.")
+        return
+    lines = [f"Очередь операций Bitrix: ожидают {stats['pending']}, отправлено {stats['sent']}, "
+             f"не отправлено {stats['dead']}, заменено более новыми {stats['superseded']}."]
+    for letter in await get_dead_letters(10) or []:
+        lines.append(f"{letter['key']} ({letter['source']}, попыток {letter['attempts']}): {letter['last_error']}")
+    await message.answer("\n".join(lines))
+
+
+def format_duration(seconds):
+    hours = seconds / 3600
+    return f"{hours / 24:.1f} дн." if hours >= 48 else f"{hours:.1f} ч."
+
+
+@dp.message(Command("dwell_times"))
+async def dwell_times_command(message: Message):
+    """
+    Перцентили времени пребывания посылок на этапе по воронкам и пунктам выдачи.
+    Формат команды: /dwell_times {код этапа} [за сколько дней, по умолчанию 30]
+    """
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("У вас нет прав для выполнения этой команды.")
+        return
+
+    command_parts = message.text.split()
+    if len(command_parts) not in (2, 3) or (len(command_parts) == 3 and not command_parts[2].isdigit()):
+        await message.answer("Укажите код этапа. Пример: /dwell_times C8:PREPAYMENT_INVOICE 30")
+        return
+
+    stage_id = command_parts[1].strip()
+    days = int(command_parts[2]) if len(command_parts) == 3 else 30
+    stats = await get_stage_dwell_percentiles(stage_id, since=int(time.time()) - days * 86400)
+    if not stats:
+        await message.answer(f"Завершённых переходов с этапа {stage_id} за {days} дн. не найдено.")
+        return
+
+    lines = [f"Время на этапе {stage_id} за {days} дн.:"]
+    for row in stats:
+        lines.append(
+            f"Воронка {row['pipeline']}, {row['pickup_point'] or 'пункт выдачи не указан'}: {row['count']} посылок, "
+            f"p50 {format_duration(row['p50'])}, p90 {format_duration(row['p90'])}, "
+            f"p95 {format_duration(row['p95'])}"
+        )
+    await message.answer("\n".join(lines))
 
 
 @dp.message(Command("get_final_deals"))
@@ -402,14 +541,14 @@ async def get_final_deals_command(message: Message):
         return
 
     contact_id = command_parts[1].strip()
-    deals = get_all_final_deals_by_contact_id(contact_id)
+    deals = await get_all_final_deals_by_contact_id(contact_id)
     if deals:
         response = f"Итоговые сделки для contact_id {contact_id}:\n"
         for deal in deals:
             response += (
                 f"ID: {deal['id']}, final_deal_id: {deal['final_deal_id']}, "
                 f"creation_date: {deal['creation_date']}, stage: {deal['current_stage_id']}, "
-                f"track_numbers: {deal['track_numbers']}, вес: {deal['total_weight']}, "
+                f"track_numbers: {', '.join(deal['track_numbers'])}, вес: {deal['total_weight']}, "
                 f"сумма: {deal['total_amount']}, заказы: {deal['number_of_orders']}\n"
             )
         await message.answer(response)
@@ -433,7 +572,7 @@ async def delete_final_deal_command(message: Message):
         return
 
     final_deal_id = command_parts[1].strip()
-    if delete_final_deal_from_db(final_deal_id):
+    if await delete_final_deal_from_db(final_deal_id):
         await message.answer(f"Итоговая сделка с final_deal_id {final_deal_id} успешно удалена.")
     else:
         await message.answer(f"Итоговая сделка с final_deal_id {final_deal_id} не найдена.")
@@ -443,14 +582,21 @@ async def delete_final_deal_command(message: Message):
 async def start_services():
     logging.info("Запуск всех сервисов...")
     await set_bot_commands()
+    await resume_unfinished_broadcasts(bot)
     import uvicorn
     config = uvicorn.Config(app, host="0.0.0.0", port=3303, log_level="info")
     server = uvicorn.Server(config)
     try:
-        await asyncio.gather(server.serve(), webhook_timer(), dp.start_polling(bot))
+        await asyncio.gather(server.serve(), webhook_dispatcher.run(), retention_loop(), crm_sync_loop(),
+                             outbox_loop(send_plan), dp.start_polling(bot))
     except Exception as e:
         logging.error(f"Ошибка в одной из задач: {e}")
     finally:
+        await dp.storage.close()
+        await close_bitrix_client()
+        shutdown_export_executor()
+        shutdown_db_executor()
+        close_all_connections()
         logging.info("Сервисы корректно завершены.")
 
 
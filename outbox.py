@@ -0,0 +1,83 @@
+import asyncio
+import logging
+from batch_planner import plan_operations
+from db_async import enqueue_operations, claim_outbox, complete_outbox
+
+
+# ========== Настройки очереди операций Bitrix ==========
+# Операции, сформированные при обработке вебхуков, сохраняются в processed_results вместе с локальными
+# записями (transactional outbox) и отправляются отсюда, поэтому не теряются при сбое Bitrix или перезапуске бота.
+OUTBOX_DRAIN_SIZE = 500           # Сколько операций берётся в одну отправку
+OUTBOX_LEASE_SECONDS = 600        # Через сколько секунд операции упавшего обработчика снова станут доступны
+OUTBOX_MAX_ATTEMPTS = 8           # После стольких неудачных попыток операция попадает в outbox_dead_letters
+OUTBOX_RETRY_DELAY = 30           # Задержка перед первой повторной попыткой (с), далее удваивается
+OUTBOX_MAX_RETRY_DELAY = 3600     # Максимальная задержка между попытками (с)
+OUTBOX_POLL_INTERVAL = 30         # Как часто проверять отложенные операции, если новых нет (с)
+
+_wakeup = asyncio.Event()
+
+
+def notify_outbox():
+    """
+    Сообщает обработчику очереди о новых операциях.
+    """
+    _wakeup.set()
+
+
+async def enqueue(operations, source):
+    """
+    Ставит операции {ключ: команда} в очередь и будит обработчик. Вызывающий код возвращается,
+    как только операции записаны в базу, не дожидаясь ответа Bitrix. Возвращает True при успехе.
+    """
+    if not operations:
+        return True
+    if not await enqueue_operations(operations, source):
+        return False
+    notify_outbox()
+    return True
+
+
+async def drain_outbox(send_plan):
+    """
+    Отправляет операции, срок которых наступил, порциями по OUTBOX_DRAIN_SIZE, пока они не закончатся.
+    Порция планируется целиком (plan_operations) и отправляется batch-запросами через send_plan;
+    результат каждой операции фиксируется отдельно. Возвращает количество обработанных операций.
+    """
+    total = 0
+    while True:
+        rows = await claim_outbox(OUTBOX_DRAIN_SIZE, OUTBOX_LEASE_SECONDS)
+        if not rows:
+            return total
+        total += len(rows)
+
+        operations = {}
+        ids_by_key = {}
+        for row in rows:
+            operations[row['key']] = row['command']
+            ids_by_key.setdefault(row['key'], []).append(row['id'])
+
+        failed = await send_plan(plan_operations(operations))
+        sent_ids = [row_id for key, ids in ids_by_key.items() if key not in failed for row_id in ids]
+        failures = [(row_id, failed[key]) for key, ids in ids_by_key.items() if key in failed for row_id in ids]
+        await complete_outbox(sent_ids, failures, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_DELAY, OUTBOX_MAX_RETRY_DELAY)
+        logging.info(f"Очередь операций Bitrix: выполнено {len(sent_ids)}, отложено {len(failures)}.")
+
+        if len(rows) < OUTBOX_DRAIN_SIZE:
+            return total
+
+
+async def outbox_loop(send_plan):
+    """
+    Основной цикл обработчика очереди. Запускается вместе с ботом и сервером.
+    Операции отправляются сразу после notify_outbox, отложенные повторы — не реже раза в OUTBOX_POLL_INTERVAL.
+    """
+    while True:
+        _wakeup.clear()
+        try:
+            await drain_outbox(send_plan)
+        except Exception as e:
+            logging.error(f"Ошибка при отправке очереди операций Bitrix: {e}")
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
@@ -2,11 +2,12 @@ import logging
 from typing import Optional, Dict, Any, List
 from datetime import datetime, timezone, timedelta
 from bot_instance import bot
-from db_management import get_personal_code_by_chat_id, get_track_data_by_track_number, get_client_by_chat_id, \
+# Выборки читаются из контекста пакета (batch_context), если он задан, иначе из базы
+from batch_context import get_personal_code_by_chat_id, get_track_data_by_track_number, get_client_by_chat_id, \
     get_client_by_contact_id, delete_deal_by_track_number, get_chat_id_by_contact_id, save_final_deal_to_db, \
-    update_final_deal_in_db, get_final_deal_from_db, get_name_track_by_track_number, find_deal_by_track, \
-    update_tracked_deal, get_task_id_by_deal_id, delete_task_from_db, get_original_date_by_track, save_deal_history, \
-    update_name_track_by_track_number
+    append_final_deal_track, get_final_deal_track_numbers, get_final_deal_from_db, get_name_track_by_track_number, \
+    find_deal_by_track, update_tracked_deal, get_task_id_by_deal_id, delete_task_from_db, get_original_date_by_track, \
+    save_deal_history, record_stage_transition, update_name_track_by_track_number
 from bitrix_integration import update_contact_fields_in_bitrix
 from functions import trim_time_from_iso
 
@@ -62,8 +63,8 @@ async def send_notification_if_required(deal_info, chat_id, track_number, pickup
     }
     location_value = locations.get(pickup_point, "неизвестное место выдачи")
     stage_value = status_code_list.get(stage_id)
-    personal_code = get_personal_code_by_chat_id(chat_id)
-    name_track = get_name_track_by_track_number(track_number)  # Получаем name_track из БД
+    personal_code = await get_personal_code_by_chat_id(chat_id)
+    name_track = await get_name_track_by_track_number(track_number)  # Получаем name_track из БД
 
     logging.info(f"Проверка уведомления: стадия сделки={stage_id}, пункт выдачи={location_value}, "
                  f"ожидаемая стадия={stage_value}, chat_id={chat_id}")
@@ -659,27 +660,31 @@ async def send_notification_if_required(deal_info, chat_id, track_number, pickup
 class OperationsBuilder:
     """
     Класс для инкапсуляции формирования операций (batch-запросов) для обновления сделок в Bitrix24.
-    Все методы добавляют соответствующие операции в словарь self.operations.
+    Все методы добавляют соответствующие операции в словарь self.operations и возвращают ключ операции.
+    Ключ определяется действием и сущностью, а не позицией в пакете: в очереди outbox более новая операция
+    с тем же ключом заменяет неотправленную.
     """
     def __init__(self) -> None:
         self.operations: Dict[str, str] = {}
 
-    def add_detach_old_contact(self, old_deal_id: int, expected_contact_id: str) -> None:
+    def add_detach_old_contact(self, old_deal_id: int, expected_contact_id: str) -> str:
         """
         Добавляет операцию отвязки контакта от старой сделки.
         """
-        key = f"detach_old_contact_{old_deal_id}"
+        key = f"detach_old_contact_{old_deal_id}_{expected_contact_id}"
         self.operations[key] = f"crm.deal.contact.items.delete?ID={old_deal_id}&CONTACT_ID={expected_contact_id}"
+        return key
 
-    def add_delete_deal(self, deal_id: int) -> None:
+    def add_delete_deal(self, deal_id: int) -> str:
         """
         Добавляет операцию удаления сделки.
         """
         key = f"delete_deal_{deal_id}"
         self.operations[key] = f"crm.deal.delete?id={deal_id}"
+        return key
 
     def add_update_deal(self, deal_id: int, expected_contact_id: str, title: str, phone: str, city: str,
-                        track_number: str, pickup_point_mapped: str, chat_id: str) -> None:
+                        track_number: str, pickup_point_mapped: str, chat_id: str) -> str:
         """
         Добавляет операцию обновления текущей сделки.
         """
@@ -689,8 +694,9 @@ class OperationsBuilder:
             f"&fields[PHONE]={phone}&fields[CITY]={city}&fields[UF_CRM_1723542556619]={track_number}"
             f"&fields[UF_CRM_1723542922949]={pickup_point_mapped}&fields[UF_CRM_1725179625]={chat_id}"
         )
+        return key
 
-    def add_almaty_task(self, deal_id: int, client_phone: str, client_pickup: str) -> None:
+    def add_almaty_task(self, deal_id: int, client_phone: str, client_pickup: str) -> str:
         """
         Добавляет операцию создания задачи для сделки, находящейся на этапе 'Прибыл в Алмату'.
         """
@@ -712,8 +718,9 @@ class OperationsBuilder:
             f"fields[CREATED_DATE]={start_date}&"
             f"fields[DEADLINE]={deadline}"
         )
+        return key
 
-    def add_update_contact_fields(self, contact_id: str, weight: Any, amount: Any, number_of_orders: Any) -> None:
+    def add_update_contact_fields(self, contact_id: str, weight: Any, amount: Any, number_of_orders: Any) -> str:
         """
         Добавляет операцию обновления пользовательских полей контакта.
         """
@@ -722,11 +729,12 @@ class OperationsBuilder:
             f"crm.contact.update?id={contact_id}&fields[UF_CRM_1726207792191]={weight}"
             f"&fields[UF_CRM_1726207809637]={amount}&fields[UF_CRM_1730182877]={number_of_orders}"
         )
+        return key
 
     def add_update_deal_as_final(self, deal_id: int, client_info: Dict[str, Any], contact_id: str,
                                    expected_awaiting_pickup_stage: str, category_id: int,
                                    pickup_point_mapped: str, weight: Any, amount: Any,
-                                   number_of_orders: Any, track_number: str) -> None:
+                                   number_of_orders: Any, track_number: str) -> str:
         """
         Добавляет операцию обновления сделки как итоговой.
         """
@@ -741,11 +749,12 @@ class OperationsBuilder:
             f"&fields[UF_CRM_1730185262]={number_of_orders}&fields[UF_CRM_1729115312]={track_number}"
             f"&fields[UF_CRM_1729539412]=1&fields[OPENED]=Y"
         )
+        return key
 
     def add_update_existing_final_deal(self, final_deal_id: int, client_info: Dict[str, Any], contact_id: str,
                                        expected_awaiting_pickup_stage: str, category_id: int,
                                        pickup_point_mapped: str, weight: Any, amount: Any,
-                                       number_of_orders: Any, track_number: str) -> None:
+                                       number_of_orders: Any, track_number: str) -> str:
         """
         Добавляет операцию обновления уже существующей итоговой сделки.
         Использует final_deal_id (ID итоговой сделки из базы данных).
@@ -762,16 +771,17 @@ class OperationsBuilder:
             f"&fields[UF_CRM_1730185262]={number_of_orders}&fields[UF_CRM_1729115312]={track_number}"
             f"&fields[UF_CRM_1729539412]=1&fields[OPENED]=Y"
         )
+        return key
 
-    def add_create_copy_of_deal(self, contact_id: str, client_info: Dict[str, Any], stage_id: str,
+    def add_create_copy_of_deal(self, deal_id: int, contact_id: str, client_info: Dict[str, Any], stage_id: str,
                                 category_id: int, pickup_point_mapped: str, chat_id: str,
-                                track_number: str) -> None:
+                                track_number: str) -> str:
         """
-        Добавляет операцию создания копии сделки в архивном этапе.
+        Добавляет операцию создания копии сделки deal_id в архивном этапе.
         """
         title = (f"{client_info['personal_code']} {client_info['name_translit']} "
                  f"{client_info['pickup_point']} +{client_info['phone']}")
-        key = f"create_final_deal_{contact_id}"
+        key = f"create_copy_of_deal_{deal_id}"
         self.operations[key] = (
             f"crm.deal.add?"
             f"fields[TITLE]={title}&"
@@ -781,23 +791,26 @@ class OperationsBuilder:
             f"&fields[UF_CRM_1725179625]={chat_id}&fields[UF_CRM_1723542556619]={track_number}"
             f"&fields[UF_CRM_1729539412]=1"
         )
+        return key
 
-    def add_archive_deal(self, deal_id: int, archive_stage_id: str) -> None:
+    def add_archive_deal(self, deal_id: int, archive_stage_id: str) -> str:
         """
         Добавляет операцию архивирования сделки с заданным deal_id, устанавливая стадию равной archive_stage_id.
         """
         key = f"archive_deal_{deal_id}"
         self.operations[key] = f"crm.deal.update?ID={deal_id}&fields[STAGE_ID]={archive_stage_id}"
         logging.info(f"Операция для архивирования сделки {deal_id} добавлена.")
+        return key
 
-    def add_update_deal_title(self, deal_id: int, incorrect_title: str) -> None:
+    def add_update_deal_title(self, deal_id: int, incorrect_title: str) -> str:
         """
         Добавляет операцию обновления заголовка сделки.
         """
         key = f"update_deal_title_{deal_id}"
         self.operations[key] = f"crm.deal.update?ID={deal_id}&fields[TITLE]={incorrect_title}"
+        return key
 
-    def add_create_task(self, deal_id: int, task_title: str, task_description: str, deadline: str) -> None:
+    def add_create_task(self, deal_id: int, task_title: str, task_description: str, deadline: str) -> str:
         """
         Добавляет операцию создания задачи для сделки.
         """
@@ -808,13 +821,15 @@ class OperationsBuilder:
             f"&fields[RESPONSIBLE_ID]=1&fields[PRIORITY]=2&fields[UF_CRM_TASK]=D_{deal_id}"
             f"&fields[DEADLINE]={deadline}"
         )
+        return key
 
-    def add_update_track_numbers(self, final_deal_id: int, updated_track_numbers: str) -> None:
+    def add_update_track_numbers(self, final_deal_id: int, updated_track_numbers: str) -> str:
         """
         Добавляет операцию обновления списка трек-номеров в итоговой сделке.
         """
         key = f"update_track_numbers_{final_deal_id}"
         self.operations[key] = f"crm.deal.update?id={final_deal_id}&fields[UF_CRM_1729115312]={updated_track_numbers}"
+        return key
 
 
 def precheck_deal(deal_info: dict) -> Optional[dict]:
@@ -874,39 +889,42 @@ def precheck_deal(deal_info: dict) -> Optional[dict]:
     }
 
 
-def update_deal_history(deal_id: int, track_number: str, stage_id: str, date_modify: str) -> None:
+async def update_deal_history(deal_id: int, track_number: str, stage_id: str, date_modify: str,
+                              changed_at: Optional[str] = None) -> None:
     """
-    Обновляет или создает запись в deal_history для сделки.
+    Обновляет или создает запись в deal_history для сделки и добавляет переход в журнал stage_transitions.
 
     Если запись существует и этап изменился, обновляет запись (с учетом поля china_shipment_date).
-    Если записи нет, создает новую.
+    Если записи нет, создает новую. changed_at — точное время перехода (ISO 8601), по умолчанию date_modify.
     """
-    deal_history = get_original_date_by_track(track_number)
+    deal_history = await get_original_date_by_track(track_number)
     if deal_history:
         last_modified, saved_stage_id, china_shipment_date = deal_history
         if saved_stage_id != stage_id:
             logging.info(f"Этап сделки изменился: {saved_stage_id} -> {stage_id}. Обновляем запись в deal_history.")
             china_date = date_modify if stage_id == "C8:PREPARATION" and china_shipment_date is None \
                 else china_shipment_date
-            save_deal_history(
+            await save_deal_history(
                 deal_id=deal_id,
                 track_number=track_number,
                 original_date_modify=date_modify,
                 stage_id=stage_id,
                 china_shipment_date=china_date
             )
+            await record_stage_transition(deal_id, track_number, stage_id, changed_at or date_modify)
         else:
             logging.info("Этап сделки не изменился. Обновление deal_history не требуется.")
     else:
         logging.info("Запись в deal_history отсутствует. Создаём новую запись.")
         china_date = date_modify if stage_id == "C8:PREPARATION" else None
-        save_deal_history(
+        await save_deal_history(
             deal_id=deal_id,
             track_number=track_number,
             original_date_modify=date_modify,
             stage_id=stage_id,
             china_shipment_date=china_date
         )
+        await record_stage_transition(deal_id, track_number, stage_id, changed_at or date_modify)
 
 
 async def process_order_pipeline(
@@ -933,7 +951,7 @@ async def process_order_pipeline(
     ops_builder = OperationsBuilder()
 
     try:
-        track_data = get_track_data_by_track_number(track_number)
+        track_data = await get_track_data_by_track_number(track_number)
     except Exception as e:
         logging.error(f"Ошибка при получении данных трека {track_number}: {e}")
         return
@@ -961,7 +979,7 @@ async def _process_existing_track(
     logging.info(f"Найдены данные по трек-номеру {track_number}: {track_data}")
 
     try:
-        client_info = get_client_by_chat_id(chat_id)
+        client_info = await get_client_by_chat_id(chat_id)
     except Exception as e:
         logging.error(f"Ошибка при получении данных клиента по chat_id {chat_id}: {e}")
         return
@@ -969,7 +987,7 @@ async def _process_existing_track(
     if client_info:
         logging.info(f"Получены данные клиента по chat_id {chat_id}: {client_info}")
         expected_contact_id: str = client_info['contact_id']
-        old_deal = find_deal_by_track(track_number, current_deal_id=deal_info.get('ID'))
+        old_deal = await find_deal_by_track(track_number, current_deal_id=deal_info.get('ID'))
         logging.info(f"Ожидаемый контакт ID: {expected_contact_id}. Найдена старая сделка: {old_deal}")
 
         if old_deal and old_deal['ID'] != deal_info.get('ID'):
@@ -1001,7 +1019,7 @@ async def _process_existing_track(
             pickup_point_mapped=pickup_point_mapped,
             chat_id=chat_id
         )
-        update_tracked_deal(deal_info.get('ID'), track_number)
+        await update_tracked_deal(deal_info.get('ID'), track_number)
         logging.info(f"Операция обновления сделки добавлена для ID {deal_info.get('ID')}.")
 
         try:
@@ -1039,9 +1057,9 @@ async def _process_unregistered_track(
     almaty_stage_id = "C8:PREPAYMENT_INVOICE"
     if stage_id == almaty_stage_id:
         contact_id = deal_info.get('CONTACT_ID')
-        chat_id = get_chat_id_by_contact_id(contact_id)
+        chat_id = await get_chat_id_by_contact_id(contact_id)
         if chat_id:
-            client_info = get_client_by_chat_id(chat_id)
+            client_info = await get_client_by_chat_id(chat_id)
             if client_info:
                 ops_builder.add_almaty_task(deal_id, client_info['phone'], client_info['pickup_point'])
                 logging.info(f"Задача для сделки {deal_id} добавлена через OperationsBuilder.")
@@ -1084,7 +1102,7 @@ async def process_pickup_pipelines(
     ops_builder = OperationsBuilder()
 
     try:
-        track_data = get_track_data_by_track_number(track_number)
+        track_data = await get_track_data_by_track_number(track_number)
     except Exception as e:
         logging.error(f"Ошибка при получении данных трека {track_number}: {e}")
         return
@@ -1116,7 +1134,7 @@ async def _process_existing_pickup(
     logging.info(f"Найдены данные по трек-номеру {track_number}: {track_data}")
 
     try:
-        client_info = get_client_by_chat_id(chat_id)
+        client_info = await get_client_by_chat_id(chat_id)
     except Exception as e:
         logging.error(f"Ошибка при получении клиента по chat_id {chat_id}: {e}")
         client_info = None
@@ -1124,7 +1142,7 @@ async def _process_existing_pickup(
     # Фоллбэк 1: если client_info не найден — пробуем по contact_id
     if not client_info and contact_id:
         logging.info(f"Клиент не найден по chat_id. Пробуем по contact_id {contact_id}")
-        client_info = get_client_by_contact_id(contact_id)
+        client_info = await get_client_by_contact_id(contact_id)
 
     # Фоллбэк 2: если contact_id не был в сделке, но client_info найден через chat_id — восстановим contact_id
     if client_info and not contact_id:
@@ -1138,7 +1156,7 @@ async def _process_existing_pickup(
 
     logging.info(f"Получены данные клиента: {client_info}")
     expected_contact_id: int = int(client_info.get('contact_id'))
-    duplicate_deal = find_deal_by_track(track_number, current_deal_id=deal_info.get('ID'))
+    duplicate_deal = await find_deal_by_track(track_number, current_deal_id=deal_info.get('ID'))
     logging.info(f"Ожидаемый контакт ID: {expected_contact_id}. Найден дубликат: {duplicate_deal}")
 
     if duplicate_deal and duplicate_deal['ID'] != deal_info.get('ID'):
@@ -1153,12 +1171,12 @@ async def _process_existing_pickup(
                 )
                 ops_builder.add_detach_old_contact(duplicate_deal['ID'], expected_contact_id)
                 ops_builder.add_delete_deal(duplicate_deal['ID'])
-                task_id = get_task_id_by_deal_id(duplicate_deal['ID'])
+                task_id = await get_task_id_by_deal_id(duplicate_deal['ID'])
                 if task_id:
                     ops_builder.operations[f"delete_task_{task_id}"] = f"tasks.task.delete?taskId={task_id}"
                     logging.info(
                         f"Операция удаления задачи с ID {task_id} для дубликата {duplicate_deal['ID']} добавлена.")
-                    delete_task_from_db(duplicate_deal['ID'])
+                    await delete_task_from_db(duplicate_deal['ID'])
                     logging.info(f"Запись о задаче для дубликата {duplicate_deal['ID']} удалена.")
                 else:
                     logging.info(f"Для дубликата {duplicate_deal['ID']} не найдена привязанная задача.")
@@ -1172,7 +1190,7 @@ async def _process_existing_pickup(
     if contact_id != str(expected_contact_id):
         logging.info(
             f"Контакт ID {contact_id} отличается от ожидаемого {expected_contact_id}. Создание операции по отвязке.")
-        ops_builder.operations[f"detach_contact_{deal_id}"] = f"crm.deal.contact.items.delete?ID={deal_id}&CONTACT_ID={contact_id}"
+        ops_builder.operations[f"detach_contact_{deal_id}_{contact_id}"] = f"crm.deal.contact.items.delete?ID={deal_id}&CONTACT_ID={contact_id}"
         logging.info(f"Контакт успешно перепривязан к ID {contact_id}.")
 
     title = f"{client_info['personal_code']} {client_info['name_translit']} {client_info['pickup_point']} +{client_info['phone']}"
@@ -1192,7 +1210,7 @@ async def _process_existing_pickup(
         }.get(client_info['pickup_point']),
         chat_id=chat_id
     )
-    update_tracked_deal(deal_info.get('ID'), track_number)
+    await update_tracked_deal(deal_info.get('ID'), track_number)
     logging.info(f"Операция обновления сделки добавлена для ID {deal_info.get('ID')}.")
     try:
         await send_notification_if_required(deal_info, chat_id, track_number, client_info['pickup_point'])
@@ -1223,18 +1241,18 @@ async def _process_unregistered_pickup(
     almaty_stage_id = "C8:PREPAYMENT_INVOICE"
     if stage_id == almaty_stage_id:
         contact_id = deal_info.get('CONTACT_ID')
-        chat_id = get_chat_id_by_contact_id(contact_id)
+        chat_id = await get_chat_id_by_contact_id(contact_id)
         if not chat_id:
             logging.error(f"chat_id не найден для contact_id {contact_id}. Уведомление невозможно отправить.")
             return
         try:
-            client_info = get_client_by_chat_id(chat_id)
+            client_info = await get_client_by_chat_id(chat_id)
         except Exception as e:
             logging.error(f"Ошибка при получении клиента по chat_id {chat_id}: {e}")
             client_info = None
         if not client_info:
             logging.info(f"Данные по chat_id {chat_id} не получены. Попытка получения через contact_id {contact_id}.")
-            client_info = get_client_by_contact_id(contact_id)
+            client_info = await get_client_by_contact_id(contact_id)
             if not client_info:
                 logging.error(f"Клиент с contact_id {contact_id} не найден.")
                 return
@@ -1262,7 +1280,7 @@ async def process_final_deal(
     contact_id = deal_info.get('CONTACT_ID')
     today_date = datetime.now(timezone.utc).date()
 
-    final_deal = get_final_deal_from_db(contact_id)
+    final_deal = await get_final_deal_from_db(contact_id)
     logging.info(f"Проверяем наличие итоговой сделки для контакта {contact_id}. Найдено: {final_deal}")
 
     expected_awaiting_pickup_stage = stage_mapping.get(pipeline_stage, {}).get('awaiting_pickup')
@@ -1304,6 +1322,7 @@ async def _update_existing_final_deal(
       - Если значения веса, суммы и количества заказов отличаются – суммирует их с новыми и
         вызывает метод обновления итоговой сделки.
       - Если значения совпадают – обновляет только список трек‑номеров.
+      - Трек-номер, уже входящий в итоговую сделку, повторно не добавляется.
       - Затем обновляет запись в базе и удаляет сделку по track_number.
     """
     logging.debug(f"Тип deal_info: {type(deal_info)}; содержимое: {deal_info}")
@@ -1314,15 +1333,6 @@ async def _update_existing_final_deal(
     track_number: str = deal_info.get('UF_CRM_1723542556619', '')
     logging.debug(f"deal_id: {deal_id}, track_number: {track_number}")
 
-    current_track_numbers = final_deal.get('track_numbers', '')
-    updated_track_numbers = (
-        f"{current_track_numbers}, {track_number}".strip(', ')
-        if current_track_numbers else track_number
-    )
-    # Получаем список трек-номеров из текущего агрегированного поля
-    track_list = [t.strip() for t in updated_track_numbers.split(',') if t.strip()]
-    logging.debug(f"current_track_numbers: {current_track_numbers}, updated_track_numbers: {updated_track_numbers}")
-
     # Получаем данные итоговой сделки
     final_deal_id = final_deal.get('final_deal_id')
     final_weight = final_deal.get('total_weight', 0)
@@ -1350,49 +1360,58 @@ async def _update_existing_final_deal(
     archive_stage_id = stage_mapping.get(pipeline_stage, {}).get('archive', 'LOSE')
     logging.debug(f"pipeline_stage: {pipeline_stage}, archive_stage_id: {archive_stage_id}")
 
-    # Сравниваем агрегированные значения
-    if (float(weight), float(amount), int(number_of_orders)) != (
-            float(final_weight), float(final_amount), int(final_orders)):
-        new_weight = float(final_weight) + float(weight)
-        new_amount = float(final_amount) + float(amount)
-        new_orders = float(final_orders) + float(number_of_orders)
-
-        if int(len(track_list)) != int(new_orders):
-            logging.info("Агрегированные значения не изменились. Обновляем только список трек‑номеров.")
-            ops_builder.add_update_track_numbers(final_deal['final_deal_id'], updated_track_numbers)
-            update_final_deal_in_db(final_deal['final_deal_id'], updated_track_numbers, final_deal['current_stage_id'])
-            logging.info("Локальная запись итоговой сделки обновлена списком трек‑номеров.")
-        else:
-            logging.info(
-                f"Обновление итоговой сделки: суммирование данных - вес: {final_weight} + {weight} = {new_weight}, "
-                f"сумма: {final_amount} + {amount} = {new_amount}, заказы: {final_orders} + {number_of_orders} = {new_orders}"
-            )
-            logging.debug(f"Обновление существующей итоговой сделки с final_deal_id: {final_deal_id}")
-            ops_builder.add_update_existing_final_deal(
-                final_deal_id=final_deal_id,
-                client_info=client_info,
-                contact_id=client_info['contact_id'],
-                expected_awaiting_pickup_stage=stage_mapping.get(pipeline_stage, {}).get('awaiting_pickup'),
-                category_id=final_deal.get('category_id', 0),
-                pickup_point_mapped=pickup_point_mapped,
-                weight=float(new_weight),
-                amount=float(new_amount),
-                number_of_orders=int(new_orders),
-                track_number=updated_track_numbers
-            )
-            logging.debug("Операция обновления итоговой сделки добавлена.")
-            ops_builder.add_update_contact_fields(client_info['contact_id'], str(new_weight), float(new_amount),
-                                                  int(new_orders))
-            logging.debug("Операция обновления данных контакта добавлена.")
-            update_final_deal_in_db(final_deal['final_deal_id'], updated_track_numbers,
-                                    final_deal['current_stage_id'],
-                                    weight=new_weight, amount=new_amount, orders=new_orders)
-            logging.info("Локальная запись итоговой сделки обновлена новыми агрегированными значениями.")
+    # Трек-номера итоговой сделки хранятся в final_deal_tracks, итоги пересчитываются базой при добавлении.
+    # Строка для поля Bitrix собирается только для отправляемой операции.
+    current_track_numbers = await get_final_deal_track_numbers(final_deal_id)
+    logging.debug(f"current_track_numbers: {current_track_numbers}")
+    if track_number in current_track_numbers:
+        logging.info(f"Трек-номер {track_number} уже входит в итоговую сделку {final_deal_id}. Обновление не требуется.")
     else:
-        logging.info("Агрегированные значения не изменились. Обновляем только список трек‑номеров.")
-        ops_builder.add_update_track_numbers(final_deal['final_deal_id'], updated_track_numbers)
-        update_final_deal_in_db(final_deal['final_deal_id'], updated_track_numbers, final_deal['current_stage_id'])
-        logging.info("Локальная запись итоговой сделки обновлена списком трек‑номеров.")
+        updated_track_numbers = ", ".join(current_track_numbers + [track_number])
+        track_count = len(current_track_numbers) + 1
+
+        # Сравниваем агрегированные значения
+        if (float(weight), float(amount), int(number_of_orders)) != (
+                float(final_weight), float(final_amount), int(final_orders)):
+            new_weight = float(final_weight) + float(weight)
+            new_amount = float(final_amount) + float(amount)
+            new_orders = float(final_orders) + float(number_of_orders)
+
+            if track_count != int(new_orders):
+                logging.info("Агрегированные значения не изменились. Обновляем только список трек‑номеров.")
+                ops_builder.add_update_track_numbers(final_deal_id, updated_track_numbers)
+                await append_final_deal_track(final_deal_id, track_number)
+                logging.info("Трек-номер добавлен в локальную запись итоговой сделки.")
+            else:
+                logging.info(
+                    f"Обновление итоговой сделки: суммирование данных - вес: {final_weight} + {weight} = {new_weight}, "
+                    f"сумма: {final_amount} + {amount} = {new_amount}, заказы: {final_orders} + {number_of_orders} = {new_orders}"
+                )
+                logging.debug(f"Обновление существующей итоговой сделки с final_deal_id: {final_deal_id}")
+                ops_builder.add_update_existing_final_deal(
+                    final_deal_id=final_deal_id,
+                    client_info=client_info,
+                    contact_id=client_info['contact_id'],
+                    expected_awaiting_pickup_stage=stage_mapping.get(pipeline_stage, {}).get('awaiting_pickup'),
+                    category_id=final_deal.get('category_id', 0),
+                    pickup_point_mapped=pickup_point_mapped,
+                    weight=float(new_weight),
+                    amount=float(new_amount),
+                    number_of_orders=int(new_orders),
+                    track_number=updated_track_numbers
+                )
+                logging.debug("Операция обновления итоговой сделки добавлена.")
+                ops_builder.add_update_contact_fields(client_info['contact_id'], str(new_weight), float(new_amount),
+                                                      int(new_orders))
+                logging.debug("Операция обновления данных контакта добавлена.")
+                await append_final_deal_track(final_deal_id, track_number, weight=float(weight), amount=float(amount),
+                                              number_of_orders=int(number_of_orders))
+                logging.info("Трек-номер и его вес, сумма и заказы добавлены в локальную запись итоговой сделки.")
+        else:
+            logging.info("Агрегированные значения не изменились. Обновляем только список трек‑номеров.")
+            ops_builder.add_update_track_numbers(final_deal_id, updated_track_numbers)
+            await append_final_deal_track(final_deal_id, track_number)
+            logging.info("Трек-номер добавлен в локальную запись итоговой сделки.")
 
     # Архивируем текущую сделку
     ops_builder.add_archive_deal(deal_id, archive_stage_id)
@@ -1455,13 +1474,13 @@ async def _update_current_deal_as_final(
         logging.info(f"Операция обновления данных контакта {contact_id} добавлена.")
     else:
         logging.info(f"Операция обновления данных контакта {contact_id} уже существует.")
-    update_name_track_by_track_number(track_number, "Прибывшие посылки")
+    await update_name_track_by_track_number(track_number, "Прибывшие посылки")
     archive_stage_id = stage_mapping.get(pipeline_stage, {}).get('archive', 'LOSE')
-    ops_builder.add_create_copy_of_deal(contact_id, client_info, archive_stage_id, category_id, pickup_point_mapped,
-                                        client_info['chat_id'], track_number)
+    ops_builder.add_create_copy_of_deal(deal_id, contact_id, client_info, archive_stage_id, category_id,
+                                        pickup_point_mapped, client_info['chat_id'], track_number)
     logging.info(f"Создание копии сделки добавлено в операции: {deal_id}.")
     logging.info(f"{stage_mapping.get(pipeline_stage, {}).get('awaiting_pickup')}")
-    save_final_deal_to_db(
+    await save_final_deal_to_db(
         contact_id=contact_id,
         deal_id=deal_id,
         creation_date=today_date.isoformat(),
@@ -1523,12 +1542,12 @@ async def process_deal_add(
 
     # 2. Обновление истории сделки
     raw_date = deal_info.get("UF_CRM_1743357179") or deal_info.get("DATE_MODIFY")
-    raw_date = trim_time_from_iso(raw_date)
-    update_deal_history(
+    await update_deal_history(
         precheck['deal_id'],
         precheck['track_number'],
         precheck['stage_id'],
-        raw_date
+        trim_time_from_iso(raw_date),
+        changed_at=raw_date
     )
 
     # 3. Обработка сделки по категориям
@@ -1548,12 +1567,12 @@ async def process_deal_add(
         contact_id = precheck.get('contact_id')
         if contact_id:
             contact_id = int(contact_id)
-        chat_id = get_chat_id_by_contact_id(contact_id)
+        chat_id = await get_chat_id_by_contact_id(contact_id)
         if chat_id:
-            client_info = get_client_by_chat_id(chat_id)
+            client_info = await get_client_by_chat_id(chat_id)
         if not client_info and contact_id:
             logging.info(f"Попытка получения данных клиента по contact_id {contact_id}")
-            client_info = get_client_by_contact_id(contact_id)
+            client_info = await get_client_by_contact_id(contact_id)
         if not client_info:
             logging.error(f"Клиентская информация не найдена для contact_id {contact_id}. Пропуск обработки.")
             return
@@ -1574,13 +1593,13 @@ async def process_contact_update(contact_info):
         return
 
     # Получаем chat_id по contact_id
-    chat_id = get_chat_id_by_contact_id(contact_id)
+    chat_id = await get_chat_id_by_contact_id(contact_id)
     if not chat_id:
         logging.warning(f"chat_id для контакта {contact_id} не найден.")
         return
 
     # Получаем данные из локальной базы данных
-    client_data = get_client_by_chat_id(chat_id)
+    client_data = await get_client_by_chat_id(chat_id)
     if not client_data:
         logging.warning(f"Данные клиента для chat_id {chat_id} не найдены.")
         return
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import random
+import time
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов по алгоритму token bucket с адаптивной скоростью.
+
+    Токены пополняются со скоростью rate в секунду и накапливаются не более capacity штук,
+    поэтому после простоя допускается короткий всплеск запросов.
+    При превышении лимита на стороне сервера скорость снижается (slow_down),
+    после успешных запросов постепенно восстанавливается до max_rate (recover).
+    """
+
+    def __init__(self, rate, capacity, min_rate=None):
+        self.max_rate = rate
+        self.min_rate = min_rate or rate / 8
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        """
+        Ждёт, пока в корзине появится токен, и забирает его.
+        """
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def slow_down(self, factor=0.5):
+        """
+        Снижает скорость после ответа о превышении лимита и сбрасывает накопленные токены.
+        """
+        self._refill()
+        self.rate = max(self.min_rate, self.rate * factor)
+        self._tokens = 0
+        logging.warning(f"Превышен лимит запросов. Скорость снижена до {self.rate:.2f} запросов/с.")
+
+    def recover(self, step=0.1):
+        """
+        Постепенно возвращает скорость к максимальной после успешного запроса.
+        """
+        if self.rate < self.max_rate:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + step)
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    """
+    Задержка перед повторной попыткой: экспоненциальный рост с полным случайным разбросом (full jitter),
+    чтобы параллельные запросы не повторялись одновременно.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
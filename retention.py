@@ -0,0 +1,199 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from config import ARCHIVE_DIR, DATABASE_PATH
+from db_pool import get_connection
+from db_async import run_in_db
+
+
+# ========== Настройки хранения ==========
+# Для каждой таблицы: условие, по которому строка больше не нужна боту, срок хранения в днях
+# и формат метки времени (webhooks и processed_results пишут isoformat, crm_sync_runs — Unix time,
+# остальные — CURRENT_TIMESTAMP).
+# deal_history не очищается: это текущее состояние отслеживаемых посылок (этап и дата отправки из Китая),
+# а не журнал обработанных строк, и created_at в нём не обновляется при изменениях.
+RETENTION_POLICIES = {
+    "webhooks": {
+        "condition": "processed = 1 AND timestamp < ?",
+        "days": 30,
+        "iso": True,
+    },
+    "processed_results": {
+        "condition": "sent IN (1, 3) AND timestamp < ?",
+        "days": 30,
+        "iso": True,
+    },
+    "broadcast_messages": {
+        # Получатели незавершённой рассылки нужны для её продолжения
+        "condition": "timestamp < ? AND broadcast_id IN (SELECT id FROM broadcasts WHERE status != 'running')",
+        "days": 90,
+        "iso": False,
+    },
+    "crm_sync_runs": {
+        "condition": "started_at < ?",
+        "days": 30,
+        "iso": False,
+        "epoch": True,
+    },
+}
+
+DELETE_BATCH_SIZE = 1000          # Строк, удаляемых одной транзакцией
+BATCH_PAUSE = 0.1                 # Пауза между пакетами, чтобы запросы бота не ждали очистки (с)
+VACUUM_PAGES = 2000               # Страниц, возвращаемых файловой системе за один запуск
+RETENTION_START_DELAY = 300       # Первый запуск через 5 минут после старта бота
+RETENTION_INTERVAL = 24 * 3600    # Затем раз в сутки
+
+
+def _cutoff(days, iso, epoch=False):
+    if epoch:
+        return time.time() - days * 86400
+    moment = datetime.utcnow() - timedelta(days=days)
+    return moment.isoformat() if iso else moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def get_table_sizes():
+    """
+    Возвращает словарь {таблица или индекс: размер в байтах}.
+    Если SQLite собран без dbstat, возвращает количество строк в таблицах политики хранения.
+
+    dbstat читает весь файл базы, поэтому отчёт строится через отдельное соединение только для чтения
+    и вызывается вне потока базы данных (asyncio.to_thread): в режиме WAL он не задерживает запросы бота.
+    """
+    conn = sqlite3.connect(f"file:{DATABASE_PATH}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name").fetchall()
+        return {name: size for name, size in rows}
+    except sqlite3.OperationalError:
+        return {f"{table} (строк)": conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in RETENTION_POLICIES}
+    finally:
+        conn.close()
+
+
+def get_database_size():
+    conn = get_connection()
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return page_size * page_count, page_size * freelist_count
+
+
+def archive_batch(table, condition, cutoff, batch_size=DELETE_BATCH_SIZE):
+    """
+    Переносит до batch_size устаревших строк таблицы в архив {ARCHIVE_DIR}/{table}-{ГГГГ-ММ}.jsonl.gz
+    и удаляет их одной короткой транзакцией. Строки сначала дописываются в архив, затем удаляются,
+    поэтому при сбое между этими шагами строка может попасть в архив повторно, но не потеряется.
+    Возвращает количество перенесённых строк.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT * FROM {table} WHERE {condition} ORDER BY id LIMIT ?", (cutoff, batch_size))
+    rows = cursor.fetchall()
+    if not rows:
+        return 0
+
+    columns = [column[0] for column in cursor.description]
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    archive_path = os.path.join(ARCHIVE_DIR, f"{table}-{datetime.utcnow():%Y-%m}.jsonl.gz")
+    with gzip.open(archive_path, "at", encoding="utf-8") as archive:
+        for row in rows:
+            archive.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+
+    ids = [row[columns.index("id")] for row in rows]
+    try:
+        cursor.execute(f"DELETE FROM {table} WHERE id IN ({','.join('?' * len(ids))})", ids)
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Ошибка при удалении архивированных строк из {table}: {e}")
+        return 0
+    return len(ids)
+
+
+def incremental_vacuum(pages=VACUUM_PAGES):
+    """
+    Возвращает файловой системе до pages свободных страниц.
+    Если в базе ещё не включён auto_vacuum = INCREMENTAL, место не освобождается: для включения нужен
+    полный VACUUM, который блокирует базу на всё время перестройки, поэтому он выполняется только
+    командой администратора /vacuum (enable_incremental_vacuum).
+    """
+    conn = get_connection()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        logging.info("Хранение данных: auto_vacuum = INCREMENTAL не включён, место в файле базы не освобождается. "
+                     "Включите его командой /vacuum в период низкой нагрузки.")
+        return
+    # Каждый шаг выражения освобождает одну страницу, поэтому результат нужно прочитать целиком
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+
+
+def enable_incremental_vacuum():
+    """
+    Включает auto_vacuum = INCREMENTAL однократным полным VACUUM. Пока он выполняется, остальные запросы
+    к базе ждут, поэтому функция вызывается только явно, командой администратора.
+    Возвращает True, если режим включён этим вызовом, и False, если он уже был включён.
+    """
+    conn = get_connection()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    logging.info("Включение auto_vacuum = INCREMENTAL (однократный полный VACUUM)...")
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    logging.info("auto_vacuum = INCREMENTAL включён.")
+    return True
+
+
+def _format_size(size):
+    return f"{size / 1024 / 1024:.1f} МБ"
+
+
+async def run_retention():
+    """
+    Архивирует и удаляет устаревшие строки по RETENTION_POLICIES, освобождает место в файле базы
+    и логирует размеры таблиц до и после очистки. Возвращает словарь {таблица: перенесено строк}.
+    """
+    sizes_before = await asyncio.to_thread(get_table_sizes)
+    db_size_before, _ = await run_in_db(get_database_size)
+
+    archived = {}
+    for table, policy in RETENTION_POLICIES.items():
+        cutoff = _cutoff(policy["days"], policy["iso"], policy.get("epoch", False))
+        archived[table] = 0
+        while True:
+            # Каждый пакет — отдельное задание потока базы, между ними успевают выполниться запросы бота
+            count = await run_in_db(archive_batch, table, policy["condition"], cutoff)
+            archived[table] += count
+            if count < DELETE_BATCH_SIZE:
+                break
+            await asyncio.sleep(BATCH_PAUSE)
+        if archived[table]:
+            logging.info(f"Хранение данных: из {table} перенесено в архив {archived[table]} строк старше {cutoff}.")
+
+    await run_in_db(incremental_vacuum)
+
+    sizes_after = await asyncio.to_thread(get_table_sizes)
+    db_size_after, free_after = await run_in_db(get_database_size)
+    for name in sorted(sizes_before, key=sizes_before.get, reverse=True):
+        before, after = sizes_before[name], sizes_after.get(name, 0)
+        if before != after:
+            logging.info(f"Хранение данных: {name}: {before} -> {after}")
+    logging.info(f"Хранение данных: размер базы {_format_size(db_size_before)} -> {_format_size(db_size_after)}, "
+                 f"свободно внутри файла {_format_size(free_after)}.")
+    return archived
+
+
+async def retention_loop():
+    """
+    Периодически запускает очистку. Запускается вместе с ботом и сервером.
+    """
+    await asyncio.sleep(RETENTION_START_DELAY)
+    while True:
+        try:
+            await run_retention()
+        except Exception as e:
+            logging.error(f"Ошибка при очистке устаревших данных: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
@@ -0,0 +1,29 @@
+import os
+import sys
+import types
+
+import pytest
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def migrated_connection(tmp_path, monkeypatch):
+    """
+    Соединение с временной базой после init_db: все таблицы созданы, миграции применены.
+    config подменяется, чтобы не требовались .env и клиент Bitrix.
+    """
+    database_path = str(tmp_path / "clients.db")
+    config = types.ModuleType("config")
+    config.DATABASE_PATH = database_path
+    monkeypatch.setitem(sys.modules, "config", config)
+
+    import db_pool
+    import db_management
+    monkeypatch.setattr(db_pool, "DATABASE_PATH", database_path)
+    db_pool.close_all_connections()
+
+    db_management.init_db()
+    yield db_pool.get_connection()
+    db_pool.close_all_connections()
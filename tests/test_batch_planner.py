@@ -0,0 +1,63 @@
+from batch_planner import Operation, plan_operations
+
+
+def _plan_keys(plan):
+    return [list(chunk) for chunk in plan.chunks]
+
+
+def test_updates_of_one_deal_are_merged_with_later_values_winning():
+    plan = plan_operations({
+        "update_deal_10": "crm.deal.update?ID=10&fields[TITLE]=old&fields[CITY]=Astana",
+        "archive_deal_10": "crm.deal.update?ID=10&fields[STAGE_ID]=LOSE&fields[TITLE]=new",
+    })
+
+    assert plan.chunks == [{
+        "update_deal_10": "crm.deal.update?ID=10&fields[TITLE]=new&fields[CITY]=Astana&fields[STAGE_ID]=LOSE"
+    }]
+    assert plan.aliases == {"update_deal_10": "update_deal_10", "archive_deal_10": "update_deal_10"}
+
+
+def test_operations_on_deleted_deal_are_dropped():
+    plan = plan_operations({
+        "detach_old_contact_10_5": "crm.deal.contact.items.delete?ID=10&CONTACT_ID=5",
+        "update_deal_10": "crm.deal.update?ID=10&fields[TITLE]=x",
+        "delete_deal_10": "crm.deal.delete?id=10",
+        "update_deal_11": "crm.deal.update?ID=11&fields[TITLE]=y",
+    })
+
+    assert sorted(key for chunk in plan.chunks for key in chunk) == ["delete_deal_10", "update_deal_11"]
+    assert plan.aliases["detach_old_contact_10_5"] is None
+    assert plan.aliases["update_deal_10"] is None
+
+
+def test_result_references_keep_commands_in_one_chunk_in_dependency_order():
+    operations = {
+        "update_copy": "crm.deal.update?ID=$result[create_copy]&fields[TITLE]=copy",
+        "create_copy": "crm.deal.add?fields[TITLE]=copy",
+    }
+    operations.update({f"update_deal_{deal_id}": f"crm.deal.update?ID={deal_id}&fields[TITLE]=t"
+                       for deal_id in range(1, 4)})
+
+    plan = plan_operations(operations, batch_limit=2)
+
+    assert all(len(chunk) <= 2 for chunk in plan.chunks)
+    [linked] = [keys for keys in _plan_keys(plan) if "create_copy" in keys]
+    assert linked == ["create_copy", "update_copy"]
+
+
+def test_groups_are_packed_into_minimum_number_of_chunks():
+    operations = {f"update_deal_{deal_id}": f"crm.deal.update?ID={deal_id}&fields[TITLE]=t"
+                  for deal_id in range(120)}
+
+    plan = plan_operations(operations)
+
+    assert [len(chunk) for chunk in plan.chunks] == [50, 50, 20]
+
+
+def test_parse_detects_entity_and_dependencies():
+    task = Operation.parse("almaty_task_7", "tasks.task.add?fields[TITLE]=t&fields[UF_CRM_TASK]=D_7")
+    copy = Operation.parse("update_copy", "crm.deal.update?ID=$result[create_copy]&fields[TITLE]=t")
+
+    assert task.entity == "deal:7"
+    assert copy.depends_on == ["create_copy"]
+    assert copy.to_query() == "crm.deal.update?ID=$result[create_copy]&fields[TITLE]=t"
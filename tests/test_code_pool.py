@@ -0,0 +1,77 @@
+def _is_free(connection, code):
+    return connection.execute("SELECT 1 FROM free_codes WHERE code = ?", (code,)).fetchone() is not None
+
+
+def _save_client(chat_id, personal_code, phone):
+    from db_management import save_client_data
+    save_client_data(chat_id, 1, personal_code, "Имя", "Imya", phone, "Астана", "pv_astana_1")
+
+
+def _first_vip_code(connection):
+    return connection.execute("SELECT vip_code FROM vip_codes LIMIT 1").fetchone()[0]
+
+
+def test_generated_codes_are_unique_and_leave_the_pool(migrated_connection):
+    from db_management import generate_unique_code
+    codes = [generate_unique_code() for _ in range(20)]
+
+    assert len(set(codes)) == 20
+    assert all(len(code) == 4 for code in codes)
+    assert not any(_is_free(migrated_connection, code) for code in codes)
+
+
+def test_vip_codes_are_not_in_the_pool(migrated_connection):
+    assert not _is_free(migrated_connection, _first_vip_code(migrated_connection))
+
+
+def test_code_assigned_outside_the_pool_is_skipped(migrated_connection):
+    from db_management import generate_unique_code
+    # Следующий по порядку выдачи код назначен вручную, минуя пул
+    taken = migrated_connection.execute("SELECT code FROM free_codes ORDER BY sort_key LIMIT 1").fetchone()[0]
+    _save_client(1, taken, "77000000001")
+
+    code = generate_unique_code()
+    assert code != taken
+    assert not _is_free(migrated_connection, taken)
+
+
+def test_pool_is_widened_below_low_watermark(migrated_connection):
+    from db_management import CODE_POOL_LOW_WATERMARK, generate_unique_code
+    migrated_connection.execute("DELETE FROM free_codes WHERE rowid NOT IN (SELECT rowid FROM free_codes LIMIT ?)",
+                                (CODE_POOL_LOW_WATERMARK,))
+    migrated_connection.commit()
+
+    generate_unique_code()
+    digits = migrated_connection.execute("SELECT digits FROM code_pool WHERE id = 1").fetchone()[0]
+    five_digit = migrated_connection.execute("SELECT COUNT(*) FROM free_codes WHERE length(code) = 5").fetchone()[0]
+    assert digits == 5
+    assert five_digit >= 89000
+
+
+def test_deleted_client_returns_code_to_the_pool(migrated_connection):
+    from db_management import delete_client_from_db, generate_unique_code
+    code = generate_unique_code()
+    _save_client(1, code, "77000000001")
+
+    assert delete_client_from_db("77000000001") is True
+    assert _is_free(migrated_connection, code)
+
+
+def test_vip_code_is_not_released(migrated_connection):
+    from db_management import delete_client_from_db
+    vip_code = _first_vip_code(migrated_connection)
+    _save_client(1, vip_code, "77000000001")
+
+    delete_client_from_db("77000000001")
+    assert not _is_free(migrated_connection, vip_code)
+
+
+def test_changed_personal_code_swaps_pool_membership(migrated_connection):
+    from db_management import generate_unique_code, update_personal_code
+    old_code = generate_unique_code()
+    _save_client(1, old_code, "77000000001")
+    new_code = migrated_connection.execute("SELECT code FROM free_codes LIMIT 1").fetchone()[0]
+
+    assert update_personal_code(old_code, new_code) is True
+    assert _is_free(migrated_connection, old_code)
+    assert not _is_free(migrated_connection, new_code)
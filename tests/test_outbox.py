@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+
+class FakeBitrix:
+    """
+    Заменяет batch_processing.send_plan: запоминает отправленные команды и не выполняет ключи из failing.
+    """
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.sent = []
+
+    async def __call__(self, plan):
+        for chunk in plan.chunks:
+            self.sent.extend(chunk.values())
+        return {key: "Ошибка Bitrix" for key, alias in plan.aliases.items() if alias in self.failing}
+
+
+def _outbox(connection):
+    return connection.execute(
+        "SELECT operation_key, sent, attempts FROM processed_results ORDER BY id").fetchall()
+
+
+def test_sent_operations_are_completed(migrated_connection):
+    from db_management import enqueue_operations
+    from outbox import drain_outbox
+    enqueue_operations({"update_deal_1": "crm.deal.update?ID=1&fields[TITLE]=a",
+                        "delete_deal_2": "crm.deal.delete?id=2"}, "test")
+    bitrix = FakeBitrix()
+
+    assert asyncio.run(drain_outbox(bitrix)) == 2
+    assert sorted(bitrix.sent) == ["crm.deal.delete?id=2", "crm.deal.update?ID=1&fields[TITLE]=a"]
+    assert _outbox(migrated_connection) == [("update_deal_1", 1, 0), ("delete_deal_2", 1, 0)]
+    assert asyncio.run(drain_outbox(bitrix)) == 0
+
+
+def test_failed_operation_is_retried_after_backoff(migrated_connection):
+    from db_management import enqueue_operations
+    from outbox import OUTBOX_RETRY_DELAY, drain_outbox
+    enqueue_operations({"update_deal_1": "crm.deal.update?ID=1&fields[TITLE]=a",
+                        "update_deal_2": "crm.deal.update?ID=2&fields[TITLE]=b"}, "test")
+
+    before = time.time()
+    asyncio.run(drain_outbox(FakeBitrix(failing={"update_deal_1"})))
+
+    assert _outbox(migrated_connection) == [("update_deal_1", 0, 1), ("update_deal_2", 1, 0)]
+    next_attempt_at, last_error = migrated_connection.execute(
+        "SELECT next_attempt_at, last_error FROM processed_results WHERE operation_key = 'update_deal_1'").fetchone()
+    assert next_attempt_at >= before + OUTBOX_RETRY_DELAY
+    assert last_error == "Ошибка Bitrix"
+    # До наступления срока повтора операция не отправляется
+    assert asyncio.run(drain_outbox(FakeBitrix())) == 0
+
+
+def test_operation_is_dead_lettered_after_max_attempts(migrated_connection, monkeypatch):
+    import outbox
+    from db_management import enqueue_operations, get_dead_letters, retry_dead_letters
+    monkeypatch.setattr(outbox, "OUTBOX_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(outbox, "OUTBOX_RETRY_DELAY", 0)
+    enqueue_operations({"update_deal_1": "crm.deal.update?ID=1&fields[TITLE]=a"}, "test")
+    bitrix = FakeBitrix(failing={"update_deal_1"})
+
+    asyncio.run(outbox.drain_outbox(bitrix))
+    asyncio.run(outbox.drain_outbox(bitrix))
+
+    assert _outbox(migrated_connection) == [("update_deal_1", 2, 2)]
+    assert [letter['key'] for letter in get_dead_letters()] == ["update_deal_1"]
+    assert asyncio.run(outbox.drain_outbox(bitrix)) == 0
+
+    assert retry_dead_letters() == 1
+    assert asyncio.run(outbox.drain_outbox(FakeBitrix())) == 1
+    assert _outbox(migrated_connection) == [("update_deal_1", 1, 0)]
+
+
+def test_newer_operation_supersedes_pending_one(migrated_connection):
+    from db_management import enqueue_operations
+    from outbox import drain_outbox
+    enqueue_operations({"update_deal_1": "crm.deal.update?ID=1&fields[TITLE]=old"}, "test")
+    enqueue_operations({"update_deal_1": "crm.deal.update?ID=1&fields[TITLE]=new"}, "test")
+    bitrix = FakeBitrix()
+
+    asyncio.run(drain_outbox(bitrix))
+
+    assert bitrix.sent == ["crm.deal.update?ID=1&fields[TITLE]=new"]
+    assert _outbox(migrated_connection) == [("update_deal_1", 3, 0), ("update_deal_1", 1, 0)]
+
+
+def test_operation_superseded_while_sending_is_left_for_the_newer_one(migrated_connection):
+    from db_management import enqueue_operations
+    from outbox import drain_outbox
+    enqueue_operations({"update_deal_1": "crm.deal.update?ID=1&fields[TITLE]=old"}, "test")
+    bitrix = FakeBitrix(failing={"update_deal_1"})
+
+    async def send_while_superseding(plan):
+        # Пока операция отправляется, вебхук ставит более новую с тем же ключом
+        enqueue_operations({"update_deal_1": "crm.deal.update?ID=1&fields[TITLE]=new"}, "test")
+        return await bitrix(plan)
+
+    assert asyncio.run(drain_outbox(send_while_superseding)) == 1
+    assert _outbox(migrated_connection) == [("update_deal_1", 3, 0), ("update_deal_1", 0, 0)]
+
+    bitrix.failing.clear()
+    assert asyncio.run(drain_outbox(bitrix)) == 1
+    assert bitrix.sent[-1] == "crm.deal.update?ID=1&fields[TITLE]=new"
@@ -0,0 +1,19 @@
+def test_hot_queries_use_indexes(migrated_connection):
+    from db_management import HOT_QUERIES
+    from db_migrations import find_full_scans
+    assert find_full_scans(migrated_connection, HOT_QUERIES) == {}
+
+
+def test_trigger_statements_use_indexes(migrated_connection):
+    from db_migrations import find_full_scans, trigger_queries
+    queries = trigger_queries(migrated_connection)
+    assert "final_deal_tracks_after_insert[0]" in queries
+    assert find_full_scans(migrated_connection, queries) == {}
+
+
+def test_find_full_scans_reports_unindexed_query(migrated_connection):
+    from db_migrations import find_full_scans
+    query = ("SELECT chat_id FROM clients WHERE name_cyrillic = ?", ("",))
+    problems = find_full_scans(migrated_connection, {"by_name": query})
+    assert list(problems) == ["by_name"]
+    assert problems["by_name"][0].startswith("SCAN")
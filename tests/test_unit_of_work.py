@@ -0,0 +1,65 @@
+import asyncio
+
+
+def _tasks(connection):
+    return connection.execute("SELECT deal_id, task_id FROM deal_tasks ORDER BY deal_id").fetchall()
+
+
+def test_commit_applies_writes_in_order_and_counts_rows(migrated_connection):
+    from unit_of_work import UnitOfWork
+    unit_of_work = UnitOfWork()
+    unit_of_work.add("save_task", (1, 10))
+    unit_of_work.add("save_task", (2, 20))
+    unit_of_work.add("delete_task", (1,))
+    unit_of_work.add("delete_task", (3,))
+
+    counts = asyncio.run(unit_of_work.commit())
+
+    assert counts == {"save_task": 2, "delete_task": 1}
+    assert _tasks(migrated_connection) == [(2, 20)]
+    assert len(unit_of_work) == 0
+
+
+def test_commit_rolls_back_all_writes_on_error(migrated_connection):
+    from unit_of_work import UnitOfWork
+    unit_of_work = UnitOfWork()
+    unit_of_work.add("save_task", (1, 10))
+    unit_of_work.add("delete_task", (1, "лишний параметр"))
+
+    assert asyncio.run(unit_of_work.commit()) is None
+    assert _tasks(migrated_connection) == []
+
+
+def test_empty_commit_does_not_touch_the_database(migrated_connection):
+    from unit_of_work import UnitOfWork
+    assert asyncio.run(UnitOfWork().commit()) == {}
+
+
+def test_enqueued_operations_are_committed_with_local_writes(migrated_connection):
+    from unit_of_work import UnitOfWork
+    unit_of_work = UnitOfWork()
+    unit_of_work.add("save_task", (1, 10))
+    unit_of_work.enqueue_operations({"update_deal_1": "crm.deal.update?ID=1&fields[TITLE]=t"}, "webhook_batch")
+
+    counts = asyncio.run(unit_of_work.commit())
+
+    assert counts == {"save_task": 1, "supersede_operation": 0, "enqueue_operation": 1}
+    row = migrated_connection.execute(
+        "SELECT operation_key, entity_id, event_type, action, sent FROM processed_results").fetchone()
+    assert row == ("update_deal_1", 1, "webhook_batch", "crm.deal.update", 0)
+
+
+def test_batch_writers_are_deferred_until_commit(migrated_connection):
+    import batch_context
+    from unit_of_work import UnitOfWork, use_unit_of_work
+
+    async def process():
+        unit_of_work = UnitOfWork()
+        with use_unit_of_work(unit_of_work):
+            await batch_context.save_task_to_db(1, 10)
+        deferred = _tasks(migrated_connection)
+        await unit_of_work.commit()
+        return deferred
+
+    assert asyncio.run(process()) == []
+    assert _tasks(migrated_connection) == [(1, 10)]
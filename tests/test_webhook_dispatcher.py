@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+
+async def _run_dispatcher(dispatcher, until, timeout=2.0):
+    task = asyncio.create_task(dispatcher.run())
+    try:
+        await asyncio.wait_for(until.wait(), timeout)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def test_failed_batch_is_retried_without_new_webhooks(migrated_connection):
+    from webhook_dispatcher import WebhookDispatcher
+    calls = []
+    done = asyncio.Event()
+
+    async def process_batch():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            raise RuntimeError("Bitrix недоступен")
+        done.set()
+
+    async def scenario():
+        dispatcher = WebhookDispatcher(process_batch, debounce=0.01, max_latency=0.05, max_retry_delay=0.02)
+        dispatcher.notify()
+        await _run_dispatcher(dispatcher, done)
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+
+
+def test_coalesced_event_during_processing_starts_next_window(migrated_connection):
+    from webhook_dispatcher import WebhookDispatcher
+    calls = []
+    done = asyncio.Event()
+
+    async def scenario():
+        dispatcher = WebhookDispatcher(None, debounce=0.01, max_latency=0.05)
+
+        async def process_batch():
+            calls.append(len(calls))
+            if len(calls) == 1:
+                # Повторное событие для вебхука, который сейчас обрабатывается
+                dispatcher.notify(0)
+            else:
+                done.set()
+
+        dispatcher._process_batch = process_batch
+        dispatcher.notify()
+        await _run_dispatcher(dispatcher, done)
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+
+
+def test_coalesced_event_while_idle_does_not_start_processing(migrated_connection):
+    from webhook_dispatcher import WebhookDispatcher
+    calls = []
+
+    async def process_batch():
+        calls.append(len(calls))
+
+    async def scenario():
+        dispatcher = WebhookDispatcher(process_batch, debounce=0.01, max_latency=0.05)
+        dispatcher.notify(0)
+        await _run_dispatcher(dispatcher, asyncio.Event(), timeout=0.1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(scenario())
+    assert calls == []
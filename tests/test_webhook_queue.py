@@ -0,0 +1,79 @@
+def _webhook_row(connection, webhook_id):
+    cursor = connection.execute(
+        "SELECT processed, duplicates, lease_owner, timestamp FROM webhooks WHERE id = ?", (webhook_id,))
+    return cursor.fetchone()
+
+
+def test_repeated_event_is_coalesced(migrated_connection):
+    from db_management import save_webhook_to_db
+    assert save_webhook_to_db("101", "ONCRMDEALUPDATE") is True
+    assert save_webhook_to_db("101", "ONCRMDEALUPDATE") is False
+    assert save_webhook_to_db("102", "ONCRMDEALUPDATE") is True
+
+    rows = migrated_connection.execute(
+        "SELECT entity_id, duplicates FROM webhooks WHERE processed = 0 ORDER BY entity_id").fetchall()
+    assert rows == [("101", 1), ("102", 0)]
+
+
+def test_claimed_webhooks_are_not_given_to_another_worker(migrated_connection):
+    from db_management import save_webhook_to_db, claim_webhooks
+    for entity_id in ("1", "2", "3"):
+        save_webhook_to_db(entity_id, "ONCRMDEALUPDATE")
+
+    first = claim_webhooks("worker-1", 2, 600)
+    second = claim_webhooks("worker-2", 10, 600)
+    assert [webhook['entity_id'] for webhook in first] == ["1", "2"]
+    assert [webhook['entity_id'] for webhook in second] == ["3"]
+    assert claim_webhooks("worker-3", 10, 600) == []
+
+
+def test_expired_lease_can_be_claimed_again(migrated_connection):
+    from db_management import save_webhook_to_db, claim_webhooks
+    save_webhook_to_db("1", "ONCRMDEALUPDATE")
+
+    assert len(claim_webhooks("worker-1", 10, -1)) == 1
+    assert [webhook['entity_id'] for webhook in claim_webhooks("worker-2", 10, 600)] == ["1"]
+
+
+def test_duplicate_during_processing_keeps_lease_and_blocks_mark(migrated_connection):
+    from db_management import save_webhook_to_db, claim_webhooks, release_webhooks, apply_local_writes
+    save_webhook_to_db("1", "ONCRMDEALUPDATE")
+    [claimed] = claim_webhooks("worker-1", 10, 600)
+
+    # Повторное событие приходит, пока вебхук в обработке
+    assert save_webhook_to_db("1", "ONCRMDEALUPDATE") is False
+    processed, duplicates, lease_owner, timestamp = _webhook_row(migrated_connection, claimed['id'])
+    assert (processed, duplicates, lease_owner) == (0, 1, "worker-1")
+    assert timestamp != claimed['timestamp']
+    assert claim_webhooks("worker-2", 10, 600) == []
+
+    # Отметка по старой метке времени не срабатывает, и обработчик возвращает вебхук в очередь
+    counts = apply_local_writes([("mark_webhook_processed", (claimed['id'], claimed['timestamp']))])
+    assert counts == {"mark_webhook_processed": 0}
+    release_webhooks([claimed], "worker-1")
+
+    [reclaimed] = claim_webhooks("worker-2", 10, 600)
+    assert (reclaimed['id'], reclaimed['timestamp']) == (claimed['id'], timestamp)
+
+
+def test_release_ignores_webhooks_of_another_worker(migrated_connection):
+    from db_management import save_webhook_to_db, claim_webhooks, release_webhooks
+    save_webhook_to_db("1", "ONCRMDEALUPDATE")
+    [claimed] = claim_webhooks("worker-1", 10, 600)
+
+    release_webhooks([claimed], "worker-2")
+    assert _webhook_row(migrated_connection, claimed['id'])[2] == "worker-1"
+
+
+def test_processed_webhook_is_not_claimed_and_new_event_creates_row(migrated_connection):
+    from db_management import save_webhook_to_db, claim_webhooks, apply_local_writes
+    save_webhook_to_db("1", "ONCRMDEALUPDATE")
+    [claimed] = claim_webhooks("worker-1", 10, 600)
+
+    counts = apply_local_writes([("mark_webhook_processed", (claimed['id'], claimed['timestamp']))])
+    assert counts == {"mark_webhook_processed": 1}
+    assert _webhook_row(migrated_connection, claimed['id'])[:3] == (1, 0, None)
+
+    assert save_webhook_to_db("1", "ONCRMDEALUPDATE") is True
+    [claimed_again] = claim_webhooks("worker-1", 10, 600)
+    assert claimed_again['id'] != claimed['id']
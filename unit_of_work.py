@@ -0,0 +1,68 @@
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Tuple
+from db_async import apply_local_writes
+from db_management import outbox_writes
+
+
+class UnitOfWork:
+    """
+    Собирает локальные записи, сделанные при обработке пакета вебхуков, чтобы выполнить их
+    одной транзакцией.
+
+    Пакетная обработка вебхуков не ждёт ответа Bitrix: её операции ставятся в очередь outbox
+    (enqueue_operations) той же транзакцией, что и локальные записи, и отправляются позже
+    с повторными попытками. Поэтому локальные записи сохраняются до того, как известен результат
+    операций, и не откатываются при их ошибке. Операции, исчерпавшие попытки, остаются в outbox
+    со статусом «dead» (команда /outbox) и разбираются вручную; автоматической сверки с CRM нет.
+    """
+
+    def __init__(self) -> None:
+        self.writes: List[Tuple[str, tuple]] = []  # (вид записи, параметры)
+
+    def __len__(self) -> int:
+        return len(self.writes)
+
+    def add(self, statement: str, params: Iterable) -> None:
+        self.writes.append((statement, tuple(params)))
+
+    def enqueue_operations(self, operations: Dict[str, str], source: str) -> None:
+        """
+        Ставит операции Bitrix {ключ: команда} в очередь outbox той же транзакцией, что и локальные записи.
+        """
+        for statement, params in outbox_writes(operations, source):
+            self.add(statement, params)
+
+    async def commit(self) -> Optional[Dict[str, int]]:
+        """
+        Выполняет собранные записи одной транзакцией.
+        Возвращает словарь {вид записи: количество изменённых строк} или None, если транзакция не удалась.
+        """
+        writes, self.writes = self.writes, []
+        if not writes:
+            return {}
+
+        counts = await apply_local_writes(writes)
+        if counts is not None:
+            logging.info(f"Сохранено {len(writes)} локальных записей пакета одной транзакцией.")
+        return counts
+
+
+_current_unit_of_work: ContextVar[Optional[UnitOfWork]] = ContextVar("unit_of_work", default=None)
+
+
+def current_unit_of_work() -> Optional[UnitOfWork]:
+    return _current_unit_of_work.get()
+
+
+@contextmanager
+def use_unit_of_work(unit_of_work: UnitOfWork):
+    """
+    Направляет локальные записи функций обработки сделок в unit_of_work на время блока with.
+    """
+    token = _current_unit_of_work.set(unit_of_work)
+    try:
+        yield unit_of_work
+    finally:
+        _current_unit_of_work.reset(token)
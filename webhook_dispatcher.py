@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import time
+from db_async import get_latest_webhook_timestamp
+from rate_limiter import backoff_delay
+
+
+class WebhookDispatcher:
+    """
+    Запускает пакетную обработку вебхуков по сигналу от обработчика /icargo/webhook.
+
+    Обработка стартует при выполнении любого из условий:
+    - с момента последнего вебхука прошло debounce секунд (поток событий затих);
+    - с момента первого необработанного вебхука прошло max_latency секунд (даже если поток не затихает);
+    - накоплено max_batch_size вебхуков.
+    Вебхуки, пришедшие во время обработки, попадают в следующее окно. Повторное событие во время обработки
+    тоже открывает окно: оно сдвигает метку времени строки, и текущий запуск не отметит её обработанной.
+    Если обработка завершилась ошибкой, диспетчер ждёт с экспоненциально растущей задержкой
+    и запускает её снова, не дожидаясь новых вебхуков.
+    """
+
+    def __init__(self, process_batch, debounce=10.0, max_latency=60.0, max_batch_size=200, max_retry_delay=300.0):
+        self._process_batch = process_batch
+        self.debounce = debounce
+        self.max_latency = max_latency
+        self.max_batch_size = max_batch_size
+        self.max_retry_delay = max_retry_delay
+        self._failures = 0
+        self._event = asyncio.Event()
+        self._pending = 0
+        self._first_at = None
+        self._last_at = None
+        self._processing = False
+
+    def notify(self, count=1):
+        """
+        Сообщает диспетчеру о новых сохранённых вебхуках. Вызывается из обработчика вебхука.
+        count=0 — событие схлопнуто с уже ожидающим вебхуком; во время обработки оно считается новым.
+        """
+        if self._processing and not count:
+            count = 1
+        now = time.monotonic()
+        if self._first_at is None:
+            self._first_at = now
+        self._last_at = now
+        self._pending += count
+        self._event.set()
+
+    async def _wait_for_trigger(self):
+        """
+        Ждёт, пока текущее окно не будет готово к обработке, и возвращает причину запуска.
+        """
+        while True:
+            if self._pending >= self.max_batch_size:
+                return f"накоплено {self._pending} вебхуков"
+
+            now = time.monotonic()
+            quiet_deadline = self._last_at + self.debounce
+            hard_deadline = self._first_at + self.max_latency
+            if now >= hard_deadline:
+                return f"достигнута максимальная задержка {self.max_latency} с"
+            if now >= quiet_deadline:
+                return f"простой {self.debounce} с"
+
+            # Ждём нового вебхука или наступления ближайшего срока
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout=min(quiet_deadline, hard_deadline) - now)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        """
+        Основной цикл диспетчера. Запускается вместе с ботом и сервером.
+        """
+        # Вебхуки, оставшиеся необработанными до перезапуска, обрабатываются в первом окне
+        if await get_latest_webhook_timestamp() is not None:
+            logging.info("Найдены необработанные вебхуки с прошлого запуска.")
+            self.notify()
+
+        while True:
+            await self._event.wait()
+            if not self._pending:
+                self._event.clear()
+                self._first_at = None
+                continue
+
+            reason = await self._wait_for_trigger()
+            pending = self._pending
+            self._pending = 0
+            self._first_at = None
+            self._event.clear()
+
+            logging.info(f"Запуск обработки {pending} вебхуков: {reason}.")
+            self._processing = True
+            try:
+                await self._process_batch()
+                self._failures = 0
+            except Exception as e:
+                delay = backoff_delay(self._failures, base=self.debounce, cap=self.max_retry_delay)
+                self._failures += 1
+                logging.error(f"Ошибка при пакетной обработке вебхуков: {e}. Повтор через {delay:.1f} с.")
+                await asyncio.sleep(delay)
+                self.notify()
+            finally:
+                self._processing = False